@@ -290,7 +290,7 @@ def create_window(canvas, title, zoom=1.0):
     b = Gtk.Button.new_with_label('Dump QTree')
 
     def on_clicked(button, li):
-        view._qtree.dump()
+        view.canvas.spatial_index.dump()
 
     b.connect('clicked', on_clicked, [0])
     v.add(b)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""
+Benchmarks for bulk operations on the solver and canvas.
+
+Run all benchmarks, or only the ones named on the command line:
+
+    python demo_benchmark.py [name ...]
+"""
+
+from __future__ import print_function
+
+import sys
+from timeit import Timer
+
+from gaphas import Canvas
+from gaphas.examples import Box
+from gaphas.item import Line
+from gaphas.solver import Solver, Variable, STRONG
+from gaphas.simplex import SimplexSolver
+from gaphas.constraint import EqualsConstraint, LessThanConstraint, \
+    CenterConstraint
+
+
+def solve_marked():
+    """
+    Solving time should grow linearly with the number of marked
+    constraints.
+    """
+    for n in (1000, 10000, 100000):
+        solver = Solver()
+        for i in range(n):
+            solver.add_constraint(EqualsConstraint(Variable(0), Variable(1)))
+        t = Timer(solver.solve).timeit(number=1)
+        print('[%d marked constraints: %gms]' % (n, t * 1000))
+
+
+def batch():
+    """
+    Compare solving one by one with batch solving, when loading a 50k
+    constraint solver and moving 5000 items.
+    """
+    for mode in (False, True):
+        solver = Solver(batch=mode)
+        items = []
+        for i in range(50000 // 4):
+            x0, y0 = Variable(i * 10), Variable(0)
+            x1, y1 = Variable(i * 10 + 5), Variable(5)
+            solver.add_constraint(LessThanConstraint(smaller=x0, bigger=x1, delta=10))
+            solver.add_constraint(LessThanConstraint(smaller=y0, bigger=y1, delta=10))
+            center = Variable(0)
+            solver.add_constraint(CenterConstraint(x0, x1, center))
+            solver.add_constraint(EqualsConstraint(center, Variable(0)))
+            items.append((x0, y0, x1, y1))
+        load = Timer(solver.solve).timeit(number=1)
+        for item in items[:5000]:
+            for v in item:
+                v.value += 10
+        move = Timer(solver.solve).timeit(number=1)
+        print('[batch=%s: load %gms, move %gms]' % (mode, load * 1000, move * 1000))
+
+
+def simplex_chain():
+    """
+    Load a chain of coupled inequalities in the simplex solver and
+    push the chain from its head.
+    """
+    for n in (100, 200, 400):
+        solver = SimplexSolver()
+        variables = [Variable(0, STRONG)] + [Variable(i) for i in range(1, n)]
+
+        def load():
+            for a, b in zip(variables, variables[1:]):
+                solver.add_constraint(LessThanConstraint(smaller=a, bigger=b, delta=1))
+            solver.solve()
+
+        load = Timer(load).timeit(number=1)
+        variables[0].value = 10
+        push = Timer(solver.solve).timeit(number=1)
+        print('[%d chained constraints: load %gms, push %gms]' % (n, load * 1000, push * 1000))
+
+
+def canvas_import():
+    """
+    Import 10000 boxes and 10000 lines, connecting the boxes in a
+    ring.
+    """
+    n = 10000
+    canvas = Canvas()
+    boxes = [Box() for i in range(n)]
+    lines = [Line() for i in range(n)]
+
+    def connect(line, handle, item):
+        port = item.ports()[0]
+        constraint = port.constraint(canvas, line, handle, item)
+        canvas.connect_item(line, handle, item, port, constraint)
+
+    def load():
+        with canvas.batch():
+            for i, b in enumerate(boxes):
+                b.matrix.translate(i * 20, 0)
+                canvas.add(b)
+            for i, l in enumerate(lines):
+                canvas.add(l)
+                connect(l, l.handles()[0], boxes[i])
+                connect(l, l.handles()[-1], boxes[(i + 1) % n])
+
+    t = Timer(load).timeit(number=1)
+    print('[import: %gs]' % t)
+
+
+BENCHMARKS = (solve_marked, batch, simplex_chain, canvas_import)
+
+
+def main(names):
+    for benchmark in BENCHMARKS:
+        if not names or benchmark.__name__ in names:
+            print('%s:' % benchmark.__name__)
+            benchmark()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
+
+# vim: sw=4:et:
@@ -74,9 +74,12 @@ class ItemInMotion(object):
         self.item = item
         self.view = view
         self.last_x, self.last_y = None, None
+        self._plan = None
 
     def start_move(self, pos):
         self.last_x, self.last_y = pos
+        # The constraints to solve are found on the first move
+        self._plan = self.item.canvas.solver.create_plan()
 
     def move(self, pos):
         """
@@ -95,7 +98,9 @@ class ItemInMotion(object):
         item.canvas.request_matrix_update(item)
 
     def stop_move(self):
-        pass
+        if self._plan is not None:
+            self.item.canvas.solver.discard_plan(self._plan)
+            self._plan = None
 
 
 InMotion = generic(ItemInMotion)
@@ -173,6 +178,7 @@ class ItemHandleInMotion(object):
         self.handle = handle
         self.view = view
         self.last_x, self.last_y = None, None
+        self._plan = None
 
     def start_move(self, pos):
         self.last_x, self.last_y = pos
@@ -182,6 +188,10 @@ class ItemHandleInMotion(object):
         if cinfo:
             canvas.solver.remove_constraint(cinfo.constraint)
 
+        # Reuse the propagation order while the handle is dragged
+        handle_pos = self.handle.pos
+        self._plan = canvas.solver.create_plan(handle_pos.x, handle_pos.y)
+
     def move(self, pos):
         item = self.item
         handle = self.handle
@@ -202,7 +212,9 @@ class ItemHandleInMotion(object):
         return sink
 
     def stop_move(self):
-        pass
+        if self._plan is not None:
+            self.item.canvas.solver.discard_plan(self._plan)
+            self._plan = None
 
     def glue(self, pos, distance=GLUE_DISTANCE):
         """
@@ -35,13 +35,21 @@ from builtins import range
 __version__ = "$Revision$"
 # $HeadURL$
 
-from collections import namedtuple
+from collections import namedtuple, deque
+from itertools import chain, count
+from array import array
+from contextlib import contextmanager
+from timeit import default_timer
 import logging
+import math
 
 from cairo import Matrix
 from gaphas import tree
 from gaphas import solver
+from gaphas.solver import Solver
 from gaphas import table
+from gaphas.geometry import Rectangle
+from gaphas.quadtree import LooseQuadtree
 from gaphas.decorators import nonrecursive, AsyncIO
 from .state import observed, reversible_method, reversible_pair
 
@@ -91,20 +99,70 @@ class Context(object):
 class Canvas(object):
     """
     Container class for items.
+
+    A different constraint solver can be provided, e.g. a
+    `simplex.SimplexSolver`. By default a `solver.Solver` is used.
+
+    The views share a spatial index of the items. By default a
+    `quadtree.LooseQuadtree` is used. For diagrams that are mostly
+    browsed, a `rtree.PackedRTree` can be provided instead.
     """
 
-    def __init__(self):
+    def __init__(self, solver=None, spatial_index=None):
         self._tree = tree.Tree()
-        self._solver = solver.Solver()
+        # The tree keeps the index up to date from here on
+        self._tree.index_nodes('_canvas_index')
+        self._solver = solver if solver is not None else Solver()
         self._connections = table.Table(Connection, list(range(4)))
+        # handle -> Connection, kept in sync with the connection table
+        self._handle_connections = {}
         self._dirty_items = set()
         self._dirty_matrix_items = set()
         self._dirty_index = False
 
+        # Bounding boxes of the items, in canvas coordinates. The
+        # index is shared by all views, see set_item_bounding_box().
+        self._qtree = spatial_index if spatial_index is not None else LooseQuadtree()
+
+        # Bulk editing, see batch()
+        self._batch_level = 0
+        self._removed_items = []
+
         self._registered_views = set()
 
+        # Update profiling, see profile()
+        self._profiler = None
+
+        # Context for measuring without a view, see measure_context
+        self._measure_context = None
+
     solver = property(lambda s: s._solver)
 
+    # Only call pre_update() and post_update() on items that override
+    # the (empty) methods of Item. No context is built if no item needs it.
+    skip_default_updates = True
+
+
+    def profile(self, profiler=None):
+        """
+        Report the time spent in each phase of ``update_now()`` to
+        ``profiler``, an `UpdateProfiler`. Profiling is turned off by
+        passing ``None``.
+
+        >>> c = Canvas()
+        >>> stats = UpdateStats()
+        >>> c.profile(stats)
+        >>> from gaphas import item
+        >>> c.add(item.Item())
+        >>> c.update_now()
+        >>> stats.passes
+        1
+        >>> stats.counts['sort']
+        1
+        >>> c.profile(None)
+        """
+        self._profiler = profiler
+
 
     @observed
     def add(self, item, parent=None, index=None):
@@ -120,9 +178,8 @@ class Canvas(object):
         >>> i._canvas is c
         True
         """
-        assert item not in self._tree.nodes, 'Adding already added node %s' % item
+        assert item not in self._tree, 'Adding already added node %s' % item
         self._tree.add(item, parent, index)
-        self._dirty_index = True
 
         self.update_matrix(item, parent)
 
@@ -139,7 +196,10 @@ class Canvas(object):
         """
         item._set_canvas(None)
         self._tree.remove(item)
-        self._update_views(removed_items=(item,))
+        if self._batch_level:
+            self._removed_items.append(item)
+        else:
+            self._update_views(removed_items=(item,))
         self._dirty_items.discard(item)
         self._dirty_matrix_items.discard(item)
 
@@ -167,6 +227,134 @@ class Canvas(object):
                            'index': lambda self, item: self._tree.get_siblings(item).index(item) })
 
 
+    def _expand_items(self, items):
+        """
+        Return ``items`` and all their children, in depth-first order.
+        """
+        all_items = set(items)
+        for item in items:
+            all_items.update(self._tree.get_all_children(item))
+        return self.sort(all_items)
+
+
+    def _positions(self, items):
+        """
+        Return (item, parent, index) tuples for ``items`` and their
+        children, so they can be restored with ``add_many()``.
+        """
+        get_parent = self._tree.get_parent
+        get_siblings = self._tree.get_siblings
+        return [(item, get_parent(item), get_siblings(item).index(item))
+                for item in self._expand_items(items)]
+
+
+    def _connections_to_items(self, items):
+        """
+        Return all connections from and to ``items``.
+        """
+        query = self._connections.query
+        connections = {}
+        for item in items:
+            for cinfo in chain(query(item=item), query(connected=item)):
+                connections[cinfo.item, cinfo.handle] = cinfo
+        return list(connections.values())
+
+
+    @observed
+    def add_many(self, items_with_parents, connections=()):
+        """
+        Add a sequence of items to the canvas. ``items_with_parents``
+        contains (item, parent) pairs or (item, parent, index) tuples.
+        Parents should be added before their children.
+        ``connections`` are `Connection` tuples that are connected
+        once all items are added.
+
+        All items are added before the views are notified, and the
+        undo system records the operation as a whole.
+
+        >>> c = Canvas()
+        >>> from gaphas import item
+        >>> i = item.Item()
+        >>> ii = item.Item()
+        >>> c.add_many([(i, None), (ii, i)])
+        >>> c.get_parent(ii) is i
+        True
+        """
+        tree = self._tree
+        added = []
+        for entry in items_with_parents:
+            item, parent = entry[:2]
+            index = entry[2] if len(entry) > 2 else None
+            assert item not in tree, 'Adding already added node %s' % item
+            tree.add(item, parent, index)
+            self.update_matrix(item, parent)
+            added.append(item)
+
+        for item in added:
+            item._set_canvas(self)
+
+        for cinfo in connections:
+            self.connect_item(*cinfo)
+
+        mark_dirty = self._mark_dirty
+        for item in added:
+            mark_dirty(item)
+        self._dirty_matrix_items.update(added)
+        if not self._batch_level:
+            self.update()
+
+
+    @observed
+    def remove_many(self, items):
+        """
+        Remove a list of items, and their children, from the canvas.
+        The connection table is searched once for all items, the tree
+        is cut per subtree and the views are notified only once.
+
+        >>> c = Canvas()
+        >>> from gaphas import item
+        >>> i = item.Item()
+        >>> ii = item.Item()
+        >>> c.add_many([(i, None), (ii, i)])
+        >>> c.remove_many([i])
+        >>> c.get_all_items()
+        []
+        """
+        removed = self._expand_items(items)
+        if not removed:
+            return
+
+        disconnect_item = self._disconnect_item
+        for cinfo in self._connections_to_items(removed):
+            disconnect_item(*cinfo)
+
+        # Children first, like remove() does
+        for item in reversed(removed):
+            item._set_canvas(None)
+
+        # Removing a parent removes its subtree, so only the topmost
+        # items are removed. Determine them before the tree changes.
+        tree = self._tree
+        get_parent = tree.get_parent
+        removed_set = set(removed)
+        roots = [item for item in removed
+                 if get_parent(item) not in removed_set]
+        for item in roots:
+            tree.remove(item)
+
+        self._dirty_items.difference_update(removed)
+        self._dirty_matrix_items.difference_update(removed)
+        if self._batch_level:
+            self._removed_items.extend(removed)
+        else:
+            self._update_views(removed_items=removed)
+
+    reversible_pair(add_many, remove_many,
+                    bind1={'items_with_parents': lambda self, items: self._positions(items),
+                           'connections': lambda self, items: self._connections_to_items(self._expand_items(items)) },
+                    bind2={'items': lambda self, items_with_parents: [entry[0] for entry in items_with_parents] })
+
+
     @observed
     def reparent(self, item, parent, index=None):
         """
@@ -174,13 +362,52 @@ class Canvas(object):
         """
         self._tree.reparent(item, parent, index)
 
-        self._dirty_index = True
+        # The new ancestors need an update, too
+        if item in self._dirty_items:
+            self._dirty_items.discard(item)
+            self._mark_dirty(item)
 
     reversible_method(reparent, reverse=reparent,
                       bind={'parent': lambda self, item: self.get_parent(item),
                             'index': lambda self, item: self._tree.get_siblings(item).index(item) })
 
 
+    @contextmanager
+    def batch(self):
+        """
+        Bulk edit the canvas, e.g. when a diagram is loaded. Within the
+        ``with`` block no updates are scheduled, the solver does not
+        mark constraints and views are not notified. When the outermost
+        block is left, the canvas is updated in one go: the index, the
+        matrices, the constraints and finally the views.
+
+        Changes made in the block are recorded by the undo system, as
+        usual.
+
+        >>> c = Canvas()
+        >>> from gaphas import item
+        >>> with c.batch():
+        ...     for n in range(3):
+        ...         c.add(item.Item())
+        ...     len(c._dirty_items)
+        3
+        >>> len(c._dirty_items)
+        0
+        """
+        self._batch_level += 1
+        self._solver.suspend()
+        try:
+            yield self
+        finally:
+            self._solver.resume()
+            try:
+                # Requests made while updating need no extra update
+                if self._batch_level == 1:
+                    self.update_now()
+            finally:
+                self._batch_level -= 1
+
+
     def get_all_items(self):
         """
         Get a list of all items.
@@ -197,6 +424,26 @@ class Canvas(object):
         return self._tree.nodes
 
 
+    def iter_items(self):
+        """
+        Iterate all items, in depth-first order. Unlike
+        ``get_all_items()`` no copy is made, so items should not be
+        added or removed while iterating.
+
+        >>> c = Canvas()
+        >>> from gaphas import item
+        >>> i = item.Item()
+        >>> c.add(i)
+        >>> list(c.iter_items()) # doctest: +ELLIPSIS
+        [<gaphas.item.Item ...>]
+        >>> c.item_count
+        1
+        """
+        return self._tree.iter_nodes()
+
+    item_count = property(lambda s: s._tree.node_count)
+
+
     def get_root_items(self):
         """
         Return the root items of the canvas.
@@ -330,6 +577,7 @@ class Canvas(object):
             raise ConnectionError('Handle %r of item %r is already connected' % (handle, item))
 
         self._connections.insert(item, handle, connected, port, constraint, callback)
+        self._handle_connections[handle] = Connection(item, handle, connected, port, constraint, callback)
 
         if constraint:
             self._solver.add_constraint(constraint)
@@ -358,6 +606,7 @@ class Canvas(object):
             callback()
 
         self._connections.delete(item, handle, connected, port, constraint, callback)
+        self._handle_connections.pop(handle, None)
 
     reversible_pair(connect_item, _disconnect_item)
 
@@ -433,6 +682,7 @@ class Canvas(object):
         self._connections.delete(item=cinfo.item, handle=cinfo.handle)
 
         self._connections.insert(item, handle, cinfo.connected, cinfo.port, constraint, cinfo.callback)
+        self._handle_connections[handle] = Connection(item, handle, cinfo.connected, cinfo.port, constraint, cinfo.callback)
         if constraint:
             self._solver.add_constraint(constraint)
 
@@ -458,10 +708,26 @@ class Canvas(object):
         >>> c.get_connection(i.handles()[1])     # doctest: +ELLIPSIS
         >>> c.get_connection(ii.handles()[0])    # doctest: +ELLIPSIS
         """
-        try:
-            return next(self._connections.query(handle=handle))
-        except StopIteration as ex:
-            return None
+        return self._handle_connections.get(handle)
+
+
+    def get_connections_for_handles(self, handles):
+        """
+        Get connection information for a sequence of handles. A list
+        is returned with a connection, or None, for each handle.
+
+        >>> c = Canvas()
+        >>> from gaphas import item
+        >>> i = item.Line()
+        >>> c.add(i)
+        >>> ii = item.Line()
+        >>> c.add(ii)
+        >>> c.connect_item(i, i.handles()[0], ii, ii.ports()[0])
+        >>> c.get_connections_for_handles(i.handles())  # doctest: +ELLIPSIS
+        [Connection(item=<gaphas.item.Line object at 0x...), None]
+        """
+        get = self._handle_connections.get
+        return [get(h) for h in handles]
 
 
     def get_connections(self, item=None, handle=None, connected=None, port=None):
@@ -562,6 +828,67 @@ class Canvas(object):
             return i2c * c2i
 
 
+    spatial_index = property(lambda s: s._qtree,
+                             doc="Spatial index of the item bounding boxes, "
+                                 "in canvas coordinates")
+
+
+    def set_item_bounding_box(self, item, bounds, data=None):
+        """
+        Update the bounding box of ``item`` in the spatial index.
+        ``bounds`` is in canvas coordinates. ``data`` is the bounding
+        box in item coordinates, as (x0, y0, x1, y1); it's used by
+        `update_item_bounding_box()`.
+
+        The index is shared by all views. It grows to cover all
+        items.
+
+        >>> c = Canvas()
+        >>> from gaphas import item
+        >>> i = item.Item()
+        >>> c.add(i)
+        >>> c.set_item_bounding_box(i, (10, 10, 20, 20), (0, 0, 20, 20))
+        >>> c.get_item_bounding_box(i)
+        (10, 10, 20, 20)
+        >>> c.spatial_index.find_intersect((15, 15, 1, 1)) == set([i])
+        True
+        """
+        self._qtree.add(item, bounds, data)
+
+
+    def get_item_bounding_box(self, item):
+        """
+        Get the bounding box of ``item``, in canvas coordinates.
+        A KeyError is raised if no bounding box has been calculated.
+        """
+        return self._qtree.get_bounds(item)
+
+
+    def update_item_bounding_box(self, item):
+        """
+        Recalculate the bounding box of ``item`` from its bounding
+        box in item coordinates. This is sufficient if only the
+        item's matrix has changed.
+
+        >>> c = Canvas()
+        >>> from gaphas import item
+        >>> i = item.Item()
+        >>> c.add(i)
+        >>> c.set_item_bounding_box(i, (0, 0, 20, 20), (0, 0, 20, 20))
+        >>> i.matrix.translate(5, 5)
+        >>> c.update_matrix(i)
+        True
+        >>> c.update_item_bounding_box(i)
+        >>> tuple(c.get_item_bounding_box(i))
+        (5.0, 5.0, 20.0, 20.0)
+        """
+        data = self._qtree.get_data(item)
+        i2c = self.get_matrix_i2c(item).transform_point
+        x0, y0 = i2c(data[0], data[1])
+        x1, y1 = i2c(data[2], data[3])
+        self.set_item_bounding_box(item, Rectangle(x0, y0, x1=x1, y1=y1), data)
+
+
     @observed
     def request_update(self, item, update=True, matrix=True):
         """
@@ -580,15 +907,62 @@ class Canvas(object):
         0
         """
         if update:
-            self._dirty_items.add(item)
+            self._mark_dirty(item)
         if matrix:
             self._dirty_matrix_items.add(item)
 
-        self.update()
+        if not self._batch_level:
+            self.update()
 
     reversible_method(request_update, reverse=request_update)
 
 
+    def _mark_dirty(self, item):
+        """
+        Mark ``item`` and its ancestors for a full update. The walk up
+        the tree stops at the first ancestor that is already marked:
+        all its ancestors are marked, too.
+        """
+        dirty_items = self._dirty_items
+        get_parent = self._tree.get_parent
+        while item is not None and item not in dirty_items:
+            dirty_items.add(item)
+            item = get_parent(item)
+
+
+    def _dirty_spine(self):
+        """
+        Return the items marked for a full update in depth-first
+        order. The ancestors of a marked item are marked, too, so the
+        walk only descends into marked items.
+
+        >>> c = Canvas()
+        >>> from gaphas import item
+        >>> i1, i2, i3, i4 = item.Item(), item.Item(), item.Item(), item.Item()
+        >>> c.add(i1)
+        >>> c.add(i2, i1)
+        >>> c.add(i3)
+        >>> c.add(i4, i2)
+        >>> c._mark_dirty(i4)
+        >>> c._mark_dirty(i3)
+        >>> c._dirty_spine() == [i1, i2, i4, i3]
+        True
+        """
+        dirty_items = self._dirty_items
+        get_children = self._tree.get_children
+        spine = []
+        stack = [iter(get_children(None))]
+        while stack:
+            for item in stack[-1]:
+                if item in dirty_items:
+                    spine.append(item)
+                    stack.append(iter(get_children(item)))
+                    break
+            else:
+                stack.pop()
+        return spine
+
+
     def request_matrix_update(self, item):
         """
         Schedule only the matrix to be updated.
@@ -625,6 +999,16 @@ class Canvas(object):
         self.update_now()
 
 
+    def _with_update_hook(self, items, name):
+        """
+        Return the items which need their ``name`` method, pre_update()
+        or post_update(), to be called.
+        """
+        if not self.skip_default_updates:
+            return items
+        return [item for item in items if _has_update_hook(item, name)]
+
+
     def _pre_update_items(self, items, cr):
         context_map = dict()
         c = Context(cairo=cr)
@@ -650,37 +1034,52 @@ class Canvas(object):
     def update_now(self):
         """
         Peform an update of the items that requested an update.
+
+        If a profiler is set (see ``profile()``), the time spent in
+        each phase is recorded in an `UpdateTimings` instance.
         """
+        profiler = self._profiler
+        if profiler is not None:
+            timings = UpdateTimings()
+            mark = timings.mark
+        else:
+            timings = None
+            mark = _no_mark
 
         if self._dirty_index:
             self.update_index()
             self._dirty_index = False
+            mark('index', self._tree.node_count)
 
-        sort = self.sort
         extend_dirty_items = self._extend_dirty_items
 
-        # perform update requests for parents of dirty items
-        dirty_items = self._dirty_items
-        for item in set(dirty_items):
-            dirty_items.update(self._tree.get_ancestors(item))
-
         # order the dirty items, so they are updated bottom to top
-        dirty_items = sort(self._dirty_items, reverse=True)
+        dirty_items = self._dirty_spine()
+        dirty_items.reverse()
+        mark('sort', len(dirty_items))
 
         self._dirty_items.clear()
+        dirty_matrix_items = set()
 
         try:
-            cr = self._obtain_cairo_context()
+            # The cairo context is only obtained when an item needs it
+            cr = None
 
             # allow programmers to perform tricks and hacks before item
             # full update (only called for items that requested a full update)
-            self._pre_update_items(dirty_items, cr)
+            update_items = self._with_update_hook(dirty_items, 'pre_update')
+            if update_items:
+                cr = self._obtain_cairo_context()
+                self._pre_update_items(update_items, cr)
+            mark('pre_update', len(update_items))
 
             # recalculate matrices
             dirty_matrix_items = self.update_matrices(self._dirty_matrix_items)
             self._dirty_matrix_items.clear()
+            mark('matrices', len(dirty_matrix_items))
 
             self.update_constraints(dirty_matrix_items)
+            mark('solve', len(dirty_matrix_items))
 
             # no matrix can change during constraint solving
             assert not self._dirty_matrix_items, 'No matrices may have been marked dirty (%s)' % (self._dirty_matrix_items,)
@@ -696,24 +1095,45 @@ class Canvas(object):
 
             # recalculate matrices of normalized items
             dirty_matrix_items.update(self.update_matrices(normalized_items))
+            mark('normalize', len(normalized_items))
 
             # ensure constraints are still true after normalization
             self._solver.solve()
+            mark('solve_normalized', len(normalized_items))
 
             # item's can be marked dirty due to normalization and solving
             extend_dirty_items(dirty_items)
 
             assert not self._dirty_items, 'No items may have been marked dirty (%s)' % (self._dirty_items,)
 
-            self._post_update_items(dirty_items, cr)
+            update_items = self._with_update_hook(dirty_items, 'post_update')
+            if update_items:
+                if cr is None:
+                    cr = self._obtain_cairo_context()
+                self._post_update_items(update_items, cr)
+            mark('post_update', len(update_items))
 
         except Exception as e:
             logging.error('Error while updating canvas', exc_info=e)
+            if timings is not None:
+                timings.error = e
+            # Drop the requests of the failed pass, the items involved
+            # are still handed to the views
+            extend_dirty_items(dirty_items)
+            dirty_matrix_items.update(self._dirty_matrix_items)
+            self._dirty_matrix_items.clear()
 
         assert len(self._dirty_items) == 0 and len(self._dirty_matrix_items) == 0, \
                 'dirty: %s; matrix: %s' % (self._dirty_items, self._dirty_matrix_items)
 
-        self._update_views(dirty_items, dirty_matrix_items)
+        removed_items = self._removed_items
+        if removed_items:
+            self._removed_items = []
+        self._update_views(dirty_items, dirty_matrix_items, removed_items)
+        mark('views', len(self._registered_views))
+
+        if timings is not None:
+            profiler.record(timings)
 
 
     def update_matrices(self, items):
@@ -724,44 +1144,96 @@ class Canvas(object):
         Return items, which matrices were recalculated.
         """
         changed = set()
+        get_parent = self._tree.get_parent
+        update_matrix = self.update_matrix
+        update_subtree_matrices = self._update_subtree_matrices
         for item in items:
-            parent = self._tree.get_parent(item)
+            parent = get_parent(item)
             if parent is not None and parent in items:
                 # item's matrix will be updated thanks to parent's matrix
                 # update
                 continue
 
-            self.update_matrix(item, parent)
+            update_matrix(item, parent)
             changed.add(item)
-
-            changed_children = self.update_matrices(set(self.get_children(item)))
-            changed.update(changed_children)
+            update_subtree_matrices(item, changed)
 
         return changed
 
 
+    def _update_subtree_matrices(self, item, changed):
+        """
+        Recalculate the matrices of all children of ``item``, of which
+        the matrices are up to date. The children are visited in one
+        pass over their (depth-first) range in the tree. The i2c
+        affines are kept in one flat array, 6 values per item, so each
+        child can be combined with the row of its parent. Cairo
+        matrices are only created for children of which the i2c matrix
+        really changed.
+
+        Children are added to ``changed``.
+        """
+        children = self._tree.get_all_children(item)
+        get_parent = self._tree.get_parent
+        set_matrix_i2c = self._set_matrix_i2c
+        rows = {item: 0}
+        affines = array('d', item._matrix_i2c)
+        for child in children:
+            parent = get_parent(child)
+            local = tuple(child.matrix)
+            key = (local, parent._matrix_i2c_version)
+            if key == child._matrix_i2c_key and child._matrix_i2c is not None:
+                matrix_i2c = tuple(child._matrix_i2c)
+            else:
+                row = rows[parent] * 6
+                matrix_i2c = _multiply(local, affines[row:row + 6])
+                child._matrix_i2c_key = key
+                set_matrix_i2c(child, matrix_i2c)
+            rows[child] = len(rows)
+            affines.extend(matrix_i2c)
+            changed.add(child)
+
+
     def update_matrix(self, item, parent=None):
         """
         Update matrices of an item.
+
+        The matrices are only recalculated if the item's own matrix or
+        the i2c matrix of ``parent`` changed since the last update.
+        Each calculated i2c matrix gets a new version number, which is
+        what children check against.
+
+        Returns ``True`` if the i2c matrix changed.
         """
-        try:
-            orig_matrix_i2c = Matrix(*item._matrix_i2c)
-        except:
-            orig_matrix_i2c = None
+        local = tuple(item.matrix)
+        if parent is None:
+            key = (local, 0)
+        else:
+            key = (local, parent._matrix_i2c_version)
+        if key == item._matrix_i2c_key and item._matrix_i2c is not None:
+            return False
+        item._matrix_i2c_key = key
 
-        item._matrix_i2c = Matrix(*item.matrix)
+        if parent is None:
+            matrix_i2c = local
+        else:
+            matrix_i2c = _multiply(local, tuple(parent._matrix_i2c))
+        return self._set_matrix_i2c(item, matrix_i2c)
 
-        if parent is not None:
-            try:
-                item._matrix_i2c = item._matrix_i2c.multiply(parent._matrix_i2c)
-            except AttributeError:
-                # Fall back to old behaviour
-                item._matrix_i2c *= parent._matrix_i2c
 
-        if orig_matrix_i2c is None or orig_matrix_i2c != item._matrix_i2c:
-            # calculate c2i matrix and view matrices
-            item._matrix_c2i = Matrix(*item._matrix_i2c)
-            item._matrix_c2i.invert()
+    def _set_matrix_i2c(self, item, matrix_i2c):
+        """
+        Set the i2c matrix of ``item`` from a tuple of affine values.
+        The c2i matrix is only inverted if the matrix changed.
+        """
+        if item._matrix_i2c is not None and tuple(item._matrix_i2c) == tuple(matrix_i2c):
+            return False
+        item._matrix_i2c = Matrix(*matrix_i2c)
+        # calculate c2i matrix and view matrices
+        item._matrix_c2i = Matrix(*matrix_i2c)
+        item._matrix_c2i.invert()
+        item._matrix_i2c_version = next(_matrix_versions)
+        return True
 
 
     def update_constraints(self, items):
@@ -824,6 +1296,10 @@ class Canvas(object):
         """
         Provide each item in the canvas with an index attribute. This
         makes for fast searching of items.
+
+        The tree maintains the index while items are added and
+        reparented, so this is only needed to renumber all items,
+        e.g. after unpickling.
         """
         self._tree.index_nodes('_canvas_index')
 
@@ -853,6 +1329,12 @@ class Canvas(object):
         for v in self._registered_views:
             v.request_update(dirty_items, dirty_matrix_items, removed_items)
 
+        # The views have had their chance to look at the old bounds
+        qtree = self._qtree
+        for item in removed_items:
+            if item in qtree:
+                qtree.remove(item)
+
 
     def _obtain_cairo_context(self):
         """
@@ -862,8 +1344,7 @@ class Canvas(object):
         the bounding box for a piece of text (for that you'll need a
         CairoContext).  The Cairo context is created by a View
         registered as view on this canvas. By lack of registered
-        views, a PNG image surface is created that is used to create a
-        context.
+        views, the ``measure_context`` is used.
 
         >>> c = Canvas()
         >>> c.update_now()
@@ -874,9 +1355,28 @@ class Canvas(object):
             except AttributeError:
                 pass
         else:
+            return self.measure_context
+
+
+    def _get_measure_context(self):
+        if self._measure_context is None:
             import cairo
             surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 0, 0)
-            return cairo.Context(surface)
+            self._measure_context = cairo.Context(surface)
+        return self._measure_context
+
+    def _set_measure_context(self, cr):
+        self._measure_context = cr
+
+    measure_context = property(_get_measure_context, _set_measure_context,
+        doc="""Cairo context used to update items if no view provides
+        one, e.g. when running headless. It is created on first use,
+        but a context can be provided as well.
+
+        >>> c = Canvas()
+        >>> c.measure_context is c.measure_context
+        True
+        """)
 
 
     def __getstate__(self):
@@ -884,11 +1384,16 @@ class Canvas(object):
         Persist canvas. Dirty item sets and views are not saved.
         """
         d = dict(self.__dict__)
-        for n in ('_dirty_items', '_dirty_matrix_items', '_dirty_index', '_registered_views'):
+        for n in ('_dirty_items', '_dirty_matrix_items', '_dirty_index',
+                  '_batch_level', '_removed_items', '_registered_views',
+                  '_profiler', '_measure_context', '_qtree'):
             try:
                 del d[n]
             except KeyError:
                 pass
+        # The index is rebuilt by the views
+        d['_spatial_index_type'] = type(self._qtree)
+        d['_spatial_index_settings'] = self._qtree.settings()
         return d
 
 
@@ -899,10 +1404,23 @@ class Canvas(object):
         Before loading the state, the constructor is called.
         """
         self.__dict__.update(state)
-        self._dirty_items = set(self._tree.nodes)
-        self._dirty_matrix_items = set(self._tree.nodes)
+        if '_handle_connections' not in state:
+            # Canvas pickled before the handle map was introduced
+            query = self._connections.query
+            self._handle_connections = dict((cinfo.handle, cinfo)
+                    for item in self._tree.iter_nodes()
+                    for cinfo in query(item=item))
+        self._dirty_items = set(self._tree.iter_nodes())
+        self._dirty_matrix_items = set(self._tree.iter_nodes())
         self._dirty_index = True
+        self._batch_level = 0
+        self._removed_items = []
         self._registered_views = set()
+        self._profiler = None
+        self._measure_context = None
+        index_type = self.__dict__.pop('_spatial_index_type', LooseQuadtree)
+        settings = self.__dict__.pop('_spatial_index_settings', {})
+        self._qtree = index_type(**settings)
         #self.update()
 
 
@@ -1027,10 +1545,180 @@ class CanvasProjection(object):
         return iter(self.pos)
 
 
+# Per class, whether pre_update() and post_update() are overridden
+_update_hooks = {}
+
+def _has_update_hook(item, name):
+    """
+    Tell if ``item`` has a ``name`` method (pre_update or post_update)
+    other than the empty default of `gaphas.item.Item`.
+    """
+    if name in getattr(item, '__dict__', ()):
+        return True
+    cls = type(item)
+    try:
+        return _update_hooks[cls, name]
+    except KeyError:
+        from gaphas.item import Item
+        method = getattr(cls, name, None)
+        default = Item.__dict__[name]
+        hook = getattr(method, '__func__', method) is not default
+        _update_hooks[cls, name] = hook
+        return hook
+
+
+# Version numbers of i2c matrices, unique for the whole process
+_matrix_versions = count(1)
+
+def _multiply(a, b):
+    """
+    Multiply affines ``a`` and ``b``, given as (xx, yx, xy, yy, x0, y0)
+    sequences, like ``cairo.Matrix.multiply()`` does: the result first
+    applies ``a``, then ``b``.
+
+    >>> _multiply((2, 0, 0, 2, 1, 1), (1, 0, 0, 1, 10, 20))
+    (2, 0, 0, 2, 11, 21)
+    >>> _multiply((1, 0, 0, 1, 10, 20), (2, 0, 0, 2, 1, 1))
+    (2, 0, 0, 2, 21, 41)
+    """
+    axx, ayx, axy, ayy, ax0, ay0 = a
+    bxx, byx, bxy, byy, bx0, by0 = b
+    return (axx * bxx + ayx * bxy,
+            axx * byx + ayx * byy,
+            axy * bxx + ayy * bxy,
+            axy * byx + ayy * byy,
+            ax0 * bxx + ay0 * bxy + bx0,
+            ax0 * byx + ay0 * byy + by0)
+
+
+def _no_mark(phase, count):
+    """
+    Stands in for `UpdateTimings.mark()` if the canvas is not profiled.
+    """
+    pass
+
+
+class UpdateTimings(object):
+    """
+    Timings of one ``Canvas.update_now()`` pass:
+
+    phases
+        List of (phase, seconds, item count) tuples, in the order the
+        phases were executed. The phases are ``index``, ``sort``,
+        ``pre_update``, ``matrices``, ``solve``, ``normalize``,
+        ``solve_normalized``, ``post_update`` and ``views``. Phases
+        that were skipped, or not reached due to an error, are absent.
+    time
+        Total time of the update pass, in seconds.
+    error
+        The exception that ended the update pass, or ``None``.
+
+    >>> t = UpdateTimings()
+    >>> t.mark('sort', 2)
+    >>> [(phase, count) for phase, seconds, count in t.phases]
+    [('sort', 2)]
+    """
+
+    def __init__(self):
+        self.phases = []
+        self.error = None
+        self._start = self._last = default_timer()
+
+    time = property(lambda s: s._last - s._start)
+
+    def mark(self, phase, count):
+        """
+        End ``phase``, which handled ``count`` items.
+        """
+        now = default_timer()
+        self.phases.append((phase, now - self._last, count))
+        self._last = now
+
+
+class UpdateProfiler(object):
+    """
+    Receives the `UpdateTimings` of each update pass of a profiled
+    canvas (see ``Canvas.profile()``).
+    """
+
+    def record(self, timings):
+        """
+        Handle the `UpdateTimings` of an update pass.
+        """
+        pass
+
+
+class UpdateStats(UpdateProfiler):
+    """
+    Profiler that keeps the durations of the last ``window`` update
+    passes, per phase, so percentiles can be calculated.
+
+    >>> stats = UpdateStats(window=3)
+    >>> for n in range(5):
+    ...     t = UpdateTimings()
+    ...     t.phases.append(('solve', float(n), 1))
+    ...     stats.record(t)
+    >>> stats.passes
+    5
+    >>> stats.percentile('solve', 50)
+    3.0
+    >>> stats.percentile('solve', 100)
+    4.0
+    >>> stats.percentile('index', 50)
+    """
+
+    def __init__(self, window=100):
+        self.window = window
+        self.passes = 0
+        self.errors = 0
+        self.times = {}
+        self.counts = {}
+        self._total = deque(maxlen=window)
+
+    def record(self, timings):
+        self.passes += 1
+        if timings.error is not None:
+            self.errors += 1
+        self._total.append(timings.time)
+        times = self.times
+        counts = self.counts
+        for phase, seconds, count in timings.phases:
+            try:
+                times[phase].append(seconds)
+            except KeyError:
+                times[phase] = deque([seconds], maxlen=self.window)
+            counts[phase] = count
+
+    def percentile(self, phase, p):
+        """
+        Return the ``p``-th percentile of the duration of ``phase``
+        (nearest rank), or ``None`` if the phase was not recorded. The
+        phase ``None`` stands for the whole update pass.
+        """
+        values = self._total if phase is None else self.times.get(phase)
+        if not values:
+            return None
+        values = sorted(values)
+        rank = int(math.ceil(p / 100.0 * len(values)))
+        return values[max(rank, 1) - 1]
+
+    def as_dict(self, percentiles=(50, 90, 99)):
+        """
+        Return the percentiles of each phase as plain values. Useful
+        for exporting.
+        """
+        phases = [None] + sorted(self.times)
+        return dict(((phase or 'total'),
+                     dict((p, self.percentile(phase, p)) for p in percentiles))
+                    for phase in phases)
+
+
 # Additional tests in @observed methods
 __test__ = {
     'Canvas.add': Canvas.add,
     'Canvas.remove': Canvas.remove,
+    'Canvas.add_many': Canvas.add_many,
+    'Canvas.remove_many': Canvas.remove_many,
     'Canvas.request_update': Canvas.request_update,
     }
 
@@ -27,15 +27,29 @@ class Position(object):
     (Variable(3, 20), Variable(5, 20))
     >>> vp[0], vp[1]
     (Variable(3, 20), Variable(5, 20))
+
+    The variables are kept in ``store``, a `solver.VariableStore`, if
+    one is provided:
+
+    >>> from gaphas.solver import VariableStore
+    >>> store = VariableStore()
+    >>> vp = Position((3, 5), store=store)
+    >>> vp.x.store is store, len(store)
+    (True, 2)
     """
 
     x = solvable(varname='_v_x')
     y = solvable(varname='_v_y')
 
-    def __init__(self, pos, strength=NORMAL):
-        self.x, self.y = pos
-        self.x.strength = strength
-        self.y.strength = strength
+    def __init__(self, pos, strength=NORMAL, store=None):
+        if store is not None:
+            x, y = pos
+            self.set_x(store.variable(float(x), strength))
+            self.set_y(store.variable(float(y), strength))
+        else:
+            self.x, self.y = pos
+            self.x.strength = strength
+            self.y.strength = strength
 
     @observed
     def _set_pos(self, pos):
@@ -93,10 +107,12 @@ class Handle(object):
     object (with __call__() method), so the pickle handler can also
     pickle that. Pickle is not capable of pickling ``instancemethod``
     or ``function`` objects.
+
+    The position is kept in ``store``, if provided (see `Position`).
     """
 
-    def __init__(self, pos=(0, 0), strength=NORMAL, connectable=False, movable=True):
-        self._pos = Position(pos, strength)
+    def __init__(self, pos=(0, 0), strength=NORMAL, connectable=False, movable=True, store=None):
+        self._pos = Position(pos, strength, store)
         self._connectable = connectable
         self._movable = movable
         self._visible = True
@@ -26,6 +26,10 @@ LineConstraint
 New constraint class should derive from Constraint class abstract
 class and implement `Constraint.solve_for(Variable)` method to update
 a variable with appropriate value.
+
+EqualsConstraint, CenterConstraint and LessThanConstraint can solve
+many (independent) constraints at once, see
+`Constraint.solve_batch()`.
 """
 
 from __future__ import absolute_import
@@ -35,7 +39,8 @@ from __future__ import print_function
 from builtins import object
 import math
 
-from gaphas.solver import Projection
+from gaphas import state
+from gaphas.solver import BaseVariable, Variable, Projection
 
 
 __version__ = "$Revision$"
@@ -50,6 +55,55 @@ def _update(variable, value):
         variable.value = value
 
 
+def _value(v):
+    """
+    Value of a variable or a plain number (e.g. a delta).
+    """
+    return getattr(v, 'value', v)
+
+
+def _has_kernel(cls, base):
+    """
+    Check if constraint class ``cls`` can use the batch kernel of
+    ``base``. A subclass that solves differently can not.
+    """
+    return cls.solve == Constraint.solve and cls.solve_for == base.solve_for
+
+
+def _assign(targets, values):
+    """
+    Assign ``values`` to variables ``targets``. If no one is observing
+    state changes (e.g. for undo), the (costly) observed value setter
+    is bypassed for plain variables.
+    """
+    if state.observers:
+        for t, value in zip(targets, values):
+            t.value = value
+    else:
+        for t, value in zip(targets, values):
+            if isinstance(t, BaseVariable):
+                t._value = value
+                t.dirty()
+            else:
+                t.value = value
+
+
+def _solve_linear(targets, x, y, sign, mask=None):
+    """
+    Batch kernel: assign ``x + sign * y`` to the ``targets``.
+    Only targets for which ``mask`` is set (if provided) and whose
+    value really changes are updated.
+    """
+    changed, values = [], []
+    for i, t in enumerate(targets):
+        if mask is None or mask[i]:
+            v = x[i] + sign[i] * y[i]
+            if abs(t.value - v) > EPSILON:
+                changed.append(t)
+                values.append(v)
+    _assign(changed, values)
+
+
 class Constraint(object):
     """
     Constraint base class.
@@ -144,6 +198,16 @@ class Constraint(object):
         """
         raise NotImplemented
 
+    @classmethod
+    def solve_batch(cls, constraints):
+        """
+        Solve a batch of constraints of this class. The constraints
+        do not share variables. By default they're solved one by one,
+        subclasses may solve them all at once.
+        """
+        for c in constraints:
+            c.solve()
+
 
 
 class EqualsConstraint(Constraint):
@@ -181,6 +245,38 @@ class EqualsConstraint(Constraint):
                 (self.b, self.a.value + self.delta) or \
                 (self.delta, self.b.value - self.a.value)))
 
+    @classmethod
+    def solve_batch(cls, constraints):
+        """
+        >>> from gaphas.solver import Variable
+        >>> a, b, c, d = Variable(1.0), Variable(2.0), Variable(3.0), Variable(4.0, 30)
+        >>> EqualsConstraint.solve_batch([EqualsConstraint(a, b), EqualsConstraint(c, d, 1)])
+        >>> a, c
+        (Variable(2, 20), Variable(3, 20))
+        """
+        if not _has_kernel(cls, EqualsConstraint):
+            return super(EqualsConstraint, cls).solve_batch(constraints)
+
+        targets, x, y, sign = [], [], [], []
+        for c in constraints:
+            var = c.weakest()
+            if var is c.a:
+                targets.append(c.a)
+                x.append(c.b.value)
+                y.append(_value(c.delta))
+                sign.append(-1.0)
+            elif var is c.b:
+                targets.append(c.b)
+                x.append(c.a.value)
+                y.append(_value(c.delta))
+                sign.append(1.0)
+            else:
+                targets.append(c.delta)
+                x.append(c.b.value)
+                y.append(c.a.value)
+                sign.append(-1.0)
+        _solve_linear(targets, x, y, sign)
+
 
 
 class CenterConstraint(Constraint):
@@ -218,6 +314,17 @@ class CenterConstraint(Constraint):
         v = (self.a.value + self.b.value) / 2.0
         _update(self.center, v)
 
+    @classmethod
+    def solve_batch(cls, constraints):
+        if not _has_kernel(cls, CenterConstraint):
+            return super(CenterConstraint, cls).solve_batch(constraints)
+
+        n = len(constraints)
+        _solve_linear([c.center for c in constraints],
+                      [c.a.value / 2.0 for c in constraints],
+                      [c.b.value for c in constraints],
+                      [0.5] * n)
+
 
 
 class LessThanConstraint(Constraint):
@@ -263,6 +370,44 @@ class LessThanConstraint(Constraint):
             elif var is self.delta:
                 self.delta.value = self.bigger.value - self.smaller.value
 
+    @classmethod
+    def solve_batch(cls, constraints):
+        """
+        >>> from gaphas.solver import Variable
+        >>> a, b, c, d = Variable(3.0), Variable(2.0), Variable(1.0), Variable(2.0)
+        >>> lt1 = LessThanConstraint(smaller=a, bigger=b)
+        >>> lt2 = LessThanConstraint(smaller=c, bigger=d)
+        >>> LessThanConstraint.solve_batch([lt1, lt2])
+        >>> a, b, c, d
+        (Variable(3, 20), Variable(3, 20), Variable(1, 20), Variable(2, 20))
+        """
+        if not _has_kernel(cls, LessThanConstraint):
+            return super(LessThanConstraint, cls).solve_batch(constraints)
+
+        targets, x, y, sign, mask = [], [], [], [], []
+        for c in constraints:
+            var = c.weakest()
+            smaller = c.smaller.value
+            bigger = c.bigger.value
+            delta = _value(c.delta)
+            mask.append(smaller > bigger - delta)
+            if var is c.smaller:
+                targets.append(c.bigger)
+                x.append(smaller)
+                y.append(delta)
+                sign.append(1.0)
+            elif var is c.bigger:
+                targets.append(c.smaller)
+                x.append(bigger)
+                y.append(delta)
+                sign.append(-1.0)
+            else:
+                targets.append(c.delta)
+                x.append(bigger)
+                y.append(smaller)
+                sign.append(-1.0)
+        _solve_linear(targets, x, y, sign, mask)
+
 
 
 
@@ -288,12 +433,31 @@ class EquationConstraint(Constraint):
     >>> b
     Variable(1.6, 20)
 
+    The first time the constraint is solved for an argument, the
+    function is probed to find out if it's affine (linear) in that
+    argument. If so, it's solved directly from now on. Other
+    functions are solved with Newton's method.
+
+    >>> cons._affine
+    {'a': True, 'b': True}
+    >>> b.value = 4
+    >>> cons = EquationConstraint(lambda a, b: a * a - b, a=a, b=b)
+    >>> cons.solve_for(a)
+    >>> a
+    Variable(2, 20)
+    >>> cons._affine
+    {'a': False}
+
     From: http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/303396
     """
 
     def __init__(self, f, **args):
         super(EquationConstraint, self).__init__(*list(args.values()))
         self._f = f
+        # Per argument name: is the function affine in the argument,
+        # and the slope found when it was last solved by Newton's method.
+        self._affine = {}
+        self._slopes = {}
         self._args = {}
         # see important note on order of operations in __setattr__ below.
         for arg in f.__code__.co_varnames[0:f.__code__.co_argcount]:
@@ -362,23 +526,78 @@ class EquationConstraint(Constraint):
 
     def _solve_for(self, arg, args):
         """
-        Newton's method solver
+        Solve for argument ``arg``: directly if the function is affine
+        in ``arg``, otherwise with Newton's method.
+        """
+        affine = self._affine.get(arg)
+        if affine is None:
+            affine = self._affine[arg] = self._is_affine(arg, dict(args))
+        if affine:
+            x = self._solve_affine(arg, args)
+            if x is not None:
+                return x
+        return self._solve_newton(arg, args)
+
+
+    def _is_affine(self, arg, args):
+        """
+        Probe the function at three points to find out if it's
+        affine in ``arg``.
+        """
+        def f(x):
+            args[arg] = x
+            return self._f(**args)
+        x0 = args[arg]
+        h = max(1.0, abs(x0))
+        d1 = f(x0 + h) - f(x0)
+        d2 = f(x0 + 2 * h) - f(x0 + h)
+        return abs(d2 - d1) <= EPSILON * max(1.0, abs(d1), abs(d2))
+
+
+    def _solve_affine(self, arg, args):
+        """
+        Solve an affine function in closed form. The outcome is
+        checked, in case the function was not affine after all (e.g.
+        piecewise linear). Returns None if no solution was found.
+        """
+        def f(x):
+            args[arg] = x
+            return self._f(**args)
+        x0 = args[arg]
+        fx0 = f(x0)
+        if fx0 == 0:
+            return x0
+        slope = f(x0 + 1.0) - fx0
+        if slope:
+            x = x0 - fx0 / slope
+            if abs(f(x)) <= EPSILON * max(1.0, abs(fx0)):
+                return x
+            self._affine[arg] = False
+        args[arg] = x0
+
+
+    def _solve_newton(self, arg, args):
+        """
+        Newton's method solver. The slope found the last time is used
+        to make a first guess.
         """
-        #args = self._args
         close_runs = 10   # after getting close, do more passes
         if args[arg]:
             x0 = args[arg]
         else:
             x0 = 1
-        if x0 == 0:
-            x1 = 1
-        else:
-            x1 = x0*1.1
         def f(x):
             """function to solve"""
             args[arg] = x
             return self._f(**args)
         fx0 = f(x0)
+        slope = self._slopes.get(arg)
+        if slope:
+            x1 = x0 - fx0 / slope
+        elif x0 == 0:
+            x1 = 1
+        else:
+            x1 = x0*1.1
         n = 0
         while True:                    # Newton's method loop here
             fx1 = f(x1)
@@ -395,7 +614,7 @@ class EquationConstraint(Constraint):
             if n > ITERLIMIT:
                 print("Failed to converge; exceeded iteration limit")
                 break
-            slope = (fx1 - fx0) / (x1 - x0)
+            slope = self._slopes[arg] = (fx1 - fx0) / (x1 - x0)
             if slope == 0:
                 if close_flag:  # we're close but have zero slope, finish
                     break
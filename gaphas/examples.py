@@ -21,8 +21,8 @@ class Box(Element):
      SW +---+ SE
     """
 
-    def __init__(self, width=10, height=10):
-        super(Box, self).__init__(width, height)
+    def __init__(self, width=10, height=10, store=None):
+        super(Box, self).__init__(width, height, store)
 
     def draw(self, context):
         c = context.cairo
@@ -310,6 +310,25 @@ def distance_rectangle_point(rect, point):
     return abs(dx) + abs(dy)
 
 
+def distance_rectangle_point_euclidean(rect, point):
+    """
+    Return the distance from a rectangle ``(x, y, width, height)`` to a
+    ``point``. Unlike ``distance_rectangle_point()``, this is the
+    shortest distance, so it's never more than the distance from the
+    point to anything inside the rectangle.
+
+    >>> distance_rectangle_point_euclidean((0, 0, 10, 10), (13, -4))
+    5.0
+    >>> distance_rectangle_point_euclidean((0, 0, 10, 10), (5, 5))
+    0.0
+    """
+    px, py = point
+    rx, ry, rw, rh = rect
+    dx = max(rx - px, 0, px - rx - rw)
+    dy = max(ry - py, 0, py - ry - rh)
+    return sqrt(dx*dx + dy*dy)
+
+
 def point_on_rectangle(rect, point, border=False):
     """
     Return the point on which ``point`` can be projecten on the
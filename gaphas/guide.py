@@ -247,6 +247,7 @@ class GuidedItemInMotion(GuideMixin, ItemInMotion):
         except AttributeError:
             # No problem if guides do not exist.
             pass
+        super(GuidedItemInMotion, self).stop_move()
 
 
 @HandleInMotion.when_type(Item)
@@ -294,6 +295,7 @@ class GuidedItemHandleInMotion(GuideMixin, ItemHandleInMotion):
         except AttributeError:
             # No problem if guides do not exist.
             pass
+        super(GuidedItemHandleInMotion, self).stop_move()
 
 
 @PaintFocused.when_type(Item)
@@ -46,6 +46,11 @@ class Item(object):
     - _matrix_c2i:  canvas to item coordinates matrix
     - _matrix_i2v:  item to view coordinates matrices
     - _matrix_v2i:  view to item coordinates matrices
+    - _matrix_i2c_version:  version number of _matrix_i2c
+    - _matrix_i2c_key:  matrix and parent's i2c version _matrix_i2c
+      was calculated from
+    - _matrix_i2v_key:  i2c version and view matrix _matrix_i2v was
+      calculated from
     - _sort_key:  used to sort items
     - _canvas_projections:  used to sort items
     """
@@ -60,10 +65,13 @@ class Item(object):
         # used by gaphas.canvas.Canvas to hold conversion matrices
         self._matrix_i2c = None
         self._matrix_c2i = None
+        self._matrix_i2c_version = 0
+        self._matrix_i2c_key = None
 
         # used by gaphas.view.GtkView to hold item 2 view matrices (view=key)
         self._matrix_i2v = WeakKeyDictionary()
         self._matrix_v2i = WeakKeyDictionary()
+        self._matrix_i2v_key = WeakKeyDictionary()
         self._canvas_projections = WeakSet()
 
     @observed
@@ -289,7 +297,8 @@ class Item(object):
         Persist all, but calculated values (``_matrix_?2?``).
         """
         d = dict(self.__dict__)
-        for n in ('_matrix_i2c', '_matrix_c2i', '_matrix_i2v', '_matrix_v2i'):
+        for n in ('_matrix_i2c', '_matrix_c2i', '_matrix_i2v', '_matrix_v2i',
+                  '_matrix_i2c_version', '_matrix_i2c_key', '_matrix_i2v_key'):
             try:
                 del d[n]
             except KeyError:
@@ -302,9 +311,10 @@ class Item(object):
         """
         Set state. No ``__init__()`` is called.
         """
-        for n in ('_matrix_i2c', '_matrix_c2i'):
+        for n in ('_matrix_i2c', '_matrix_c2i', '_matrix_i2c_key'):
             setattr(self, n, None)
-        for n in ('_matrix_i2v', '_matrix_v2i'):
+        self._matrix_i2c_version = 0
+        for n in ('_matrix_i2v', '_matrix_v2i', '_matrix_i2v_key'):
             setattr(self, n, WeakKeyDictionary())
         self.__dict__.update(state)
         self._canvas_projections = WeakSet(state['_canvas_projections'])
@@ -322,14 +332,17 @@ class Element(Item):
      NW +---+ NE
         |   |
      SW +---+ SE
+
+    The handle positions are kept in ``store``, a
+    `solver.VariableStore`, if one is provided.
     """
 
     min_width = solvable(strength=REQUIRED, varname='_min_width')
     min_height = solvable(strength=REQUIRED, varname='_min_height')
 
-    def __init__(self, width=10, height=10):
+    def __init__(self, width=10, height=10, store=None):
         super(Element, self).__init__()
-        self._handles = [ h(strength=VERY_STRONG) for h in [Handle]*4 ]
+        self._handles = [ h(strength=VERY_STRONG, store=store) for h in [Handle]*4 ]
 
         handles = self._handles
         h_nw = handles[NW]
@@ -476,11 +489,16 @@ class Line(Item):
     methods do not have to know about the angle of the line segment
     (e.g. drawing a line from (10, 10) via (0, 0) to (10, -10) will
     draw an arrow point).
+
+    The handle positions are kept in ``store``, a
+    `solver.VariableStore`, if one is provided. Handles added later
+    on go in the same store.
     """
 
-    def __init__(self):
+    def __init__(self, store=None):
         super(Line, self).__init__()
-        self._handles = [Handle(connectable=True), Handle((10, 10), connectable=True)]
+        self._handles = [Handle(connectable=True, store=store),
+                         Handle((10, 10), connectable=True, store=store)]
         self._ports = []
         self._update_ports()
 
@@ -621,7 +639,9 @@ class Line(Item):
 
 
     def _create_handle(self, pos, strength=WEAK):
-        return Handle(pos, strength=strength)
+        # New handles go in the store of the existing ones, if any
+        store = getattr(self._handles[0].pos.x, 'store', None)
+        return Handle(pos, strength=strength, store=store)
 
 
     def _create_port(self, p1, p2):
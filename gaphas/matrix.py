@@ -4,8 +4,11 @@ the correct properties on gaphas' modules.
 
 Matrix
 ------
-Small utility class wrapping cairo.Matrix. The `Matrix` class adds
-state preservation capabilities.
+Small affine matrix class, compatible with cairo.Matrix. The `Matrix`
+class adds state preservation capabilities. It's implemented in plain
+Python, so changing a matrix is cheap: state changes are only sent out
+if there are observers (e.g. when undo recording is active). Use
+``to_cairo()`` to obtain a cairo.Matrix for drawing.
 """
 from __future__ import absolute_import
 from __future__ import division
@@ -15,91 +18,217 @@ from past.utils import old_div
 __version__ = "$Revision$"
 # $HeadURL$
 
-import cairo
-from .state import observed, reversible_method
+from math import cos, sin
+from .state import observed, observers, reversible_method
+
+try:
+    # Raise the same error as cairo.Matrix, if cairo is around
+    from cairo import Error as MatrixError
+except ImportError:
+    class MatrixError(ValueError):
+        pass
+
+
+def _observed(func):
+    """
+    Like `state.observed`, but the observed version of ``func`` is only
+    called if there are observers. Otherwise, ``func`` is called
+    directly.
+    """
+    dec = observed(func)
+    def wrapper(self, *args, **kwargs):
+        if observers:
+            return dec(self, *args, **kwargs)
+        return func(self, *args, **kwargs)
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    wrapper.__observer__ = dec
+    return wrapper
 
 
 class Matrix(object):
     """
-    Matrix wrapper. This version sends @observed messages on state changes
+    Affine matrix. This version sends @observed messages on state
+    changes. The values are (xx, yx, xy, yy, x0, y0), like in
+    cairo.Matrix: a point (x, y) is transformed to
+    (xx * x + xy * y + x0, yx * x + yy * y + y0).
 
-    >>> cairo.Matrix()
-    cairo.Matrix(1, 0, 0, 1, 0, 0)
     >>> Matrix()
     Matrix(1, 0, 0, 1, 0, 0)
+    >>> m = Matrix()
+    >>> m.translate(10, 20)
+    >>> m.scale(2, 2)
+    >>> m
+    Matrix(2, 0, 0, 2, 10, 20)
+    >>> m.transform_point(1, 1)
+    (12.0, 22.0)
+    >>> m.transform_distance(1, 1)
+    (2.0, 2.0)
+    >>> m.invert()
+    >>> m.transform_point(12, 22)
+    (1.0, 1.0)
+    >>> tuple(m.multiply(Matrix(1, 0, 0, 1, 5, 5)))
+    (0.5, 0.0, 0.0, 0.5, 0.0, -5.0)
+    >>> m = Matrix()
+    >>> m.translate(tx=1, ty=2)
+    >>> m
+    Matrix(1, 0, 0, 1, 1, 2)
+
+    A matrix that can not be inverted raises a `MatrixError`, which is
+    cairo.Error if cairo is available:
+
+    >>> try:
+    ...     Matrix(0, 0, 0, 0, 0, 0).invert()
+    ... except MatrixError as e:
+    ...     print(e)
+    invalid matrix (not invertible)
     """
 
+    __slots__ = ('xx', 'yx', 'xy', 'yy', 'x0', 'y0')
+
     def __init__(self, xx=1.0, yx=0.0, xy=0.0, yy=1.0, x0=0.0, y0=0.0):
-        self._matrix = cairo.Matrix(xx, yx, xy, yy, x0, y0)
+        self.xx = xx
+        self.yx = yx
+        self.xy = xy
+        self.yy = yy
+        self.x0 = x0
+        self.y0 = y0
 
     @staticmethod
     def init_rotate(radians):
-        return cairo.Matrix.init_rotate(radians)
+        c = cos(radians)
+        s = sin(radians)
+        return Matrix(c, s, -s, c, 0.0, 0.0)
+
+    def _set(self, xx, yx, xy, yy, x0, y0):
+        self.xx = xx
+        self.yx = yx
+        self.xy = xy
+        self.yy = yy
+        self.x0 = x0
+        self.y0 = y0
 
-    @observed
     def invert(self):
-        return self._matrix.invert()
+        xx, yx, xy, yy, x0, y0 = self.xx, self.yx, self.xy, self.yy, self.x0, self.y0
+        det = xx * yy - yx * xy
+        if not det:
+            raise MatrixError('invalid matrix (not invertible)')
+        self._set(yy / det, -yx / det, -xy / det, xx / det,
+                  (xy * y0 - yy * x0) / det, (yx * x0 - xx * y0) / det)
+
+    invert = _observed(invert)
 
-    @observed
     def rotate(self, radians):
-        return self._matrix.rotate(radians)
+        c = cos(radians)
+        s = sin(radians)
+        xx, yx, xy, yy = self.xx, self.yx, self.xy, self.yy
+        self.xx = c * xx + s * xy
+        self.yx = c * yx + s * yy
+        self.xy = c * xy - s * xx
+        self.yy = c * yy - s * yx
+
+    rotate = _observed(rotate)
 
-    @observed
     def scale(self, sx, sy):
-        return self._matrix.scale(sx, sy)
+        self.xx *= sx
+        self.yx *= sx
+        self.xy *= sy
+        self.yy *= sy
+
+    scale = _observed(scale)
 
-    @observed
     def translate(self, tx, ty):
-        self._matrix.translate(tx, ty)
+        self.x0 += self.xx * tx + self.xy * ty
+        self.y0 += self.yx * tx + self.yy * ty
 
-    @observed
-    def multiply(self, m):
-        return self._matrix.multiply(m)
+    translate = _observed(translate)
 
-    reversible_method(invert, invert)
-    reversible_method(rotate, rotate,
+    def multiply(self, m):
+        """
+        Return a new matrix, applying this matrix first, then ``m``.
+        """
+        axx, ayx, axy, ayy, ax0, ay0 = self.xx, self.yx, self.xy, self.yy, self.x0, self.y0
+        bxx, byx, bxy, byy, bx0, by0 = m
+        return Matrix(axx * bxx + ayx * bxy,
+                      axx * byx + ayx * byy,
+                      axy * bxx + ayy * bxy,
+                      axy * byx + ayy * byy,
+                      ax0 * bxx + ay0 * bxy + bx0,
+                      ax0 * byx + ay0 * byy + by0)
+
+    reversible_method(invert.__observer__, invert.__observer__)
+    reversible_method(rotate.__observer__, rotate.__observer__,
                       { 'radians': lambda radians: -radians })
-    reversible_method(scale, scale,
+    reversible_method(scale.__observer__, scale.__observer__,
                       { 'sx': lambda sx: old_div(1,sx), 'sy': lambda sy: old_div(1,sy) })
-    reversible_method(translate, translate,
+    reversible_method(translate.__observer__, translate.__observer__,
                       { 'tx': lambda tx: -tx, 'ty': lambda ty: -ty })
 
     def transform_distance(self, dx, dy):
-        self._matrix.transform_distance(dx, dy)
+        return (self.xx * dx + self.xy * dy + 0.0,
+                self.yx * dx + self.yy * dy + 0.0)
 
     def transform_point(self, x, y):
-        self._matrix.transform_point(x, y)
+        return (self.xx * x + self.xy * y + self.x0 + 0.0,
+                self.yx * x + self.yy * y + self.y0 + 0.0)
+
+    def transform_points(self, points):
+        """
+        Transform a sequence of (x, y) points. A NumPy array of shape
+        (n, 2) is transformed in one go, and an array is returned.
+        Otherwise a list of tuples is returned.
+
+        >>> Matrix(2, 0, 0, 2, 1, 1).transform_points([(0, 0), (1, 2)])
+        [(1.0, 1.0), (3.0, 5.0)]
+        """
+        xx, yx, xy, yy, x0, y0 = self.xx, self.yx, self.xy, self.yy, self.x0, self.y0
+        if hasattr(points, 'dot'):
+            return points.dot(((xx, yx), (xy, yy))) + (x0, y0)
+        return [(xx * x + xy * y + x0 + 0.0, yx * x + yy * y + y0 + 0.0)
+                for x, y in points]
+
+    def to_cairo(self):
+        """
+        Return the matrix as a cairo.Matrix, e.g. for drawing.
+        """
+        import cairo
+        return cairo.Matrix(self.xx, self.yx, self.xy, self.yy, self.x0, self.y0)
+
+    def __iter__(self):
+        return iter((self.xx, self.yx, self.xy, self.yy, self.x0, self.y0))
+
+    def __len__(self):
+        return 6
+
+    def __getitem__(self, val):
+        return (self.xx, self.yx, self.xy, self.yy, self.x0, self.y0)[val]
 
     def __eq__(self, other):
-        return self._matrix.__eq__(other)
+        try:
+            return tuple(self) == tuple(other)
+        except TypeError:
+            return NotImplemented
 
     def __ne__(self, other):
-        return self._matrix.__ne__(other)
-
-    def __le__(self, other):
-        return self._matrix.__le__(other)
-
-    def __lt__(self, other):
-        return self._matrix.__lt__(other)
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
 
-    def __ge__(self, other):
-        return self._matrix.__ge__(other)
+    __hash__ = None
 
-    def __gt__(self, other):
-        return self._matrix.__gt__(other)
-
-    def __getitem__(self, val):
-        return self._matrix.__getitem__(val)
-
-    @observed
     def __mul__(self, other):
-        return self._matrix.__mul__(other)
+        return self.multiply(other)
 
-    @observed
     def __rmul__(self, other):
-        return self._matrix.__rmul__(other)
+        return Matrix(*other).multiply(self)
+
+    def __reduce__(self):
+        return Matrix, tuple(self)
+
+    def __setstate__(self, state):
+        # Matrices pickled when they were wrapping a cairo.Matrix
+        self._set(*state['_matrix'])
 
     def __repr__(self):
-        return 'Matrix(%g, %g, %g, %g, %g, %g)' % tuple(self._matrix)
+        return 'Matrix(%g, %g, %g, %g, %g, %g)' % tuple(self)
 
 # vim:sw=4:et
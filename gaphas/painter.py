@@ -259,14 +259,15 @@ class BoundingBoxPainter(ItemPainter):
         super(BoundingBoxPainter, self)._draw_item(item, cairo)
         bounds = cairo.get_bounds()
 
-        # Update bounding box with handles.
+        # Update bounding box with handles. Handles have a fixed size
+        # on screen, the view adds a margin for that.
         view = self.view
         i2v = view.get_matrix_i2v(item).transform_point
-        for h in item.handles():
-            cx, cy = i2v(*h.pos)
-            bounds += (cx - 5, cy - 5, 9, 9)
+        handles = [i2v(*h.pos) for h in item.handles()]
+        if handles:
+            xs, ys = list(zip(*handles))
+            bounds += Rectangle(min(xs), min(ys), x1=max(xs), y1=max(ys))
 
-        bounds.expand(1)
         view.set_item_bounding_box(item, bounds)
 
 
@@ -299,15 +300,16 @@ class HandlePainter(Painter):
 
         cairo.set_line_width(1)
 
-        get_connection = view.canvas.get_connection
-        for h in item.handles():
+        handles = item.handles()
+        connections = view.canvas.get_connections_for_handles(handles)
+        for h, cinfo in zip(handles, connections):
             if not h.visible:
                 continue
             # connected and not being moved, see HandleTool.on_button_press
-            if get_connection(h):
+            if cinfo:
                 r, g, b = 1, 0, 0
             # connected but being moved, see HandleTool.on_button_press
-            elif get_connection(h):
+            elif cinfo:
                 r, g, b = 1, 0.6, 0
             elif h.movable:
                 r, g, b = 0, 1, 0
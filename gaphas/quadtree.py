@@ -21,15 +21,16 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-from builtins import zip
-from builtins import map
+from builtins import range
 from builtins import object
 from past.utils import old_div
 __version__ = "$Revision$"
 # $HeadURL$
 
-import operator
+from heapq import heapify, heappush, heappop
+from itertools import count, islice
 from .geometry import rectangle_contains, rectangle_intersects, rectangle_clip
+from .geometry import distance_rectangle_point_euclidean
 
 
 class Quadtree(object):
@@ -104,6 +105,11 @@ class Quadtree(object):
         # Easy lookup item->(bounds, data, clipped bounds) mapping
         self._ids = dict()
 
+        # Items that stick out of the tree bounds
+        self._outside = set()
+
+        self._soft_bounds = _SoftBounds()
+
 
     bounds = property(lambda s: s._bucket.bounds)
 
@@ -136,16 +142,18 @@ class Quadtree(object):
 
         >>> qtree.bounds
         (0, 0, 0, 0)
+
+        The soft bounds are kept up to date as items are added and
+        removed:
+
+        >>> qtree.add('1', (30, 20, 10, 10))
+        >>> qtree.soft_bounds
+        (20, 20, 40, 20)
+        >>> qtree.remove('2')
+        >>> qtree.soft_bounds
+        (30, 20, 10, 10)
         """
-        x_y_w_h = list(zip(*list(map(operator.getitem, iter(list(self._ids.values())), [0] * len(self._ids)))))
-        if not x_y_w_h:
-            return 0, 0, 0, 0
-        x0 = min(x_y_w_h[0])
-        y0 = min(x_y_w_h[1])
-        add = operator.add
-        x1 = max(list(map(add, x_y_w_h[0], x_y_w_h[2])))
-        y1 = max(list(map(add, x_y_w_h[1], x_y_w_h[3])))
-        return (x0, y0, x1 - x0, y1 - y0)
+        return self._soft_bounds.get(b[0] for b in self._ids.values())
 
     soft_bounds = property(get_soft_bounds)
 
@@ -160,8 +168,14 @@ class Quadtree(object):
         # Clip item bounds to fit in top-level bucket
         # Keep original bounds in _ids, for reference
         clipped_bounds = rectangle_clip(bounds, self._bucket.bounds)
+        if rectangle_contains(bounds, self._bucket.bounds):
+            self._outside.discard(item)
+        else:
+            self._outside.add(item)
 
+        self._soft_bounds.include(bounds)
         if item in self._ids:
+            self._soft_bounds.exclude(self._ids[item][0])
             old_clip = self._ids[item][2]
             if old_clip:
                 bucket = self._bucket.find_bucket(old_clip)
@@ -187,6 +201,8 @@ class Quadtree(object):
         """
         bounds, data, clipped_bounds = self._ids[item]
         del self._ids[item]
+        self._outside.discard(item)
+        self._soft_bounds.exclude(bounds)
         if clipped_bounds:
             self._bucket.find_bucket(clipped_bounds).remove(item)
 
@@ -197,6 +213,8 @@ class Quadtree(object):
         """
         self._bucket.clear()
         self._ids.clear()
+        self._outside.clear()
+        self._soft_bounds.clear()
 
 
     def rebuild(self):
@@ -205,9 +223,12 @@ class Quadtree(object):
         """
         # Clean bucket and items:
         self._bucket.clear()
+        self._outside.clear()
 
         for item, (bounds, data, _) in list(dict(self._ids).items()):
             clipped_bounds = rectangle_clip(bounds, self._bucket.bounds)
+            if not rectangle_contains(bounds, self._bucket.bounds):
+                self._outside.add(item)
             if clipped_bounds:
                 self._bucket.find_bucket(clipped_bounds).add(item, clipped_bounds)
             self._ids[item] = (bounds, data, clipped_bounds)
@@ -253,6 +274,120 @@ class Quadtree(object):
         return set(self._bucket.find(rect, method=rectangle_intersects))
 
 
+    def iter_nearest(self, point, max_distance=None, distance=None):
+        """
+        Iterate over the items nearest to ``point`` (x, y), nearest
+        first, as (distance, item) tuples.
+
+        The distance is measured to the item bounds, unless a function
+        ``distance(item)`` is provided. It should return the distance
+        to the item, or None to skip the item. To keep the order
+        right, it should not return less than the distance to the
+        bounds.
+
+        Buckets and items are visited best-first, so only the part of
+        the tree near the point is searched if iteration stops early.
+        Items further away than ``max_distance`` are not returned.
+        Items sticking out of the tree bounds are always considered,
+        with their full bounds.
+
+        >>> qtree = Quadtree((0, 0, 100, 100))
+        >>> for i in range(10):
+        ...     qtree.add(i, (i * 10, 0, 5, 5))
+        >>> next(qtree.iter_nearest((32, 20)))
+        (15.0, 3)
+        >>> next(qtree.iter_nearest((32, 20), distance=lambda i: abs(32 - i * 10) + 20))
+        (22, 3)
+        """
+        dist = distance_rectangle_point_euclidean
+        ids = self._ids
+        outside = self._outside
+        item_kind = _ITEM if distance is None else _BOUNDS
+        seq = count()
+        root = self._bucket
+        heap = [(dist(root.loose_bounds, point), next(seq), _BUCKET, root)]
+        # Buckets only hold the clipped bounds of those items
+        for item in outside:
+            heap.append((dist(ids[item][0], point), next(seq), item_kind, item))
+        heapify(heap)
+        while heap:
+            d, _, kind, obj = heappop(heap)
+            if max_distance is not None and d > max_distance:
+                return
+            if kind == _BUCKET:
+                for item in obj.items:
+                    if item in outside:
+                        continue
+                    d = dist(ids[item][0], point)
+                    if max_distance is None or d <= max_distance:
+                        heappush(heap, (d, next(seq), item_kind, item))
+                for bucket in obj._buckets:
+                    d = dist(bucket.loose_bounds, point)
+                    if max_distance is None or d <= max_distance:
+                        heappush(heap, (d, next(seq), _BUCKET, bucket))
+            elif kind == _BOUNDS:
+                d = distance(obj)
+                if d is not None:
+                    heappush(heap, (d, next(seq), _ITEM, obj))
+            else:
+                yield d, obj
+
+
+    def find_nearest(self, point, k=1, max_distance=None, distance=None):
+        """
+        Find the ``k`` items nearest to ``point``. See `iter_nearest()`.
+        Returns a list of (distance, item) tuples.
+        """
+        return list(islice(self.iter_nearest(point, max_distance, distance), k))
+
+
+    def find_within(self, point, radius, distance=None):
+        """
+        Find all items within ``radius`` of ``point``. See
+        `iter_nearest()`. Returns a list of (distance, item) tuples,
+        nearest first.
+        """
+        return list(self.iter_nearest(point, radius, distance))
+
+
+    def stats(self):
+        """
+        Return statistics on the structure of the tree, as a dict:
+
+        - buckets: number of buckets
+        - depth: depth of the deepest bucket (the top-level bucket is 0)
+        - items: number of items in the buckets
+        - root_items: number of items in the top-level bucket
+        - max_items: largest number of items in one bucket
+        - items_per_depth: a list with the number of items per level
+
+        >>> qtree = Quadtree((0, 0, 100, 100), capacity=2)
+        >>> for i in range(4):
+        ...     qtree.add(i, (i * 20 + 5, 5, 10, 10))
+        >>> stats = qtree.stats()
+        >>> stats['buckets'], stats['depth'], stats['root_items']
+        (5, 1, 1)
+        >>> stats['items_per_depth']
+        [1, 3]
+        """
+        buckets = 0
+        max_items = 0
+        items_per_depth = []
+        for bucket, depth in self._bucket.walk():
+            buckets += 1
+            n = len(bucket.items)
+            max_items = max(max_items, n)
+            if depth == len(items_per_depth):
+                items_per_depth.append(0)
+            items_per_depth[depth] += n
+        return dict(buckets=buckets,
+                    depth=len(items_per_depth) - 1,
+                    items=sum(items_per_depth),
+                    root_items=items_per_depth[0],
+                    max_items=max_items,
+                    items_per_depth=items_per_depth)
+
+
     def __len__(self):
         """
         Return number of items in tree.
@@ -267,6 +402,31 @@ class Quadtree(object):
         return item in self._ids
 
 
+    def settings(self):
+        """
+        Return the arguments to create an empty tree like this one.
+        """
+        return dict(bounds=self.bounds, capacity=self._capacity)
+
+
+    def node_bounds(self):
+        """
+        Iterate over the bounds of the buckets of the tree, e.g. for
+        debugging.
+
+        >>> qtree = Quadtree((0, 0, 100, 100), capacity=1)
+        >>> qtree.add('1', (10, 10, 10, 10))
+        >>> qtree.add('2', (60, 10, 10, 10))
+        >>> list(qtree.node_bounds())
+        [(0, 0, 100, 100), (0, 0, 50.0, 50.0), (50.0, 0, 50.0, 50.0), (0, 50.0, 50.0, 50.0), (50.0, 50.0, 50.0, 50.0)]
+        """
+        stack = [self._bucket]
+        while stack:
+            bucket = stack.pop()
+            yield bucket.bounds
+            stack.extend(reversed(bucket._buckets))
+
+
     def dump(self):
         """
         Print structure to stdout.
@@ -274,6 +434,10 @@ class Quadtree(object):
         self._bucket.dump()
 
 
+# Heap entries in Quadtree.iter_nearest()
+_BUCKET, _BOUNDS, _ITEM = list(range(3))
+
+
 class QuadtreeBucket(object):
     """
     A node in a Quadtree structure.
@@ -284,28 +448,39 @@ class QuadtreeBucket(object):
         Set bounding box for the node as (x, y, width, height).
         """
         self.bounds = bounds
+        # Items in this bucket and its sub-buckets are within these
+        # bounds. See LooseQuadtreeBucket.
+        self.loose_bounds = bounds
         self.capacity = capacity
 
         self.items = {}
         self._buckets = []
 
 
+    def _create_bucket(self, bounds):
+        """
+        Create a sub-bucket.
+        """
+        return QuadtreeBucket(bounds, self.capacity)
+
+
     def add(self, item, bounds):
         """
         Add an item to the quadtree.
         The bucket is split when nessecary.
         Items are otherwise added to this bucket, not some sub-bucket.
         """
-        assert rectangle_contains(bounds, self.bounds)
+        assert rectangle_contains(bounds, self.loose_bounds)
         # create new subnodes if threshold is reached
         if not self._buckets and len(self.items) >= self.capacity:
             x, y, w, h = self.bounds
             rw, rh = old_div(w, 2.), old_div(h, 2.)
             cx, cy = x + rw, y + rh
-            self._buckets = [QuadtreeBucket((x, y, rw, rh), self.capacity),
-                             QuadtreeBucket((cx, y, rw, rh), self.capacity),
-                             QuadtreeBucket((x, cy, rw, rh), self.capacity),
-                             QuadtreeBucket((cx, cy, rw, rh), self.capacity)]
+            create = self._create_bucket
+            self._buckets = [create((x, y, rw, rh)),
+                             create((cx, y, rw, rh)),
+                             create((x, cy, rw, rh)),
+                             create((cx, cy, rw, rh))]
             # Add items to subnodes
             items = list(self.items.items())
             self.items.clear()
@@ -367,7 +542,7 @@ class QuadtreeBucket(object):
 
         Returns an iterator.
         """
-        if rectangle_intersects(rect, self.bounds):
+        if rectangle_intersects(rect, self.loose_bounds):
             for item, bounds in list(self.items.items()):
                 if method(bounds, rect):
                     yield item
@@ -376,6 +551,17 @@ class QuadtreeBucket(object):
                     yield item
 
 
+    def walk(self, depth=0):
+        """
+        Iterate over (bucket, depth) for this bucket and all
+        sub-buckets.
+        """
+        yield self, depth
+        for bucket in self._buckets:
+            for b in bucket.walk(depth + 1):
+                yield b
+
+
     def clear(self):
         """
         Clear the bucket, including sub-buckets.
@@ -393,4 +579,299 @@ class QuadtreeBucket(object):
             bucket.dump(indent)
 
 
+class LooseQuadtree(Quadtree):
+    """
+    A loose quadtree. The buckets of a loose quadtree accept items that
+    stick out of the bucket bounds, by up to half the bucket size
+    (with the default ``looseness`` of 2). An item is put in the
+    bucket that contains its centre. So items on the centre lines of
+    a bucket can still move down the tree, instead of piling up in
+    the top-level bucket.
+
+    The tree does not clip: the top-level bucket grows to cover all
+    items added to the tree.
+
+    >>> qtree = LooseQuadtree((0, 0, 100, 100), capacity=4)
+    >>> for i in range(20):
+    ...     qtree.add(i, (i * 10 + 45, 45, 10, 10))
+    >>> qtree.bounds
+    (0, 0, 400, 400)
+    >>> sorted(qtree.find_intersect((40, 40, 20, 10)))
+    [0, 1]
+    >>> sorted(qtree.find_inside((100, 0, 80, 100)))
+    [6, 7, 8, 9, 10, 11, 12]
+    >>> qtree.stats()['root_items']
+    0
+    """
+
+    def __init__(self, bounds=(0, 0, 0, 0), capacity=10, looseness=2.0):
+        """
+        Create a new LooseQuadtree instance. ``bounds`` are the initial
+        bounds of the tree. The bounds grow as items are added.
+
+        The bounds of a bucket are enlarged by a factor ``looseness``
+        to get the bounds of the items it can contain.
+        """
+        self._looseness = looseness
+        super(LooseQuadtree, self).__init__(bounds, capacity)
+        self._bucket = LooseQuadtreeBucket(bounds, capacity, looseness)
+
+
+    def settings(self):
+        """
+        Return the arguments to create an empty tree like this one.
+        """
+        settings = super(LooseQuadtree, self).settings()
+        settings['looseness'] = self._looseness
+        return settings
+
+
+    def resize(self, bounds):
+        """
+        Resize the tree.
+        The tree structure is rebuild.
+        """
+        self._bucket = LooseQuadtreeBucket(bounds, self._capacity, self._looseness)
+        self.rebuild()
+
+
+    def _fits(self, bounds):
+        """
+        Check if ``bounds`` can be added to the top-level bucket.
+        """
+        bucket = self._bucket
+        x, y, w, h = bucket.bounds
+        cx, cy = _centre(bounds)
+        return x <= cx < x + w and y <= cy < y + h \
+                and rectangle_contains(bounds, bucket.loose_bounds)
+
+
+    def _grow(self, bounds):
+        """
+        Grow the tree, until ``bounds`` fits in the top-level bucket.
+        The old top-level bucket becomes a quadrant of the new one, so
+        no items have to be moved.
+        """
+        while not self._fits(bounds):
+            root = self._bucket
+            x, y, w, h = root.bounds
+            if w <= 0 or h <= 0:
+                # Empty tree: start with a square around the item
+                assert not self._ids
+                cx, cy = _centre(bounds)
+                size = max(bounds[2], bounds[3], 1.0)
+                self._bucket = LooseQuadtreeBucket((cx - size / 2., cy - size / 2., size, size),
+                                                   self._capacity, self._looseness)
+                continue
+
+            cx, cy = _centre(bounds)
+            index = 0
+            if cx < x:
+                x -= w
+                index += 1
+            if cy < y:
+                y -= h
+                index += 2
+            bucket = LooseQuadtreeBucket((x, y, w * 2, h * 2), self._capacity, self._looseness)
+            create = bucket._create_bucket
+            bucket._buckets = [create((x, y, w, h)),
+                               create((x + w, y, w, h)),
+                               create((x, y + h, w, h)),
+                               create((x + w, y + h, w, h))]
+            bucket._buckets[index] = root
+            self._bucket = bucket
+
+
+    def add(self, item, bounds, data=None):
+        """
+        Add an item to the tree.
+        If an item already exists, its bounds are updated and the item
+        is moved to the right bucket.
+        Data can be used to add some extra info to the item
+        """
+        self._soft_bounds.include(bounds)
+        if item in self._ids:
+            old_bounds = self._ids[item][0]
+            self._soft_bounds.exclude(old_bounds)
+            self._bucket.find_bucket(old_bounds).remove(item)
+
+        if not self._fits(bounds):
+            self._grow(bounds)
+        self._bucket.find_bucket(bounds).add(item, bounds)
+        self._ids[item] = (bounds, data, bounds)
+
+
+    def remove(self, item):
+        """
+        Remove an item from the tree.
+        """
+        bounds = self._ids.pop(item)[0]
+        self._soft_bounds.exclude(bounds)
+        self._bucket.find_bucket(bounds).remove(item)
+
+
+    def rebuild(self):
+        """
+        Rebuild the tree structure.
+        """
+        self._bucket.clear()
+        items = list(self._ids.items())
+        self._ids.clear()
+        self._soft_bounds.clear()
+        for item, (bounds, data, _) in items:
+            self.add(item, bounds, data)
+
+
+class LooseQuadtreeBucket(QuadtreeBucket):
+    """
+    A node in a LooseQuadtree structure.
+    """
+
+    def __init__(self, bounds, capacity, looseness):
+        super(LooseQuadtreeBucket, self).__init__(bounds, capacity)
+        self.looseness = looseness
+        x, y, w, h = bounds
+        mx = w * (looseness - 1) / 2.
+        my = h * (looseness - 1) / 2.
+        self.loose_bounds = (x - mx, y - my, w * looseness, h * looseness)
+
+
+    def _create_bucket(self, bounds):
+        """
+        Create a sub-bucket.
+        """
+        return LooseQuadtreeBucket(bounds, self.capacity, self.looseness)
+
+
+    def find_bucket(self, bounds):
+        """
+        Find the bucket that holds a bounding box: the bucket that
+        contains the centre of ``bounds``, as long as it is loose
+        enough to contain the box.
+        """
+        bucket = self
+        x, y = _centre(bounds)
+        while bucket._buckets:
+            sx, sy, sw, sh = bucket.bounds
+            index = 0
+            if x >= sx + sw / 2.:
+                index += 1
+            if y >= sy + sh / 2.:
+                index += 2
+            sub = bucket._buckets[index]
+            if not rectangle_contains(bounds, sub.loose_bounds):
+                break
+            bucket = sub
+        return bucket
+
+
+class _SoftBounds(object):
+    """
+    The union of a collection of rectangles, kept up to date as
+    rectangles are included and excluded.
+
+    For each side the outermost value is kept, with the number of
+    rectangles that have a side at that value. Only when the last of
+    those is excluded, the union is calculated from scratch, the next
+    time it's asked for.
+
+    >>> sb = _SoftBounds()
+    >>> sb.include((0, 0, 10, 10))
+    >>> sb.include((5, 5, 10, 10))
+    >>> sb.include((5, 0, 10, 10))
+    >>> sb.get(None)
+    (0, 0, 15, 15)
+
+    Another rectangle is on the right and top sides:
+
+    >>> sb.exclude((5, 0, 10, 10))
+    >>> sb.get(None)
+    (0, 0, 15, 15)
+
+    Only now the union has to be calculated again:
+
+    >>> sb.exclude((5, 5, 10, 10))
+    >>> sb.get([(0, 0, 10, 10)])
+    (0, 0, 10, 10)
+    """
+
+    __slots__ = ('_edges', '_counts', '_dirty')
+
+    def __init__(self):
+        self.clear()
+
+
+    def clear(self):
+        # Edges are stored as (x0, y0, -x1, -y1), so all are minimums
+        self._edges = None
+        self._counts = None
+        self._dirty = False
+
+
+    def include(self, bounds):
+        """
+        Add a rectangle to the union.
+        """
+        if self._dirty:
+            return
+        x, y, w, h = bounds
+        new = (x, y, -x - w, -y - h)
+        edges = self._edges
+        if edges is None:
+            self._edges = list(new)
+            self._counts = [1, 1, 1, 1]
+            return
+        counts = self._counts
+        for i in range(4):
+            e = new[i]
+            if e < edges[i]:
+                edges[i] = e
+                counts[i] = 1
+            elif e == edges[i]:
+                counts[i] += 1
+
+
+    def exclude(self, bounds):
+        """
+        Remove a rectangle, that was included before, from the union.
+        """
+        if self._dirty or self._edges is None:
+            return
+        x, y, w, h = bounds
+        old = (x, y, -x - w, -y - h)
+        edges = self._edges
+        counts = self._counts
+        for i in range(4):
+            if old[i] == edges[i]:
+                counts[i] -= 1
+                if not counts[i]:
+                    self._dirty = True
+                    return
+
+
+    def get(self, all_bounds):
+        """
+        Return the union as (x, y, width, height). ``all_bounds``
+        should provide all rectangles that are included. It's only
+        iterated if the union has to be calculated from scratch.
+        """
+        if self._dirty:
+            self.clear()
+            for bounds in all_bounds:
+                self.include(bounds)
+        edges = self._edges
+        if edges is None:
+            return 0, 0, 0, 0
+        x0, y0, x1, y1 = edges
+        return (x0, y0, -x1 - x0, -y1 - y0)
+
+
+def _centre(bounds):
+    """
+    Centre point of a (x, y, width, height) rectangle.
+    """
+    x, y, w, h = bounds
+    return x + w / 2., y + h / 2.
+
+
 # vim:sw=4:et:ai
@@ -0,0 +1,508 @@
+"""
+Packed R-tree
+=============
+
+An R-tree groups nearby rectangles in nodes, each with the bounding
+box of its children. A packed R-tree is built in one go from all
+rectangles, with full nodes. This module uses the Sort-Tile-Recursive
+(STR) algorithm: the rectangles are sorted on x and cut in vertical
+slices, each slice is sorted on y and cut in nodes. The same is done
+for the nodes, until one root node is left.
+
+A packed tree is compact and fast to query, but it can not be changed.
+`PackedRTree` keeps added and moved items in a small overflow buffer,
+which is merged in the packed tree once it gets too large. This makes
+it a good spatial index for diagrams that are mostly browsed, not
+edited.
+
+(Leutenegger, Lopez and Edgington: STR, a simple and efficient
+algorithm for R-tree packing, 1997)
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from builtins import range
+from builtins import object
+__version__ = "$Revision$"
+# $HeadURL$
+
+from math import ceil, sqrt
+from heapq import heappush, heappop
+from itertools import count, islice
+from .geometry import rectangle_contains, rectangle_intersects
+from .geometry import distance_rectangle_point_euclidean
+from .quadtree import _SoftBounds
+
+
+class PackedRTree(object):
+    """
+    Sort-Tile-Recursive packed R-tree. It has the same interface as
+    `quadtree.Quadtree`.
+
+    Rectangles use the same scheme throughout Gaphas: (x, y, width, height).
+
+    >>> rtree = PackedRTree.bulk_load(('%d' % i, ((i * 4) % 90, (i * 10) % 90, 10, 10))
+    ...                               for i in range(20))
+    >>> len(rtree)
+    20
+    >>> sorted(rtree.find_inside((40, 40, 40, 40)))
+    ['13', '14', '15', '16']
+    >>> sorted(rtree.find_intersect((40, 40, 20, 20)))
+    ['12', '13', '14', '15']
+
+    Changes go to the overflow buffer first:
+
+    >>> rtree.add('20', (45, 45, 5, 5))
+    >>> rtree.remove('14')
+    >>> sorted(rtree.find_intersect((40, 40, 20, 20)))
+    ['12', '13', '15', '20']
+    >>> rtree.stats()['buffer']
+    1
+    >>> rtree.pack()
+    >>> rtree.stats()['buffer']
+    0
+    >>> sorted(rtree.find_intersect((40, 40, 20, 20)))
+    ['12', '13', '15', '20']
+    """
+
+    def __init__(self, capacity=16, buffer_size=256):
+        """
+        Create a new, empty, PackedRTree.
+
+        ``capacity`` is the number of children per node. The overflow
+        buffer is merged with the packed tree if it holds more than
+        ``buffer_size`` changes, or more than 1/16th of the items,
+        whichever is larger.
+        """
+        self._capacity = capacity
+        self._buffer_size = buffer_size
+
+        # item -> (bounds, data)
+        self._ids = {}
+        self._root = None
+        # Items in the packed tree that are still up to date
+        self._packed = set()
+        # Items added or moved since the tree was packed: item -> bounds
+        self._buffer = {}
+        # Number of changes since the tree was packed
+        self._changes = 0
+
+        self._soft_bounds = _SoftBounds()
+
+
+    @classmethod
+    def bulk_load(cls, items_with_bounds, capacity=16, buffer_size=256):
+        """
+        Create a packed tree from a sequence of (item, bounds) or
+        (item, bounds, data) tuples.
+        """
+        rtree = cls(capacity, buffer_size)
+        ids = rtree._ids
+        include = rtree._soft_bounds.include
+        for entry in items_with_bounds:
+            ids[entry[0]] = (entry[1], entry[2] if len(entry) > 2 else None)
+            include(entry[1])
+        rtree.pack()
+        return rtree
+
+
+    def _get_bounds(self):
+        root = self._root
+        if root is None:
+            return (0, 0, 0, 0)
+        x0, y0, x1, y1 = root.bbox
+        return (x0, y0, x1 - x0, y1 - y0)
+
+    bounds = property(_get_bounds, doc="Bounds of the packed tree")
+
+
+    def get_soft_bounds(self):
+        """
+        Calculate the size of all items in the tree.
+
+        Returns a tuple (x, y, width, height).
+
+        >>> rtree = PackedRTree()
+        >>> rtree.add('1', (10, 20, 30, 40))
+        >>> rtree.add('2', (20, 30, 40, 10))
+        >>> rtree.soft_bounds
+        (10, 20, 50, 40)
+
+        The soft bounds are kept up to date as items are added and
+        removed, like in a `quadtree.Quadtree`:
+
+        >>> rtree.remove('2')
+        >>> rtree.soft_bounds
+        (10, 20, 30, 40)
+        """
+        return self._soft_bounds.get(b for b, d in self._ids.values())
+
+    soft_bounds = property(get_soft_bounds)
+
+
+    def add(self, item, bounds, data=None):
+        """
+        Add an item to the tree.
+        If an item already exists, its bounds are updated.
+        Data can be used to add some extra info to the item
+        """
+        self._soft_bounds.include(bounds)
+        if item in self._ids:
+            self._soft_bounds.exclude(self._ids[item][0])
+        if item in self._packed:
+            self._packed.discard(item)
+        self._buffer[item] = bounds
+        self._ids[item] = (bounds, data)
+        self._changed()
+
+
+    def remove(self, item):
+        """
+        Remove an item from the tree.
+        """
+        self._soft_bounds.exclude(self._ids.pop(item)[0])
+        self._packed.discard(item)
+        self._buffer.pop(item, None)
+        self._changed()
+
+
+    def _changed(self):
+        """
+        Merge the overflow buffer if there are too many changes.
+        """
+        self._changes += 1
+        if self._changes > max(self._buffer_size, len(self._ids) >> 4):
+            self.pack()
+
+
+    def clear(self):
+        """
+        Remove all items from the tree.
+        """
+        self._ids.clear()
+        self._root = None
+        self._packed.clear()
+        self._buffer.clear()
+        self._changes = 0
+        self._soft_bounds.clear()
+
+
+    def settings(self):
+        """
+        Return the arguments to create an empty tree like this one.
+        """
+        return dict(capacity=self._capacity, buffer_size=self._buffer_size)
+
+
+    def pack(self):
+        """
+        Build the packed tree from all items, emptying the overflow
+        buffer.
+        """
+        entries = [(item, bounds) for item, (bounds, data) in self._ids.items()]
+        self._root = _str_pack(entries, self._capacity)
+        self._packed = set(self._ids)
+        self._buffer.clear()
+        self._changes = 0
+
+    rebuild = pack
+
+
+    def get_bounds(self, item):
+        """
+        Return the bounding box for the given item.
+        """
+        return self._ids[item][0]
+
+
+    def get_data(self, item):
+        """
+        Return the data for the given item, None if no data was provided.
+        """
+        return self._ids[item][1]
+
+
+    def get_clipped_bounds(self, item):
+        """
+        Return the bounding box for the given item. Bounds are not
+        clipped in an R-tree.
+        """
+        return self._ids[item][0]
+
+
+    def _find(self, rect, method):
+        """
+        Find all items in the given rectangle (x, y, with, height).
+        Method can be either the contains or intersects function.
+        """
+        found = set()
+        rx, ry, rw, rh = rect
+        rx1, ry1 = rx + rw, ry + rh
+        packed = self._packed
+        if self._root is not None:
+            stack = [self._root]
+            pop = stack.pop
+            extend = stack.extend
+            while stack:
+                node = pop()
+                x0, y0, x1, y1 = node.bbox
+                if x0 > rx1 or x1 < rx or y0 > ry1 or y1 < ry:
+                    continue
+                if node.leaf:
+                    for item, bounds in node.children:
+                        if item in packed and method(bounds, rect):
+                            found.add(item)
+                else:
+                    extend(node.children)
+        for item, bounds in self._buffer.items():
+            if method(bounds, rect):
+                found.add(item)
+        return found
+
+
+    def find_inside(self, rect):
+        """
+        Find all items in the given rectangle (x, y, with, height).
+        Returns a set.
+        """
+        return self._find(rect, rectangle_contains)
+
+
+    def find_intersect(self, rect):
+        """
+        Find all items that intersect with the given rectangle
+        (x, y, width, height).
+        Returns a set.
+        """
+        return self._find(rect, rectangle_intersects)
+
+
+    def iter_nearest(self, point, max_distance=None, distance=None):
+        """
+        Iterate over the items nearest to ``point`` (x, y), nearest
+        first, as (distance, item) tuples. Nodes and items are visited
+        best-first. See `quadtree.Quadtree.iter_nearest()`.
+
+        >>> rtree = PackedRTree.bulk_load((i, (i * 10, 0, 5, 5)) for i in range(10))
+        >>> rtree.find_nearest((32, 5), k=2)
+        [(0.0, 3), (7.0, 2)]
+        >>> rtree.find_within((32, 5), 7.5)
+        [(0.0, 3), (7.0, 2)]
+        """
+        dist = distance_rectangle_point_euclidean
+        item_kind = _ITEM if distance is None else _BOUNDS
+        seq = count()
+        heap = []
+        for item, bounds in self._buffer.items():
+            heap.append((dist(bounds, point), next(seq), item_kind, item))
+        if self._root is not None:
+            heap.append((_bbox_distance(self._root.bbox, point), next(seq), _NODE, self._root))
+        heap.sort()
+        packed = self._packed
+        while heap:
+            d, _, kind, obj = heappop(heap)
+            if max_distance is not None and d > max_distance:
+                return
+            if kind == _NODE:
+                if obj.leaf:
+                    for item, bounds in obj.children:
+                        if item in packed:
+                            d = dist(bounds, point)
+                            if max_distance is None or d <= max_distance:
+                                heappush(heap, (d, next(seq), item_kind, item))
+                else:
+                    for node in obj.children:
+                        d = _bbox_distance(node.bbox, point)
+                        if max_distance is None or d <= max_distance:
+                            heappush(heap, (d, next(seq), _NODE, node))
+            elif kind == _BOUNDS:
+                d = distance(obj)
+                if d is not None:
+                    heappush(heap, (d, next(seq), _ITEM, obj))
+            else:
+                yield d, obj
+
+
+    def find_nearest(self, point, k=1, max_distance=None, distance=None):
+        """
+        Find the ``k`` items nearest to ``point``. See `iter_nearest()`.
+        Returns a list of (distance, item) tuples.
+        """
+        return list(islice(self.iter_nearest(point, max_distance, distance), k))
+
+
+    def find_within(self, point, radius, distance=None):
+        """
+        Find all items within ``radius`` of ``point``. See
+        `iter_nearest()`. Returns a list of (distance, item) tuples,
+        nearest first.
+        """
+        return list(self.iter_nearest(point, radius, distance))
+
+
+    def stats(self):
+        """
+        Return statistics on the structure of the tree, as a dict:
+
+        - nodes: number of nodes
+        - depth: depth of the leaf nodes (the root is 0)
+        - items: number of items in the packed tree
+        - buffer: number of items in the overflow buffer
+        """
+        nodes = 0
+        depth = -1
+        if self._root is not None:
+            level = [self._root]
+            while level:
+                nodes += len(level)
+                depth += 1
+                if level[0].leaf:
+                    break
+                level = [child for node in level for child in node.children]
+        return dict(nodes=nodes,
+                    depth=depth,
+                    items=len(self._packed),
+                    buffer=len(self._buffer))
+
+
+    def _iter_nodes(self):
+        """
+        Iterate over the nodes of the packed tree, with their depth.
+        """
+        if self._root is not None:
+            stack = [(self._root, 0)]
+            while stack:
+                node, depth = stack.pop()
+                yield node, depth
+                if not node.leaf:
+                    stack.extend((child, depth + 1) for child in reversed(node.children))
+
+
+    def node_bounds(self):
+        """
+        Iterate over the bounds of the nodes of the packed tree, e.g.
+        for debugging.
+
+        >>> rtree = PackedRTree.bulk_load(((i, (i, i, 1, 1)) for i in range(10)), capacity=4)
+        >>> list(rtree.node_bounds())
+        [(0, 0, 10, 10), (0, 0, 4, 4), (4, 4, 4, 4), (8, 8, 2, 2)]
+        """
+        for node, depth in self._iter_nodes():
+            x0, y0, x1, y1 = node.bbox
+            yield (x0, y0, x1 - x0, y1 - y0)
+
+
+    def dump(self):
+        """
+        Print structure to stdout.
+        """
+        for node, depth in self._iter_nodes():
+            indent = '   ' * depth
+            x0, y0, x1, y1 = node.bbox
+            print(indent, node, (x0, y0, x1 - x0, y1 - y0))
+            if node.leaf:
+                for item, bounds in node.children:
+                    if item in self._packed:
+                        print(indent + '   ', item, bounds)
+        if self._buffer:
+            print(' buffer')
+            for item, bounds in self._buffer.items():
+                print('   ', item, bounds)
+
+
+    def __len__(self):
+        """
+        Return number of items in tree.
+        """
+        return len(self._ids)
+
+
+    def __contains__(self, item):
+        """
+        Check if an item is in tree.
+        """
+        return item in self._ids
+
+
+# Heap entries in PackedRTree.iter_nearest()
+_NODE, _BOUNDS, _ITEM = list(range(3))
+
+
+class _Node(object):
+    """
+    A node in a PackedRTree. ``bbox`` is (x0, y0, x1, y1). The children
+    of a leaf node are (item, bounds) tuples.
+    """
+
+    __slots__ = ('bbox', 'children', 'leaf')
+
+    def __init__(self, children, leaf):
+        self.children = children
+        self.leaf = leaf
+        if leaf:
+            boxes = [(x, y, x + w, y + h) for item, (x, y, w, h) in children]
+        else:
+            boxes = [child.bbox for child in children]
+        self.bbox = (min(b[0] for b in boxes), min(b[1] for b in boxes),
+                     max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+
+def _str_pack(entries, capacity):
+    """
+    Pack (item, bounds) tuples in a tree, level by level, and return
+    the root node. None is returned if there are no entries.
+
+    >>> root = _str_pack([(i, (i, i, 1, 1)) for i in range(10)], 4)
+    >>> root.bbox
+    (0, 0, 10, 10)
+    >>> [len(n.children) for n in root.children]
+    [4, 4, 2]
+    """
+    if not entries:
+        return None
+    nodes = _str_level(entries, capacity, _entry_centre, True)
+    while len(nodes) > 1:
+        nodes = _str_level(nodes, capacity, _node_centre, False)
+    return nodes[0]
+
+
+def _str_level(children, capacity, centre, leaf):
+    """
+    Create one level of nodes: sort ``children`` on x, cut them in
+    vertical slices, sort each slice on y and cut it in nodes.
+    """
+    n_nodes = int(ceil(len(children) / capacity))
+    n_slices = int(ceil(sqrt(n_nodes)))
+    slice_size = n_slices * capacity
+    children = sorted(children, key=lambda c: centre(c)[0])
+    nodes = []
+    for i in range(0, len(children), slice_size):
+        s = sorted(children[i:i + slice_size], key=lambda c: centre(c)[1])
+        for j in range(0, len(s), capacity):
+            nodes.append(_Node(s[j:j + capacity], leaf))
+    return nodes
+
+
+def _bbox_distance(bbox, point):
+    """
+    Distance from ``point`` to a (x0, y0, x1, y1) bounding box.
+    """
+    px, py = point
+    x0, y0, x1, y1 = bbox
+    dx = max(x0 - px, 0, px - x1)
+    dy = max(y0 - py, 0, py - y1)
+    return sqrt(dx * dx + dy * dy)
+
+
+def _entry_centre(entry):
+    x, y, w, h = entry[1]
+    return x + w / 2., y + h / 2.
+
+
+def _node_centre(node):
+    x0, y0, x1, y1 = node.bbox
+    return (x0 + x1) / 2., (y0 + y1) / 2.
+
+
+# vim:sw=4:et:ai
@@ -0,0 +1,1140 @@
+"""
+Incremental simplex constraint solver, in the style of Cassowary.
+
+`SimplexSolver` can be used in place of `solver.Solver`:
+
+    canvas = Canvas(solver=SimplexSolver())
+
+The local propagation solver (`solver.Solver`) solves one constraint
+at a time. Simultaneous constraints may make variables juggle back and
+forth. The simplex solver handles all linear constraints at once, as
+a linear program:
+
+- The constraints themselves are required relations.
+- Each variable has a "stay": a preference to keep its current value.
+  The weight of the stay depends on the strength of the variable, so
+  the weakest variables are changed first. Variables with strength
+  REQUIRED are practically never changed.
+- Variables changed from outside the solver (e.g. a dragged handle)
+  become edit variables. Like in Cassowary, edits take precedence
+  over stays.
+- Like `LessThanConstraint` does for local propagation, an edit does
+  not push variables of the same or a higher strength through an
+  inequality: those variables are guarded while the edit lasts. A
+  box handle is stopped at the minimal size of the box, for example,
+  instead of pushing the opposite handle.
+
+Changes are handled incrementally: suggesting a new value for an edit
+variable is solved by the dual simplex method, starting from the
+previous solution.
+
+Not every constraint is linear. Constraints without a linear form
+(see `linear_form()`), or using projected variables, are solved by a
+local propagation solver, after the linear constraints are solved.
+
+The implementation of the simplex tableau follows "The Cassowary
+Linear Arithmetic Constraint Solving Algorithm" by Badros, Borning and
+Stuckey, and the Kiwi solver.
+"""
+
+from __future__ import division
+from __future__ import absolute_import
+
+from builtins import object
+from collections import OrderedDict
+from itertools import count
+
+__version__ = "$Revision$"
+# $HeadURL$
+
+from .state import observed, reversible_pair
+from .solver import Solver, Projection, JuggleError, REQUIRED, EPSILON
+from . import constraint as _constraint
+
+# Relational operators of linear constraints
+EQ, LE, GE = '==', '<=', '>='
+
+# Maximum number of times linear and non-linear constraints are solved
+# in turn during one solve() run, before a JuggleError is raised.
+PASS_LIMIT = 20
+
+# The weight of an edit, relative to the stay of a variable with the
+# same strength.
+EDIT_WEIGHT = 1e4
+
+# The weight of a guard, relative to an edit of a variable with the
+# same strength.
+GUARD_WEIGHT = 10.0
+
+# Weight of the stay of a variable with strength REQUIRED.
+REQUIRED_WEIGHT = 1e9
+
+# Weight of linear constraints that can not be satisfied as required
+# constraint.
+STRONGEST = 1e10
+
+
+def strength_weight(strength):
+    """
+    Map a variable strength to a priority weight. Each step of 10 in
+    strength weighs 10 times more. Required variables are not
+    treated as hard constraints, they get a weight that outweighs
+    any edit.
+
+    >>> from gaphas.solver import WEAK, NORMAL, STRONG, REQUIRED
+    >>> strength_weight(WEAK), strength_weight(NORMAL), strength_weight(STRONG)
+    (10.0, 100.0, 1000.0)
+    >>> strength_weight(REQUIRED)
+    1000000000.0
+    """
+    if strength >= REQUIRED:
+        return REQUIRED_WEIGHT
+    return 10.0 ** (strength / 10.0)
+
+
+def _near_zero(value):
+    return -1e-8 < value < 1e-8
+
+
+class UnsatisfiableError(Exception):
+    """
+    Raised when a required constraint can not be satisfied.
+    """
+
+
+class InternalSolverError(Exception):
+    """
+    Raised when the simplex tableau is in an unexpected state.
+    """
+
+
+# Symbol kinds
+EXTERNAL, SLACK, ERROR, DUMMY = range(4)
+
+
+class Symbol(object):
+    """
+    A symbol (column) in the simplex tableau. Symbols are ordered by
+    creation, to pivot by Bland's rule.
+    """
+
+    __slots__ = ('kind', 'id')
+
+    _ids = count()
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.id = next(Symbol._ids)
+
+
+class Row(object):
+    """
+    A row in the simplex tableau: ``constant + sum(coeff * symbol)``.
+    """
+
+    __slots__ = ('constant', 'cells')
+
+    def __init__(self, constant=0.0, cells=None):
+        self.constant = constant
+        self.cells = dict(cells) if cells else {}
+
+    def copy(self):
+        return Row(self.constant, self.cells)
+
+    def add(self, value):
+        self.constant += value
+        return self.constant
+
+    def insert_symbol(self, symbol, coeff=1.0):
+        cells = self.cells
+        coeff += cells.get(symbol, 0.0)
+        if _near_zero(coeff):
+            cells.pop(symbol, None)
+        else:
+            cells[symbol] = coeff
+
+    def insert_row(self, other, coeff=1.0):
+        self.constant += other.constant * coeff
+        cells = self.cells
+        get = cells.get
+        for symbol, c in other.cells.items():
+            c = get(symbol, 0.0) + c * coeff
+            if -1e-8 < c < 1e-8:
+                cells.pop(symbol, None)
+            else:
+                cells[symbol] = c
+
+    def remove(self, symbol):
+        self.cells.pop(symbol, None)
+
+    def reverse_sign(self):
+        self.constant = -self.constant
+        self.cells = dict((s, -c) for s, c in self.cells.items())
+
+    def solve_for(self, symbol):
+        """
+        Solve the row for ``symbol``. The symbol is removed from the
+        row, the row then represents ``symbol = row``.
+        """
+        coeff = -1.0 / self.cells.pop(symbol)
+        self.constant *= coeff
+        self.cells = dict((s, c * coeff) for s, c in self.cells.items())
+
+    def solve_for_pair(self, lhs, rhs):
+        """
+        Solve the row ``lhs = row`` for ``rhs``.
+        """
+        self.insert_symbol(lhs, -1.0)
+        self.solve_for(rhs)
+
+    def coefficient_for(self, symbol):
+        return self.cells.get(symbol, 0.0)
+
+    def substitute(self, symbol, row):
+        coeff = self.cells.pop(symbol, None)
+        if coeff is not None:
+            self.insert_row(row, coeff)
+
+
+class Tag(object):
+    """
+    Marker and other (error) symbols of a constraint in the tableau.
+    """
+
+    __slots__ = ('marker', 'other', 'weight')
+
+    def __init__(self, weight):
+        self.marker = None
+        self.other = None
+        self.weight = weight
+
+
+class Edit(object):
+    """
+    An edit (or stay) of a variable: a non-required constraint
+    ``variable == constant``.
+    """
+
+    __slots__ = ('variable', 'tag', 'constant')
+
+    def __init__(self, variable, tag, constant):
+        self.variable = variable
+        self.tag = tag
+        self.constant = constant
+
+
+class Relation(object):
+    """
+    A linear relation ``sum(coeff * variable) + constant op 0``, as
+    added to the tableau.
+    """
+
+    __slots__ = ('terms', 'constant', 'op', 'weight', 'tag')
+
+    def __init__(self, terms, constant, op):
+        self.terms = terms
+        self.constant = constant
+        self.op = op
+        self.weight = None
+        self.tag = None
+
+    def add_to(self, tableau):
+        self.tag = tableau.add(self.terms, self.constant, self.op, self.weight)
+
+
+class Tableau(object):
+    """
+    Simplex tableau. Linear constraints are expressed as
+    ``sum(coeff * variable) + constant op 0``, where ``op`` is one of
+    ``EQ``, ``LE`` or ``GE``. Variables can be any object with a
+    ``value`` attribute. They're tracked by identity.
+
+    >>> from gaphas.solver import Variable
+    >>> a, b = Variable(1.0), Variable(2.0)
+    >>> t = Tableau()
+    >>> stay = t.add_edit(a, 1.0)
+    >>> tag = t.add([(a, 1.0), (b, -1.0)], 10.0, EQ)
+    >>> t.value(a), t.value(b)
+    (1.0, 11.0)
+    >>> t.suggest(stay, 5.0)
+    >>> t.value(a), t.value(b)
+    (5.0, 15.0)
+
+    Next to the rows, by basic symbol, the tableau keeps the columns:
+    for each parametric symbol the basic symbols of the rows it
+    occurs in. Pivoting and substitution only visit those rows.
+
+    Adding and removing constraints keeps the tableau feasible, the
+    objective is optimized once the solution is needed. So building
+    a tableau takes one optimization, not one per constraint.
+    """
+
+    def __init__(self):
+        self._rows = {}
+        self._columns = {}
+        self._vars = {}
+        self._objective = Row()
+        self._artificial = None
+        self._infeasible = []
+        self._optimal = True
+
+    def symbol(self, variable):
+        """
+        Return the external symbol for ``variable``.
+        """
+        try:
+            return self._vars[id(variable)][1]
+        except KeyError:
+            symbol = Symbol(EXTERNAL)
+            self._vars[id(variable)] = (variable, symbol)
+            return symbol
+
+    def value(self, variable):
+        """
+        Return the value of ``variable`` in the current solution.
+        """
+        self.optimize()
+        try:
+            row = self._rows.get(self._vars[id(variable)][1])
+        except KeyError:
+            return variable.value
+        return row.constant if row is not None else 0.0
+
+    def values(self):
+        """
+        Iterate (variable, value) for all variables in the tableau.
+        """
+        self.optimize()
+        rows = self._rows
+        for variable, symbol in list(self._vars.values()):
+            row = rows.get(symbol)
+            yield variable, row.constant if row is not None else 0.0
+
+    def forget(self, variable):
+        """
+        Forget about ``variable``. It should no longer be referenced
+        by any constraint.
+        """
+        entry = self._vars.pop(id(variable), None)
+        if entry is not None and entry[1] in self._rows:
+            self._pop_row(entry[1])
+
+    def add(self, terms, constant, op, weight=None):
+        """
+        Add constraint ``sum(coeff * variable) + constant op 0``.
+        ``terms`` is a sequence of (variable, coeff). If no weight is
+        given the constraint is required.
+
+        Returns a tag, to be used to remove the constraint.
+
+        An `UnsatisfiableError` is raised if a required constraint can
+        not be satisfied. The tableau should be built anew in that
+        case.
+        """
+        tag = Tag(weight)
+        row = self._create_row(terms, constant, op, tag)
+        subject = self._choose_subject(row, tag)
+
+        if subject is None and all(s.kind == DUMMY for s in row.cells):
+            if not _near_zero(row.constant):
+                self._remove_effects(tag)
+                raise UnsatisfiableError('Constraint can not be satisfied')
+            subject = tag.marker
+
+        if subject is None:
+            if not self._add_with_artificial_variable(row):
+                self._remove_effects(tag)
+                raise UnsatisfiableError('Constraint can not be satisfied')
+        else:
+            row.solve_for(subject)
+            self._substitute(subject, row)
+            self._put_row(subject, row)
+
+        self._optimal = False
+        return tag
+
+    def remove(self, tag):
+        """
+        Remove the constraint identified by ``tag``.
+        """
+        self._remove_effects(tag)
+        marker = tag.marker
+        if marker in self._rows:
+            self._pop_row(marker)
+        else:
+            leaving = self._marker_leaving_symbol(marker)
+            if leaving is None:
+                raise InternalSolverError('Failed to find leaving row')
+            row = self._pop_row(leaving)
+            row.solve_for_pair(leaving, marker)
+            self._substitute(marker, row)
+        self._optimal = False
+
+    def optimize(self):
+        """
+        Optimize the objective, if constraints have been added or
+        removed since the last optimization.
+        """
+        if not self._optimal:
+            self._optimize(self._objective)
+            self._optimal = True
+
+    def add_edit(self, variable, weight, constant=None):
+        """
+        Add an edit for ``variable``, keeping it at ``constant`` (its
+        current value by default) with the given weight.
+        """
+        if constant is None:
+            constant = variable.value
+        tag = self.add([(variable, 1.0)], -constant, EQ, weight)
+        return Edit(variable, tag, constant)
+
+    def remove_edit(self, edit):
+        self.remove(edit.tag)
+
+    def suggest(self, edit, value):
+        """
+        Suggest a new value for an edit variable. The tableau is
+        updated with the dual simplex method.
+        """
+        self.optimize()
+        delta = value - edit.constant
+        if _near_zero(delta):
+            return
+        edit.constant = value
+        rows = self._rows
+        infeasible = self._infeasible
+        marker, other = edit.tag.marker, edit.tag.other
+
+        row = rows.get(marker)
+        if row is not None:
+            if row.add(-delta) < 0.0:
+                infeasible.append(marker)
+        else:
+            row = rows.get(other)
+            if row is not None:
+                if row.add(delta) < 0.0:
+                    infeasible.append(other)
+            else:
+                for symbol in self._columns.get(marker, ()):
+                    row = rows[symbol]
+                    if row.add(delta * row.cells[marker]) < 0.0 \
+                            and symbol.kind != EXTERNAL:
+                        infeasible.append(symbol)
+        self._dual_optimize()
+
+    def reset_stay(self, edit, value):
+        """
+        Let a stay (an edit nobody is editing) follow the current
+        value of its variable. The error symbols of the stay are set
+        to zero, no pivoting is needed.
+        """
+        rows = self._rows
+        for marker in (edit.tag.marker, edit.tag.other):
+            row = rows.get(marker)
+            if row is not None:
+                row.constant = 0.0
+        edit.constant = value
+
+    def _create_row(self, terms, constant, op, tag):
+        rows = self._rows
+        objective = self._objective
+        row = Row(constant)
+        for variable, coeff in terms:
+            if _near_zero(coeff):
+                continue
+            symbol = self.symbol(variable)
+            other = rows.get(symbol)
+            if other is not None:
+                row.insert_row(other, coeff)
+            else:
+                row.insert_symbol(symbol, coeff)
+
+        weight = tag.weight
+        if op in (LE, GE):
+            coeff = 1.0 if op == LE else -1.0
+            slack = tag.marker = Symbol(SLACK)
+            row.insert_symbol(slack, coeff)
+            if weight is not None:
+                error = tag.other = Symbol(ERROR)
+                row.insert_symbol(error, -coeff)
+                objective.insert_symbol(error, weight)
+        elif weight is not None:
+            errplus = tag.marker = Symbol(ERROR)
+            errminus = tag.other = Symbol(ERROR)
+            row.insert_symbol(errplus, -1.0)
+            row.insert_symbol(errminus, 1.0)
+            objective.insert_symbol(errplus, weight)
+            objective.insert_symbol(errminus, weight)
+        else:
+            dummy = tag.marker = Symbol(DUMMY)
+            row.insert_symbol(dummy)
+
+        if row.constant < 0.0:
+            row.reverse_sign()
+        return row
+
+    def _choose_subject(self, row, tag):
+        for symbol in row.cells:
+            if symbol.kind == EXTERNAL:
+                return symbol
+        for symbol in (tag.marker, tag.other):
+            if symbol is not None and symbol.kind in (SLACK, ERROR) \
+                    and row.coefficient_for(symbol) < 0.0:
+                return symbol
+        return None
+
+    def _add_with_artificial_variable(self, row):
+        rows = self._rows
+        art = Symbol(SLACK)
+        self._put_row(art, row.copy())
+        self._artificial = row.copy()
+        self._optimize(self._artificial)
+        success = _near_zero(self._artificial.constant)
+        self._artificial = None
+
+        if art in rows:
+            row = self._pop_row(art)
+            if not row.cells:
+                return success
+            entering = self._any_pivotable_symbol(row)
+            if entering is None:
+                return False
+            row.solve_for_pair(art, entering)
+            self._substitute(entering, row)
+            self._put_row(entering, row)
+
+        for symbol in self._columns.pop(art, ()):
+            rows[symbol].remove(art)
+        self._objective.remove(art)
+        return success
+
+    def _remove_effects(self, tag):
+        objective = self._objective
+        rows = self._rows
+        if tag.weight is None:
+            return
+        for marker in (tag.marker, tag.other):
+            if marker is not None and marker.kind == ERROR:
+                row = rows.get(marker)
+                if row is not None:
+                    objective.insert_row(row, -tag.weight)
+                else:
+                    objective.insert_symbol(marker, -tag.weight)
+
+    def _put_row(self, basic, row):
+        """
+        Add ``row`` to the tableau, as the row of symbol ``basic``.
+        """
+        self._rows[basic] = row
+        columns = self._columns
+        for symbol in row.cells:
+            try:
+                columns[symbol][basic] = None
+            except KeyError:
+                columns[symbol] = {basic: None}
+
+    def _pop_row(self, basic):
+        """
+        Remove the row of symbol ``basic`` from the tableau, and
+        return it.
+        """
+        row = self._rows.pop(basic)
+        columns = self._columns
+        for symbol in row.cells:
+            column = columns[symbol]
+            del column[basic]
+            if not column:
+                del columns[symbol]
+        return row
+
+    def _substitute(self, symbol, row):
+        """
+        Substitute ``symbol`` by ``row`` in the rows that contain
+        ``symbol``, the objective and the artificial objective.
+        """
+        rows = self._rows
+        columns = self._columns
+        infeasible = self._infeasible
+        cells = row.cells
+        for s in columns.pop(symbol, ()):
+            r = rows[s]
+            rcells = r.cells
+            coeff = rcells.pop(symbol)
+            r.constant += row.constant * coeff
+            get = rcells.get
+            for other, c in cells.items():
+                c = get(other, 0.0) + c * coeff
+                if -1e-8 < c < 1e-8:
+                    if rcells.pop(other, None) is not None:
+                        column = columns[other]
+                        del column[s]
+                        if not column:
+                            del columns[other]
+                else:
+                    if other not in rcells:
+                        try:
+                            columns[other][s] = None
+                        except KeyError:
+                            columns[other] = {s: None}
+                    rcells[other] = c
+            if s.kind != EXTERNAL and r.constant < 0.0:
+                infeasible.append(s)
+        self._objective.substitute(symbol, row)
+        if self._artificial is not None:
+            self._artificial.substitute(symbol, row)
+
+    def _optimize(self, objective):
+        rows = self._rows
+        while True:
+            # Bland's rule: the lowest symbol enters (and leaves), so
+            # the simplex method does not cycle.
+            entering = None
+            for symbol, coeff in objective.cells.items():
+                if coeff < 0.0 and symbol.kind != DUMMY \
+                        and (entering is None or symbol.id < entering.id):
+                    entering = symbol
+            if entering is None:
+                return
+
+            leaving = None
+            ratio = float('inf')
+            for symbol in self._columns.get(entering, ()):
+                if symbol.kind != EXTERNAL:
+                    row = rows[symbol]
+                    coeff = row.cells[entering]
+                    if coeff < 0.0:
+                        r = -row.constant / coeff
+                        if r < ratio or (r == ratio and symbol.id < leaving.id):
+                            ratio = r
+                            leaving = symbol
+            if leaving is None:
+                raise InternalSolverError('The objective is unbounded')
+
+            row = self._pop_row(leaving)
+            row.solve_for_pair(leaving, entering)
+            self._substitute(entering, row)
+            self._put_row(entering, row)
+
+    def _dual_optimize(self):
+        rows = self._rows
+        infeasible = self._infeasible
+        objective = self._objective
+        while infeasible:
+            leaving = infeasible.pop()
+            row = rows.get(leaving)
+            if row is None or row.constant >= 0.0:
+                continue
+            entering = None
+            ratio = float('inf')
+            for symbol, coeff in row.cells.items():
+                if coeff > 0.0 and symbol.kind != DUMMY:
+                    r = objective.coefficient_for(symbol) / coeff
+                    if r < ratio or (r == ratio and symbol.id < entering.id):
+                        ratio = r
+                        entering = symbol
+            if entering is None:
+                raise InternalSolverError('Dual optimize failed')
+            self._pop_row(leaving)
+            row.solve_for_pair(leaving, entering)
+            self._substitute(entering, row)
+            self._put_row(entering, row)
+
+    def _any_pivotable_symbol(self, row):
+        for symbol in row.cells:
+            if symbol.kind in (SLACK, ERROR):
+                return symbol
+        return None
+
+    def _marker_leaving_symbol(self, marker):
+        rows = self._rows
+        r1 = r2 = float('inf')
+        first = second = third = None
+        for symbol in self._columns.get(marker, ()):
+            row = rows[symbol]
+            coeff = row.cells[marker]
+            if symbol.kind == EXTERNAL:
+                third = symbol
+            elif coeff < 0.0:
+                r = -row.constant / coeff
+                if r < r1:
+                    r1 = r
+                    first = symbol
+            else:
+                r = row.constant / coeff
+                if r < r2:
+                    r2 = r
+                    second = symbol
+        return first or second or third
+
+
+def _value(v):
+    return getattr(v, 'value', v)
+
+
+def _variable_terms(*terms):
+    """
+    Split (variable or number, coeff) terms in variable terms and a
+    constant.
+    """
+    variables, constant = [], 0.0
+    for v, coeff in terms:
+        if hasattr(v, 'strength'):
+            variables.append((v, coeff))
+        else:
+            constant += v * coeff
+    return variables, constant
+
+
+def _equals(c):
+    return [_variable_terms((c.a, 1.0), (c.delta, 1.0), (c.b, -1.0)) + (EQ,)]
+
+def _less_than(c):
+    return [_variable_terms((c.smaller, 1.0), (c.delta, 1.0), (c.bigger, -1.0)) + (LE,)]
+
+def _center(c):
+    return [_variable_terms((c.a, 1.0), (c.b, 1.0), (c.center, -2.0)) + (EQ,)]
+
+def _balance(c):
+    b1, b2 = c.band
+    return [_variable_terms((b1, 1.0 - c.balance), (b2, c.balance), (c.v, -1.0)) + (EQ,)]
+
+def _line(c):
+    (sx, sy), (ex, ey) = c._line
+    px, py = c._point
+    return [_variable_terms((sx, 1.0 - c.ratio_x), (ex, c.ratio_x), (px, -1.0)) + (EQ,),
+            _variable_terms((sy, 1.0 - c.ratio_y), (ey, c.ratio_y), (py, -1.0)) + (EQ,)]
+
+def _position(c):
+    return [_variable_terms((c._origin[0], 1.0), (c._point[0], -1.0)) + (EQ,),
+            _variable_terms((c._origin[1], 1.0), (c._point[1], -1.0)) + (EQ,)]
+
+
+# Linear forms of the constraint classes. Subclasses may solve in a
+# different way, hence they're solved by local propagation.
+_linear_forms = {
+    _constraint.EqualsConstraint: _equals,
+    _constraint.LessThanConstraint: _less_than,
+    _constraint.CenterConstraint: _center,
+    _constraint.BalanceConstraint: _balance,
+    _constraint.LineConstraint: _line,
+    _constraint.PositionConstraint: _position,
+}
+
+
+def linear_form(constraint):
+    """
+    Return the linear form of ``constraint``, as a list of
+    ``(terms, constant, op)`` tuples, or None if the constraint has no
+    linear form. Constraints with projected variables have no linear
+    form.
+
+    >>> from gaphas.solver import Variable
+    >>> from gaphas.constraint import EqualsConstraint
+    >>> a, b = Variable(1.0), Variable(2.0)
+    >>> linear_form(EqualsConstraint(a, b, 3))
+    [([(Variable(1, 20), 1.0), (Variable(2, 20), -1.0)], 3.0, '==')]
+    """
+    form = _linear_forms.get(type(constraint))
+    if form is None:
+        return None
+    for v in constraint.variables():
+        if isinstance(v, Projection):
+            return None
+    return form(constraint)
+
+
+class SimplexSolver(object):
+    """
+    Solve constraints with the simplex method. The interface is the
+    same as `solver.Solver`'s.
+
+    >>> from gaphas.solver import Variable, WEAK
+    >>> from gaphas.constraint import EqualsConstraint, LessThanConstraint
+    >>> a, b, c = Variable(1.0), Variable(2.0, WEAK), Variable(3.0, WEAK)
+    >>> s = SimplexSolver()
+    >>> eq = s.add_constraint(EqualsConstraint(a, b))
+    >>> lt = s.add_constraint(LessThanConstraint(smaller=b, bigger=c, delta=5))
+    >>> s.solve()
+    >>> a, b, c
+    (Variable(1, 20), Variable(1, 10), Variable(6, 10))
+
+    Simultaneous constraints are solved in one go:
+
+    >>> a.value = 10
+    >>> s.solve()
+    >>> a, b, c
+    (Variable(10, 20), Variable(10, 10), Variable(15, 10))
+    """
+
+    def __init__(self):
+        self._constraints = set()
+        self._tableau = Tableau()
+        self._relations = {}
+        # Non-linear constraints are solved by local propagation
+        self._propagation = Solver()
+
+        # Stays and edits, by variable id
+        self._stays = {}
+        self._edits = OrderedDict()
+        self._pinned = {}
+
+        # Inequality relations, by variable id
+        self._limits = {}
+        # Guards, by id of the guarded variable, and the guarded
+        # variable ids by edit variable id
+        self._guards = {}
+        self._guarded = {}
+
+        # Variables changed outside the solver, by id
+        self._dirty = OrderedDict()
+        self._changed = False
+        self._writing = False
+        self._restore = None
+
+    constraints = property(lambda s: s._constraints)
+
+    _marked_cons = property(lambda s: list(s._propagation._marked_cons) + list(s._dirty.values()),
+                            doc="Marked constraints and dirty variables")
+
+    def _load(self):
+        """
+        Add the constraints of a unpickled solver.
+        """
+        constraints, self._restore = self._restore, None
+        for c in constraints:
+            self.add_constraint(c)
+
+    def __getstate__(self):
+        return {'_constraints': list(self._restore or self._constraints)}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self._restore = state['_constraints']
+
+
+    @observed
+    def add_constraint(self, constraint):
+        """
+        Add a constraint. The actual constraint is returned, so the
+        constraint can be removed later on.
+        """
+        if self._restore:
+            self._load()
+        assert constraint, 'No constraint (%s)' % (constraint,)
+        self._constraints.add(constraint)
+        form = linear_form(constraint)
+        if form is None:
+            self._propagation.add_constraint(constraint)
+            for v in constraint.variables():
+                while isinstance(v, Projection):
+                    v = v.variable()
+                v._solver = self
+            return constraint
+
+        relations = []
+        variables = []
+        for terms, constant, op in form:
+            for v, coeff in terms:
+                self._add_stay(v)
+                variables.append(v)
+            relation = Relation(terms, constant, op)
+            try:
+                relation.add_to(self._tableau)
+            except UnsatisfiableError:
+                # Add it as a very strong, but not required, relation
+                relation.weight = STRONGEST
+                self._rebuild(relations)
+                relation.add_to(self._tableau)
+            relations.append(relation)
+            if op != EQ:
+                for v, coeff in terms:
+                    self._limits.setdefault(id(v), []).append(relation)
+        self._relations[constraint] = relations, variables
+        self._changed = True
+        return constraint
+
+
+    @observed
+    def remove_constraint(self, constraint):
+        """
+        Remove a constraint from the solver.
+        """
+        if self._restore:
+            self._load()
+        self._constraints.discard(constraint)
+        try:
+            relations, variables = self._relations.pop(constraint)
+        except KeyError:
+            self._propagation.remove_constraint(constraint)
+            return
+
+        tableau = self._tableau
+        limits = self._limits
+        for relation in relations:
+            tableau.remove(relation.tag)
+            if relation.op != EQ:
+                for v, coeff in relation.terms:
+                    limits[id(v)].remove(relation)
+                    if not limits[id(v)]:
+                        del limits[id(v)]
+        for v in variables:
+            self._remove_stay(v)
+        self._changed = True
+
+    reversible_pair(add_constraint, remove_constraint)
+
+
+    def _rebuild(self, relations=()):
+        """
+        Build a new tableau, with the current stays, edits and
+        relations, after a constraint turned out to be unsatisfiable.
+        """
+        tableau = self._tableau = Tableau()
+        for stay in self._stays.values():
+            edit = stay[0]
+            stay[0] = tableau.add_edit(edit.variable, edit.tag.weight, edit.constant)
+        for rels, variables in self._relations.values():
+            for relation in rels:
+                relation.add_to(tableau)
+        for relation in relations:
+            relation.add_to(tableau)
+        edits = self._edits
+        for key, edit in list(edits.items()):
+            edits[key] = tableau.add_edit(edit.variable, edit.tag.weight, edit.constant)
+        for guard in self._guards.values():
+            edit = guard[0]
+            guard[0] = tableau.add_edit(edit.variable, edit.tag.weight, edit.constant)
+
+
+    def _add_stay(self, variable):
+        stay = self._stays.get(id(variable))
+        if stay is None:
+            edit = self._tableau.add_edit(variable, strength_weight(variable.strength))
+            stay = self._stays[id(variable)] = [edit, 0]
+            variable._solver = self
+        stay[1] += 1
+
+    def _remove_stay(self, variable):
+        key = id(variable)
+        stay = self._stays.get(key)
+        if stay is None:
+            return
+        stay[1] -= 1
+        if stay[1] == 0:
+            del self._stays[key]
+            edit = self._edits.pop(key, None)
+            if edit is not None:
+                self._tableau.remove_edit(edit)
+                self._remove_guards(key)
+            self._remove_guard(key)
+            self._pinned.pop(key, None)
+            self._dirty.pop(key, None)
+            self._tableau.remove_edit(stay[0])
+            self._tableau.forget(variable)
+
+
+    def request_resolve(self, variable, projections_only=False):
+        """
+        Mark a variable as changed. It's solved the next time the
+        constraints are resolved.
+        """
+        if self._restore:
+            self._load()
+        self._propagation.request_resolve(variable, projections_only)
+        if projections_only or self._writing:
+            return
+        while isinstance(variable, Projection):
+            variable = variable.variable()
+        if id(variable) in self._stays:
+            self._dirty[id(variable)] = variable
+
+
+    def suspend(self):
+        """
+        Suspend marking constraints, see `solver.Solver.suspend()`.
+        Linear constraints are not marked anyway: changed variables
+        are picked up by the next solve() call.
+        """
+        self._propagation.suspend()
+
+
+    def resume(self):
+        """
+        Resume marking constraints after `suspend()`.
+        """
+        self._propagation.resume()
+
+
+    def request_resolve_constraint(self, c):
+        """
+        Request resolving a constraint.
+        """
+        if c in self._relations:
+            for v in c.variables():
+                self.request_resolve(v)
+        else:
+            self._propagation.request_resolve_constraint(c)
+
+
+    def constraints_with_variable(self, *variables):
+        """
+        Return an iterator of constraints that work with variables.
+        """
+        for c in list(self._constraints):
+            peeled = []
+            for v in c.variables():
+                while isinstance(v, Projection):
+                    v = v.variable()
+                peeled.append(v)
+            for v in variables:
+                while isinstance(v, Projection):
+                    v = v.variable()
+                if not any(v is p for p in peeled):
+                    break
+            else:
+                yield c
+
+
+    def create_plan(self, *variables):
+        """
+        Make ``variables`` edit variables until the plan is discarded,
+        e.g. while a handle is dragged.
+        """
+        plan = []
+        for v in variables:
+            while isinstance(v, Projection):
+                v = v.variable()
+            key = id(v)
+            if key in self._stays:
+                self._pinned[key] = self._pinned.get(key, 0) + 1
+                plan.append(v)
+        return plan
+
+    def discard_plan(self, plan=None):
+        """
+        Release the edit variables of ``plan``.
+        """
+        pinned = self._pinned
+        for v in plan or ():
+            key = id(v)
+            n = pinned.get(key, 0) - 1
+            if n > 0:
+                pinned[key] = n
+            else:
+                pinned.pop(key, None)
+
+
+    def _edit(self, variable):
+        """
+        Suggest the current value of ``variable`` to the tableau.
+        """
+        key = id(variable)
+        edit = self._edits.get(key)
+        if edit is None:
+            self._remove_guard(key)
+            # Start editing from the last solution, so the new value
+            # is solved incrementally
+            edit = self._edits[key] = self._tableau.add_edit(variable,
+                    strength_weight(variable.strength) * EDIT_WEIGHT,
+                    self._stays[key][0].constant)
+            self._add_guards(variable)
+        self._tableau.suggest(edit, variable.value)
+        return edit
+
+    def _add_guards(self, variable):
+        """
+        Guard the variables that share an inequality with edit
+        variable ``variable``, and are at least as strong.
+        """
+        key = id(variable)
+        guards = self._guards
+        edits = self._edits
+        guarded = []
+        for relation in self._limits.get(key, ()):
+            for v, coeff in relation.terms:
+                vkey = id(v)
+                if vkey == key or vkey in edits or v.strength < variable.strength:
+                    continue
+                guard = guards.get(vkey)
+                if guard is None:
+                    guard = guards[vkey] = [self._tableau.add_edit(v,
+                            strength_weight(v.strength) * EDIT_WEIGHT * GUARD_WEIGHT,
+                            self._stays[vkey][0].constant), 0]
+                guard[1] += 1
+                guarded.append(vkey)
+        if guarded:
+            self._guarded[key] = guarded
+
+    def _remove_guards(self, key):
+        """
+        Release the guards of the edit of variable ``key``.
+        """
+        guards = self._guards
+        for vkey in self._guarded.pop(key, ()):
+            guard = guards.get(vkey)
+            if guard is not None:
+                guard[1] -= 1
+                if guard[1] == 0:
+                    self._remove_guard(vkey)
+
+    def _remove_guard(self, key):
+        """
+        Remove the guard on variable ``key``, if any.
+        """
+        guard = self._guards.pop(key, None)
+        if guard is not None:
+            self._tableau.remove_edit(guard[0])
+
+    def _update_variables(self):
+        """
+        Assign the solution to the variables, and let the stays
+        follow.
+        """
+        tableau = self._tableau
+        stays = self._stays
+        self._writing = True
+        try:
+            for v, value in tableau.values():
+                if abs(v.value - value) > EPSILON:
+                    v.value = value
+                stay = stays.get(id(v))
+                if stay is not None:
+                    tableau.reset_stay(stay[0], value)
+        finally:
+            self._writing = False
+
+    def solve(self):
+        """
+        Solve the linear constraints, then the non-linear constraints.
+        This is repeated until all constraints are satisfied.
+        """
+        if self._restore:
+            self._load()
+        tableau = self._tableau
+        edits = self._edits
+        dirty = self._dirty
+
+        # Edits of variables that are no longer changed are removed.
+        # The stays keep those variables in place.
+        pinned = self._pinned
+        for key in [k for k in edits if k not in dirty and k not in pinned]:
+            tableau.remove_edit(edits.pop(key))
+            self._remove_guards(key)
+
+        propagation = self._propagation
+        passes = 0
+        while self._dirty or self._changed or propagation._dirty_components:
+            passes += 1
+            if passes > PASS_LIMIT:
+                raise JuggleError('Linear and non-linear constraints do not converge')
+            if self._dirty or self._changed:
+                dirty, self._dirty = self._dirty, OrderedDict()
+                for v in dirty.values():
+                    self._edit(v)
+                self._changed = False
+                self._update_variables()
+            propagation.solve()
+
+
+# vim:sw=4:et:ai
@@ -32,18 +32,44 @@ Having weakest variable (`constraint.Constraint.weakest()` method)
 every constraint is being asked to solve itself
 (`constraint.Constraint.solve_for()` method) changing appropriate
 variables to make the constraint valid again.
+
+Constraints that share variables form a connected component. The
+solver keeps track of those components while constraints are added
+and removed. Only components containing dirty constraints are solved,
+one after another.
+
+In batch mode (``Solver(batch=True)``) the dirty constraints of a
+component are solved in passes. A pass takes constraints from the
+head of the queue as long as they share no variables. Constraints of
+the same class in a pass are solved in one go by
+`constraint.Constraint.solve_batch()`.
+
+Instrumentation
+---------------
+An instrumented solver (`Solver.instrument()`) collects `SolveStats`
+for every solve() call: the number of constraints solved, the time
+spent per constraint class, the constraints that were marked more
+than once and the longest chain of propagated constraints. Without
+instrumentation, the solver does not keep track of any of this.
 """
 
 from __future__ import division
 from __future__ import absolute_import
 
 from builtins import object
+from array import array
+from collections import OrderedDict, namedtuple
+from timeit import default_timer
 
 __version__ = "$Revision$"
 # $HeadURL$
 
 from .state import observed, reversible_pair, reversible_property
 
+# Maximum number of times a constraint may be marked dirty during one
+# solve() run, before a JuggleError is raised.
+JUGGLE_LIMIT = 100
+
 # epsilon for float comparison
 # is simple abs(x - y) > EPSILON enough for canvas needs?
 EPSILON = 1e-6
@@ -57,23 +83,15 @@ VERY_STRONG = 40
 REQUIRED = 100
 
 
-class Variable(object):
+class BaseVariable(object):
     """
-    Representation of a variable in the constraint solver.
-    Each Variable has a @value and a @strength. Ina constraint the
-    weakest variables are changed.
-
-    You can even do some calculating with it. The Variable always
-    represents a float variable.
+    Behaviour shared by `Variable` and `StoredVariable`. Subclasses
+    provide the ``_value`` and ``_strength`` attributes.
     """
 
-    def __init__(self, value=0.0, strength=NORMAL):
-        self._value = float(value)
-        self._strength = strength
-
-        # These variables are set by the Solver:
-        self._solver = None
-        self._constraints = set()
+    # These are set by the Solver. The set of constraints is created
+    # once the variable is used in a constraint.
+    __slots__ = ('_solver', '_constraints')
 
     def __hash__(self):
         return hash((self._value, self._strength))
@@ -316,6 +334,165 @@ class Variable(object):
         return self._value.__rtruediv__(other)
 
 
+class Variable(BaseVariable):
+    """
+    Representation of a variable in the constraint solver.
+    Each Variable has a @value and a @strength. Ina constraint the
+    weakest variables are changed.
+
+    You can even do some calculating with it. The Variable always
+    represents a float variable.
+    """
+
+    __slots__ = ('_value', '_strength')
+
+    def __init__(self, value=0.0, strength=NORMAL):
+        self._value = float(value)
+        self._strength = strength
+        self._solver = None
+        self._constraints = ()
+
+    def __getstate__(self):
+        return self._value, self._strength, self._solver, self._constraints
+
+    def __setstate__(self, state):
+        self._value, self._strength, self._solver, self._constraints = state
+
+
+class StoredVariable(BaseVariable):
+    """
+    A variable that keeps its value and strength in a `VariableStore`.
+    It behaves like a normal `Variable`, but only holds a reference to
+    the store and an index into it.
+
+    >>> store = VariableStore()
+    >>> v = StoredVariable(store, 3.0)
+    >>> v, v.index
+    (Variable(3, 20), 0)
+    >>> v.value = 4
+    >>> store.values[v.index]
+    4.0
+    """
+
+    __slots__ = ('_store', '_index')
+
+    def __init__(self, store, value=0.0, strength=NORMAL):
+        self._store = store
+        self._index = store.allocate(value, strength)
+        self._solver = None
+        self._constraints = ()
+
+    def _get_stored_value(self):
+        return self._store.values[self._index]
+
+    def _set_stored_value(self, value):
+        self._store.values[self._index] = value
+
+    _value = property(_get_stored_value, _set_stored_value)
+
+    def _get_stored_strength(self):
+        return self._store.strengths[self._index]
+
+    def _set_stored_strength(self, strength):
+        self._store.strengths[self._index] = strength
+
+    _strength = property(_get_stored_strength, _set_stored_strength)
+
+    store = property(lambda s: s._store)
+
+    index = property(lambda s: s._index)
+
+    def __getstate__(self):
+        return self._store, self._index, self._solver, self._constraints
+
+    def __setstate__(self, state):
+        self._store, self._index, self._solver, self._constraints = state
+
+
+class VariableStore(object):
+    """
+    Contiguous storage for the values and strengths of variables.
+    Values are kept in an ``array('d')``, strengths in an
+    ``array('i')``. Variables created by the store
+    (`StoredVariable`) are thin indexes into those arrays.
+
+    Constraints can read and write the values of many variables at
+    once, e.g. with NumPy (see `numpy_values()`). The store does not
+    save memory: each variable is still an object, holding an index
+    into the store.
+
+    >>> store = VariableStore()
+    >>> a, b = store.variable(1.0), store.variable(2.0, WEAK)
+    >>> a, b
+    (Variable(1, 20), Variable(2, 10))
+    >>> len(store)
+    2
+    >>> store.get_values(store.indexes((b, a)))
+    array('d', [2.0, 1.0])
+    >>> store.set_values((a, b), (5.0, 6.0))
+    >>> a, b
+    (Variable(5, 20), Variable(6, 10))
+
+    Handles and items can be created with a store, to keep their
+    positions in it (see `connector.Position`).
+    """
+
+    def __init__(self):
+        self.values = array('d')
+        self.strengths = array('i')
+
+    def __len__(self):
+        return len(self.values)
+
+    def allocate(self, value, strength):
+        """
+        Allocate a slot for a variable. Returns the index.
+        """
+        self.values.append(value)
+        self.strengths.append(strength)
+        return len(self.values) - 1
+
+    def variable(self, value=0.0, strength=NORMAL):
+        """
+        Create a new variable, stored in this store.
+        """
+        return StoredVariable(self, value, strength)
+
+    def indexes(self, variables):
+        """
+        Return the indexes of ``variables`` in the store.
+        """
+        for v in variables:
+            assert v._store is self, 'Variable %s is not stored in %s' % (v, self)
+        return array('l', [v._index for v in variables])
+
+    def get_values(self, indexes):
+        """
+        Return the values at ``indexes``.
+        """
+        values = self.values
+        return array('d', [values[i] for i in indexes])
+
+    def set_values(self, variables, values):
+        """
+        Assign new values to ``variables``. Only variables that
+        actually change are updated (and marked dirty), like a normal
+        value assignment does.
+        """
+        for v, value in zip(variables, values):
+            if abs(v._value - value) > EPSILON:
+                v.value = value
+
+    def numpy_values(self):
+        """
+        Return a NumPy array sharing memory with the values. Be aware
+        that no variables can be added to the store while the NumPy
+        array is alive.
+        """
+        import numpy
+        return numpy.frombuffer(self.values, dtype=numpy.float64)
+
+
 class Projection(object):
     """
     Projections are used to convert values from one space to another,
@@ -378,14 +555,86 @@ class Solver(object):
     variables.
     """
 
-    def __init__(self):
+    def __init__(self, batch=False):
         # a dict of constraint -> name/variable mappings
         self._constraints = set()
-        self._marked_cons = []
         self._solving = False
 
+        # Solve constraints in batches, see _solve_batches()
+        self.batch = batch
+        self._batch_vars = {}
+
+        # Constraints sharing variables are grouped in components.
+        # Components with marked constraints are solved in order.
+        self._components = {}
+        self._dirty_components = OrderedDict()
+        self._unregistered = ConstraintComponent()
+        self._component_stats = []
+
+        # Solve plan, used while dragging
+        self._plan = None
+        self._replay = None
+
+        # Bulk editing, see suspend()
+        self._suspended = 0
+        self._deferred_variables = OrderedDict()
+        self._deferred_marks = OrderedDict()
+
+        # Instrumentation, see instrument()
+        self._instrumented = False
+        self._stats_callback = None
+        self._stats = None
+
     constraints = property(lambda s: s._constraints)
 
+    _marked_cons = property(lambda s: [c for comp in s._dirty_components for c in comp.marked],
+                            doc="All marked constraints, grouped by component")
+
+    component_stats = property(lambda s: list(s._component_stats),
+                               doc="`ComponentStats` for each component solved by the last solve() call")
+
+    stats = property(lambda s: s._stats,
+                     doc="`SolveStats` of the last solve() call, if the solver is instrumented")
+
+
+    def instrument(self, callback=None, enabled=True):
+        """
+        Collect `SolveStats` while solving. The statistics of the last
+        solve() call are available as `stats`. If ``callback`` is
+        provided, it's called with the `SolveStats` after each solve()
+        call that had something to do, e.g. to export the figures.
+
+        While instrumented, dirty constraints are solved one by one,
+        also if the solver is in batch mode, so the time spent can be
+        attributed to constraint classes.
+
+        >>> from gaphas.constraint import EqualsConstraint
+        >>> a, b, c = Variable(1.0), Variable(2.0), Variable(3.0)
+        >>> s = Solver()
+        >>> eq_a_b = s.add_constraint(EqualsConstraint(a, b))
+        >>> eq_b_c = s.add_constraint(EqualsConstraint(b, c))
+        >>> s.instrument()
+        >>> s.solve()
+        >>> s.stats.solved, s.stats.counts
+        (5, {<class 'gaphas.constraint.EqualsConstraint'>: 5})
+
+        Solving a constraint marks the constraints of the variable it
+        changed, including itself:
+
+        >>> a.value = 4
+        >>> s.solve()
+        >>> s.stats.solved, s.stats.longest_chain
+        (4, 3)
+
+        Instrumentation is turned off with ``enabled=False``:
+
+        >>> s.instrument(enabled=False)
+        >>> s.stats
+        """
+        self._instrumented = enabled
+        self._stats_callback = callback if enabled else None
+        self._stats = None
+
 
     def request_resolve(self, variable, projections_only=False):
         """
@@ -406,7 +655,7 @@ class Solver(object):
         EquationConstraint(<lambda>, a=Variable(1, 20), b=Variable(2, 20))
         >>> c_eq._weakest
         [Variable(1, 20), Variable(2, 20)]
-        >>> s._marked_cons
+        >>> list(s._marked_cons)
         [EquationConstraint(<lambda>, a=Variable(1, 20), b=Variable(2, 20))]
         >>> a.value=5.0
         >>> c_eq.weakest()
@@ -418,21 +667,106 @@ class Solver(object):
         >>> c_eq.weakest()
         Variable(2, 20)
         """
+        if self._suspended:
+            self._defer_resolve(variable, projections_only)
+            return
         # Peel of Projections:
         while isinstance(variable, Projection):
             variable = variable.variable()
         for c in variable._constraints:
             if not projections_only or c._solver_has_projections:
-                if not self._solving:
-                    if c in self._marked_cons:
-                        self._marked_cons.remove(c)
-                    c.mark_dirty(variable)
-                    self._marked_cons.append(c)
-                else:
-                    c.mark_dirty(variable)
-                    self._marked_cons.append(c)
-                    if self._marked_cons.count(c) > 100:
-                        raise JuggleError('Variable juggling detected, constraint %s resolved %d times out of %d' % (c, self._marked_cons.count(c), len(self._marked_cons)))
+                c.mark_dirty(variable)
+                self._mark(c)
+
+
+    def suspend(self):
+        """
+        Suspend marking constraints, e.g. while loading a diagram.
+        Variables that change and constraints that are added are
+        remembered, and are marked, once, by `resume()`. Calls can be
+        nested.
+
+        >>> from gaphas.constraint import EqualsConstraint
+        >>> a, b = Variable(1.0), Variable(2.0)
+        >>> s = Solver()
+        >>> s.suspend()
+        >>> eq = s.add_constraint(EqualsConstraint(a, b))
+        >>> a.value = 3
+        >>> a.value = 4
+        >>> s._marked_cons
+        []
+        >>> s.resume()
+        >>> s._marked_cons == [eq]
+        True
+        >>> s.solve()
+        >>> a, b
+        (Variable(4, 20), Variable(4, 20))
+        """
+        self._suspended += 1
+
+
+    def resume(self):
+        """
+        Resume marking constraints after `suspend()`. The deferred
+        variables and constraints are marked.
+        """
+        assert self._suspended > 0, 'Solver is not suspended'
+        self._suspended -= 1
+        if self._suspended:
+            return
+        variables, self._deferred_variables = self._deferred_variables, OrderedDict()
+        marks, self._deferred_marks = self._deferred_marks, OrderedDict()
+        for variable, projections_only in variables.values():
+            self.request_resolve(variable, projections_only)
+        for c in marks:
+            self._mark(c)
+
+
+    def _defer_resolve(self, variable, projections_only=False):
+        """
+        Remember variable ``variable`` for `resume()`.
+        """
+        while isinstance(variable, Projection):
+            variable = variable.variable()
+        deferred = self._deferred_variables
+        key = id(variable)
+        previous = deferred.pop(key, None)
+        if previous is not None:
+            projections_only = projections_only and previous[1]
+        deferred[key] = (variable, projections_only)
+
+
+    def _defer_mark(self, c):
+        """
+        Remember constraint ``c`` for `resume()`.
+        """
+        deferred = self._deferred_marks
+        deferred.pop(c, None)
+        deferred[c] = None
+
+
+    def _mark(self, c):
+        """
+        Put constraint ``c`` at the end of the queue of marked
+        constraints of its component. While solving, the number of
+        times a constraint is marked is checked for variable juggling.
+        """
+        if self._suspended:
+            self._defer_mark(c)
+            return
+        replay = self._replay
+        if replay is not None and replay.defer(c):
+            return
+        comp = self._components.get(c, self._unregistered)
+        marked = comp.marked
+        if not self._solving:
+            marked.add(c)
+        else:
+            n = marked.append(c)
+            if n > JUGGLE_LIMIT:
+                raise JuggleError('Variable juggling detected, constraint %s resolved %d times out of %d' % (c, n, marked.marked))
+        if comp not in self._dirty_components:
+            self._dirty_components[comp] = None
 
 
     @observed
@@ -459,15 +793,40 @@ class Solver(object):
         1
         """
         assert constraint, 'No constraint (%s)' % (constraint,)
+        self.discard_plan()
+        components = self._components
         self._constraints.add(constraint)
-        self._marked_cons.append(constraint)
         constraint._solver_has_projections = False
+        neighbours = []
         for v in constraint.variables():
             while isinstance(v, Projection):
                 v = v.variable()
                 constraint._solver_has_projections = True
-            v._constraints.add(constraint)
+            # All constraints sharing a variable are in one component,
+            # so one of them is enough to find it.
+            cons = v._constraints
+            for c in cons:
+                comp = components.get(c)
+                if comp is not None:
+                    if comp not in neighbours:
+                        neighbours.append(comp)
+                    break
+            if not cons:
+                cons = v._constraints = set()
+            cons.add(constraint)
             v._solver = self
+
+        if neighbours:
+            comp = max(neighbours, key=len)
+            for other in neighbours:
+                if other is not comp:
+                    self._merge(comp, other)
+        else:
+            comp = ConstraintComponent()
+        comp.constraints.add(constraint)
+        components[constraint] = comp
+
+        self._mark(constraint)
         return constraint
 
     @observed
@@ -482,7 +841,7 @@ class Solver(object):
         >>> c
         EquationConstraint(<lambda>, a=Variable(0, 20), b=Variable(2, 20))
         >>> s.remove_constraint(c)
-        >>> s._marked_cons
+        >>> list(s._marked_cons)
         []
         >>> s._constraints
         set()
@@ -492,22 +851,195 @@ class Solver(object):
         >>> s.remove_constraint(c)
         """
         assert constraint, 'No constraint (%s)' % (constraint,)
+        self.discard_plan()
         for v in constraint.variables():
             while isinstance(v, Projection):
                 v = v.variable()
-            v._constraints.discard(constraint)
+            if v._constraints:
+                v._constraints.discard(constraint)
         self._constraints.discard(constraint)
-        while constraint in self._marked_cons:
-            self._marked_cons.remove(constraint)
+
+        comp = self._components.pop(constraint, None)
+        if comp is not None:
+            comp.constraints.discard(constraint)
+            comp.marked.discard(constraint)
+            # The component may fall apart, it's split before it's
+            # solved again.
+            comp.stale = True
+            if not comp.marked:
+                self._dirty_components.pop(comp, None)
+        self._unregistered.marked.discard(constraint)
+        self._batch_vars.pop(constraint, None)
+        self._deferred_marks.pop(constraint, None)
 
     reversible_pair(add_constraint, remove_constraint)
 
 
+    def _merge(self, comp, other):
+        """
+        Move all constraints from component ``other`` to ``comp``.
+        """
+        components = self._components
+        for c in other.constraints:
+            components[c] = comp
+        comp.constraints.update(other.constraints)
+        comp.stale = comp.stale or other.stale
+        if other.marked:
+            comp.marked.merge(other.marked)
+            del self._dirty_components[other]
+            if comp not in self._dirty_components:
+                self._dirty_components[comp] = None
+
+
+    def _split(self, comp):
+        """
+        Split a stale component in its connected parts. The marked
+        constraints are distributed over the new components, keeping
+        their order.
+        """
+        components = self._components
+        dirty_components = self._dirty_components
+        remaining = set(comp.constraints)
+        parts = []
+        while remaining:
+            part = ConstraintComponent()
+            todo = [remaining.pop()]
+            while todo:
+                c = todo.pop()
+                part.constraints.add(c)
+                components[c] = part
+                for v in c.variables():
+                    while isinstance(v, Projection):
+                        v = v.variable()
+                    found = remaining.intersection(v._constraints)
+                    if found:
+                        remaining.difference_update(found)
+                        todo.extend(found)
+            parts.append(part)
+
+        comp.stale = False
+        if len(parts) == 1:
+            # Still in one piece
+            for c in comp.constraints:
+                components[c] = comp
+            return
+
+        dirty_components.pop(comp, None)
+        for c in comp.marked:
+            part = components[c]
+            part.marked.merge_one(comp.marked, c)
+            if part not in dirty_components:
+                dirty_components[part] = None
+        comp.constraints.clear()
+        comp.marked.clear()
+
+
+    def get_components(self):
+        """
+        Return the connected components of the constraint graph, as a
+        list of sets of constraints. Constraints are in the same
+        component if they share a variable, directly or through other
+        constraints.
+
+        >>> from gaphas.constraint import EqualsConstraint
+        >>> s = Solver()
+        >>> a, b, c, d = Variable(), Variable(), Variable(), Variable()
+        >>> eq_a_b = s.add_constraint(EqualsConstraint(a, b))
+        >>> eq_c_d = s.add_constraint(EqualsConstraint(c, d))
+        >>> len(s.get_components())
+        2
+        >>> eq_b_c = s.add_constraint(EqualsConstraint(b, c))
+        >>> len(s.get_components())
+        1
+        >>> s.remove_constraint(eq_b_c)
+        >>> sorted(len(comp) for comp in s.get_components())
+        [1, 1]
+        """
+        for comp in set(self._components.values()):
+            if comp.stale:
+                self._split(comp)
+        comps = set(self._components.values())
+        return [set(comp.constraints) for comp in comps]
+
+
+    def create_plan(self, *variables):
+        """
+        Create a solve plan for changes to ``variables``. The plan is
+        used by `solve()` until it's discarded or constraints are added
+        to or removed from the solver.
+
+        A solve plan is meant for dragging: the same variables change
+        over and over again. The plan starts out with the constraints
+        of the variables. Each time the solver has to solve other
+        constraints, those are appended to the plan. Once it's
+        complete, marked constraints are solved in the order of the
+        plan, without the queueing overhead.
+
+        If a plan is already in use, it's extended with the constraints
+        of ``variables`` and returned.
+
+        >>> from gaphas.constraint import EqualsConstraint
+        >>> s = Solver()
+        >>> a, b, c = Variable(1.0), Variable(2.0), Variable(3.0)
+        >>> eq_a_b = s.add_constraint(EqualsConstraint(a, b))
+        >>> eq_b_c = s.add_constraint(EqualsConstraint(b, c))
+        >>> s.solve()
+        >>> plan = s.create_plan(a)
+        >>> plan.constraints == [eq_a_b]
+        True
+        >>> a.value = 4
+        >>> s.solve()
+        >>> plan.constraints == [eq_a_b, eq_b_c]
+        True
+        >>> a.value = 5
+        >>> s.solve()
+        >>> b.value, c.value, plan.replays
+        (5.0, 5.0, 2)
+
+        The plan is discarded when a constraint is added or removed:
+
+        >>> s.remove_constraint(eq_b_c)
+        >>> plan.valid
+        False
+        """
+        plan = self._plan
+        if plan is None:
+            plan = self._plan = SolvePlan()
+        plan.users += 1
+        constraints = self._constraints
+        for v in variables:
+            while isinstance(v, Projection):
+                v = v.variable()
+            for c in v._constraints:
+                if c in constraints:
+                    plan.append(c)
+        return plan
+
+
+    def discard_plan(self, plan=None):
+        """
+        Stop using a solve plan. If ``plan`` is provided and other
+        users still use the plan, the plan is kept. Without ``plan``
+        the current plan is discarded right away.
+        """
+        current = self._plan
+        if current is None:
+            return
+        if plan is not None:
+            if plan is not current:
+                return
+            plan.users -= 1
+            if plan.users > 0:
+                return
+        current.valid = False
+        self._plan = None
+
+
     def request_resolve_constraint(self, c):
         """
         Request resolving a constraint.
         """
-        self._marked_cons.append(c)
+        self._mark(c)
 
 
     def constraints_with_variable(self, *variables):
@@ -555,30 +1087,44 @@ class Solver(object):
         False
         >>> eq_pr_a_b in s.constraints_with_variable(a, d)
         False
+
+        Projections can be queried as well:
+
+        >>> pr_a = Projection(a)
+        >>> eq_pr_a_c = s.add_constraint(EquationConstraint(lambda a, b: a -b, a=Projection(pr_a), b=c))
+        >>> list(s.constraints_with_variable(pr_a)) == [eq_pr_a_c]
+        True
+        >>> eq_pr_a_c in s.constraints_with_variable(a, c)
+        True
+
+        Variables are compared by identity, also when a variable is
+        reached through a chain of projections. Each variable keeps the
+        set of constraints it takes part in (see `add_constraint()`),
+        so only the smallest of those sets has to be checked.
         """
+        if not variables:
+            buckets = [self._constraints]
+        else:
+            buckets = []
+            for v in variables:
+                while isinstance(v, Projection):
+                    v = v.variable()
+                buckets.append(v._constraints)
+
         # Use a copy of the original set, so constraints may be
         # deleted in the meantime.
-        variables = set(variables)
-        for c in set(self._constraints):
-            if variables.issubset(set(c.variables())):
+        constraints = self._constraints
+        for c in list(min(buckets, key=len)):
+            if c not in constraints:
+                continue
+            for v in variables:
+                if isinstance(v, Projection):
+                    if not _has_variable(c, v):
+                        break
+                elif c not in v._constraints:
+                    break
+            else:
                 yield c
-            elif c._solver_has_projections:
-                found = True
-                for v in c.variables():
-                    if v in variables:
-                        continue
-                    while isinstance(v, Projection):
-                        v = v.variable()
-                        if v in variables:
-                            break
-                    else:
-                        found = False
-                    if not found:
-                        break # quit for loop, variable not in constraint
-                else:
-                    # All iteration have completed succesfully,
-                    # so all variables are in the constraint
-                    yield c
 
 
     def solve(self):
@@ -612,23 +1158,524 @@ class Solver(object):
         >>> c._value
         10.0
         """
-        marked_cons = self._marked_cons
+        dirty_components = self._dirty_components
+        plan = self._plan
+        stats = []
+        # Only collected by an instrumented solver, if there's work
+        solve_stats = trace = None
+        if self._instrumented and dirty_components:
+            solve_stats = SolveStats()
+            start = default_timer()
         try:
             self._solving = True
 
-            # Solve each constraint. Using a counter makes it
-            # possible to also solve constraints that are marked as
-            # a result of other variabled being solved.
-            n = 0
-            while n < len(marked_cons):
-                c = marked_cons[n]
-                if not c.disabled:
-                    c.solve()
-                n += 1
-
-            self._marked_cons = []
+            if plan is not None and dirty_components:
+                replayed = self._replay_plan(plan)
+                if solve_stats is not None:
+                    solve_stats.replayed = replayed
+
+            if self.batch:
+                self._solve_batches(plan, stats, solve_stats)
+
+            # Only components with marked constraints are solved.
+            # Constraints that are marked as a result of other
+            # variables being solved are put at the end of the queue
+            # of their component, so they are solved in the same run.
+            while dirty_components:
+                comp = next(iter(dirty_components))
+                if comp.stale:
+                    self._split(comp)
+                    continue
+
+                if solve_stats is not None:
+                    # Keep track of the constraints marked by the
+                    # constraint being solved, see _Trace.defer()
+                    trace = self._replay = _Trace()
+                marked = comp.marked
+                solved = 0
+                try:
+                    while marked:
+                        c = marked.pop()
+                        if trace is not None:
+                            trace.current = trace.depth.pop(c, 1)
+                        if not c.disabled:
+                            if plan is not None:
+                                plan.append(c)
+                            if solve_stats is None:
+                                c.solve()
+                            else:
+                                solve_stats.solve(c)
+                            solved += 1
+                finally:
+                    # Also record what happened up to a JuggleError
+                    if solve_stats is not None:
+                        solve_stats.component_solved(marked, solved, trace)
+                        self._replay = None
+
+                stats.append(ComponentStats(len(comp), solved, marked.marked))
+                marked.clear()
+                # Constraints of this component may be marked when
+                # another component is solved.
+                dirty_components.pop(comp, None)
         finally:
             self._solving = False
+            self._replay = None
+            self._component_stats = stats
+            if solve_stats is not None:
+                solve_stats.components = stats
+                solve_stats.time = default_timer() - start
+                self._stats = solve_stats
+
+        callback = self._stats_callback
+        if callback is not None and solve_stats is not None:
+            callback(solve_stats)
+
+
+    def _solve_batches(self, plan, stats, solve_stats=None):
+        """
+        Solve the dirty components in passes. A pass consists of the
+        constraints at the head of the queue of each component, as
+        long as they do not share variables. Since they're
+        independent, the outcome is the same as solving them one by
+        one. Constraints marked while solving a pass are solved in a
+        later pass.
+
+        If ``solve_stats`` is provided, it is updated like `solve()`
+        does, except for the longest chain.
+
+        >>> from gaphas.constraint import EqualsConstraint
+        >>> a, b, c = Variable(1.0), Variable(2.0), Variable(3.0)
+        >>> s = Solver(batch=True)
+        >>> eq1 = s.add_constraint(EqualsConstraint(a, b))
+        >>> eq2 = s.add_constraint(EqualsConstraint(b, c))
+        >>> s.solve()
+        >>> a, b, c
+        (Variable(3, 20), Variable(3, 20), Variable(3, 20))
+        """
+        dirty_components = self._dirty_components
+        batch_vars = self._batch_vars
+        solved = {}
+        while dirty_components:
+            for comp in [comp for comp in dirty_components if comp.stale]:
+                self._split(comp)
+
+            groups = OrderedDict()
+            for comp in dirty_components:
+                queue = comp.marked._queue
+                seen = set()
+                n = 0
+                while queue:
+                    c = next(iter(queue))
+                    ids = batch_vars.get(c)
+                    if ids is None:
+                        ids = batch_vars[c] = _variable_ids(c)
+                    if not seen.isdisjoint(ids):
+                        break
+                    seen.update(ids)
+                    del queue[c]
+                    if not c.disabled:
+                        if plan is not None:
+                            plan.append(c)
+                        groups.setdefault(type(c), []).append(c)
+                        n += 1
+                solved[comp] = solved.get(comp, 0) + n
+
+            for cls, constraints in groups.items():
+                if solve_stats is not None:
+                    t = default_timer()
+                solve_batch = getattr(cls, 'solve_batch', None)
+                if solve_batch and len(constraints) > 1:
+                    solve_batch(constraints)
+                else:
+                    for c in constraints:
+                        c.solve()
+                if solve_stats is not None:
+                    solve_stats.count(cls, len(constraints), default_timer() - t)
+
+            for comp in [comp for comp in dirty_components if not comp.marked]:
+                marked = comp.marked
+                if solve_stats is not None:
+                    solve_stats.component_solved(marked, solved.get(comp, 0))
+                stats.append(ComponentStats(len(comp), solved.pop(comp, 0), marked.marked))
+                marked.clear()
+                del dirty_components[comp]
+
+
+    def _replay_plan(self, plan):
+        """
+        Solve the marked constraints that are part of ``plan`` in the
+        order of the plan. Constraints marked while replaying are
+        solved further on in the plan, if possible. Other marked
+        constraints are left for the regular solver.
+
+        Returns the number of constraints solved.
+        """
+        replay = self._replay = _Replay(plan)
+        pending = replay.pending
+        for comp in list(self._dirty_components):
+            marked = comp.marked
+            for c in list(marked):
+                if c in plan:
+                    pending.add(c)
+                    marked.discard(c)
+            if not marked:
+                del self._dirty_components[comp]
+
+        solved = 0
+        if pending:
+            plan.replays += 1
+            for c in plan.constraints:
+                if c in pending:
+                    pending.discard(c)
+                    replay.current = c
+                    if not c.disabled:
+                        c.solve()
+                        solved += 1
+                replay.index += 1
+        self._replay = None
+        return solved
+
+
+ComponentStats = namedtuple('ComponentStats', 'constraints solved marked')
+
+
+class SolveStats(object):
+    """
+    Statistics of one solve() call of an instrumented solver:
+
+    time
+        Time spent solving, in seconds.
+    solved
+        Number of constraints solved, excluding the ones solved by
+        replaying a solve plan.
+    replayed
+        Number of constraints solved by replaying a solve plan.
+    times, counts
+        Time spent and number of constraints solved, per constraint
+        class.
+    remarked
+        Constraints marked more than once, with the number of times
+        they have been marked. Those are candidates for variable
+        juggling.
+    longest_chain
+        Length of the longest chain of constraints, each one marked by
+        solving the previous one. Not kept track of in batch mode.
+    components
+        `ComponentStats` for each component solved.
+    """
+
+    def __init__(self):
+        self.time = 0.0
+        self.solved = 0
+        self.replayed = 0
+        self.times = {}
+        self.counts = {}
+        self.remarked = {}
+        self.longest_chain = 0
+        self.components = []
+
+    def solve(self, c):
+        """
+        Solve constraint ``c``, keeping track of the time spent.
+        """
+        t = default_timer()
+        c.solve()
+        self.count(type(c), 1, default_timer() - t)
+
+    def count(self, cls, n, t):
+        """
+        Count ``n`` constraints of class ``cls`` solved in ``t`` seconds.
+        """
+        times, counts = self.times, self.counts
+        times[cls] = times.get(cls, 0.0) + t
+        counts[cls] = counts.get(cls, 0) + n
+
+    def component_solved(self, marked, solved, trace=None):
+        """
+        Record the outcome of solving a component: ``solved``
+        constraints were solved from the queue ``marked``. ``trace``
+        is the `_Trace` of the propagation, if any.
+        """
+        self.solved += solved
+        if trace is not None and trace.longest > self.longest_chain:
+            self.longest_chain = trace.longest
+        remarked = self.remarked
+        for c, n in marked._counts.items():
+            if n > 1:
+                remarked[c] = max(n, remarked.get(c, 0))
+
+    def as_dict(self):
+        """
+        Return the statistics as a dictionary of plain values, with
+        constraint classes by name. Useful for exporting.
+
+        >>> from gaphas.constraint import EqualsConstraint
+        >>> stats = SolveStats()
+        >>> stats.counts[EqualsConstraint] = 2
+        >>> sorted(stats.as_dict().items()) # doctest: +NORMALIZE_WHITESPACE
+        [('components', 0), ('counts', {'EqualsConstraint': 2}),
+         ('longest_chain', 0), ('remarked', 0), ('replayed', 0),
+         ('solved', 0), ('time', 0.0), ('times', {})]
+        """
+        return {
+            'time': self.time,
+            'solved': self.solved,
+            'replayed': self.replayed,
+            'times': dict((cls.__name__, t) for cls, t in self.times.items()),
+            'counts': dict((cls.__name__, n) for cls, n in self.counts.items()),
+            'remarked': len(self.remarked),
+            'longest_chain': self.longest_chain,
+            'components': len(self.components),
+        }
+
+    def __repr__(self):
+        return '<SolveStats solved=%d time=%.6f longest_chain=%d remarked=%d>' % (
+            self.solved, self.time, self.longest_chain, len(self.remarked))
+
+
+class SolvePlan(object):
+    """
+    An ordered list of constraints, used to solve the constraints
+    affected by a drag operation without rediscovering the
+    propagation order on every motion event. See
+    `Solver.create_plan()`.
+    """
+
+    def __init__(self):
+        self.constraints = []
+        self._index = {}
+        self.users = 0
+        self.replays = 0
+        self.valid = True
+
+    def append(self, c):
+        """
+        Append a constraint to the plan, if it's not in the plan yet.
+        """
+        if c not in self._index:
+            self._index[c] = len(self.constraints)
+            self.constraints.append(c)
+
+    def __contains__(self, c):
+        return c in self._index
+
+    def __len__(self):
+        return len(self.constraints)
+
+
+class _Replay(object):
+    """
+    State of a plan being replayed.
+    """
+
+    def __init__(self, plan):
+        self.plan = plan
+        self.pending = set()
+        self.index = 0
+        self.current = None
+
+    def defer(self, c):
+        """
+        Check if marked constraint ``c`` is solved later on in the
+        plan. Marks by the constraint being solved are dropped: it
+        has just been solved.
+        """
+        if c is self.current:
+            return True
+        index = self.plan._index.get(c, -1)
+        if index > self.index:
+            self.pending.add(c)
+            return True
+        return False
+
+
+class _Trace(object):
+    """
+    Used in place of a `_Replay` by the instrumented solver, to keep
+    track of the propagation depth of marked constraints. A
+    constraint marked while solving a constraint at depth ``current``
+    ends up at depth ``current + 1``.
+    """
+
+    def __init__(self):
+        self.depth = {}
+        self.current = 1
+        self.longest = 1
+
+    def defer(self, c):
+        d = self.depth[c] = self.current + 1
+        if d > self.longest:
+            self.longest = d
+        return False
+
+
+class ConstraintComponent(object):
+    """
+    A set of constraints connected to each other through shared
+    variables, along with the queue of its marked constraints.
+
+    A component is flagged ``stale`` when a constraint is removed
+    from it: it may have fallen apart and should be split before it
+    is solved.
+    """
+
+    def __init__(self):
+        self.constraints = set()
+        self.marked = ConstraintQueue()
+        self.stale = False
+
+    def __len__(self):
+        return len(self.constraints)
+
+
+def _variable_ids(constraint):
+    """
+    Return the identities of the (projected) variables of
+    ``constraint``.
+    """
+    ids = []
+    for v in constraint.variables():
+        while isinstance(v, Projection):
+            v = v.variable()
+        ids.append(id(v))
+    return ids
+
+
+def _has_variable(constraint, variable):
+    """
+    Check if ``variable`` is used by ``constraint``, either directly or
+    through a chain of projections.
+    """
+    for v in constraint.variables():
+        while True:
+            if v is variable:
+                return True
+            if not isinstance(v, Projection):
+                break
+            v = v.variable()
+    return False
+
+
+class ConstraintQueue(object):
+    """
+    Queue of constraints marked for solving. A constraint is in the
+    queue at most once: marking a queued constraint again moves it to
+    the end of the queue. The queue keeps track of the number of times
+    each constraint has been marked, so variable juggling can be
+    detected.
+
+    >>> q = ConstraintQueue()
+    >>> q.add('a')
+    1
+    >>> q.add('b')
+    1
+    >>> q.add('a')
+    1
+    >>> list(q)
+    ['b', 'a']
+    >>> q.append('b')
+    2
+    >>> list(q), q.marked
+    (['a', 'b'], 3)
+    >>> q.pop()
+    'a'
+    >>> 'a' in q, 'b' in q, len(q)
+    (False, True, 1)
+    >>> q.count('a')
+    1
+    >>> q.clear()
+    >>> q.count('b'), q.marked
+    (0, 0)
+    """
+
+    def __init__(self):
+        self._queue = OrderedDict()
+        self._counts = {}
+        self.marked = 0
+
+    def add(self, c):
+        """
+        Queue constraint ``c``. If ``c`` is already queued it is
+        moved to the end of the queue, but not counted again.
+
+        Returns the number of times ``c`` has been marked.
+        """
+        queue = self._queue
+        if c in queue:
+            queue.move_to_end(c)
+            return self._counts[c]
+        return self.append(c)
+
+    def append(self, c):
+        """
+        Queue constraint ``c`` at the end of the queue and count it as
+        marked once more.
+
+        Returns the number of times ``c`` has been marked.
+        """
+        queue = self._queue
+        if c in queue:
+            queue.move_to_end(c)
+        else:
+            queue[c] = None
+        n = self._counts[c] = self._counts.get(c, 0) + 1
+        self.marked += 1
+        return n
+
+    def merge(self, other):
+        """
+        Append the constraints queued in ``other``, keeping their mark
+        counts.
+        """
+        for c in other:
+            self.merge_one(other, c)
+
+    def merge_one(self, other, c):
+        """
+        Append constraint ``c`` from queue ``other``, keeping its mark
+        count.
+        """
+        n = other.count(c)
+        self._queue[c] = None
+        self._counts[c] = self._counts.get(c, 0) + n
+        self.marked += n
+
+    def pop(self):
+        """
+        Remove and return the first constraint in the queue.
+        """
+        return self._queue.popitem(last=False)[0]
+
+    def discard(self, c):
+        """
+        Remove constraint ``c`` from the queue, if present.
+        """
+        self._queue.pop(c, None)
+        self._counts.pop(c, None)
+
+    def count(self, c):
+        """
+        Return the number of times constraint ``c`` has been marked
+        since the queue was last cleared.
+        """
+        return self._counts.get(c, 0)
+
+    def clear(self):
+        """
+        Empty the queue and reset the counters.
+        """
+        self._queue.clear()
+        self._counts.clear()
+        self.marked = 0
+
+    def __len__(self):
+        return len(self._queue)
+
+    def __iter__(self):
+        return iter(self._queue)
+
+    def __contains__(self, c):
+        return c in self._queue
 
 
 class solvable(object):
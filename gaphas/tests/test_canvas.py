@@ -1,8 +1,11 @@
+from __future__ import print_function
+
 import unittest
 
-from gaphas.canvas import Canvas, ConnectionError
+from gaphas import state
+from gaphas.canvas import Canvas, ConnectionError, UpdateProfiler, UpdateStats
 from gaphas.examples import Box
-from gaphas.item import Line, Handle
+from gaphas.item import Item, Line, Handle
 from gaphas.constraint import BalanceConstraint, EqualsConstraint
 import cairo
 
@@ -31,6 +34,94 @@ class MatricesTestCase(unittest.TestCase):
         c.add(b2, b1)
         c.reparent(b2, None)
 
+    def test_update_deep_matrices(self):
+        """Test matrices are updated down a hierarchy"""
+        c = Canvas()
+        boxes = [Box() for i in range(5)]
+        parent = None
+        for b in boxes:
+            b.matrix.translate(1, 2)
+            c.add(b, parent)
+            parent = b
+
+        boxes[1].matrix.translate(10, 0)
+        updated = c.update_matrices([boxes[1], boxes[3]])
+        self.assertEqual(set(boxes[1:]), updated)
+        self.assertEqual(cairo.Matrix(1, 0, 0, 1, 15, 10), boxes[-1]._matrix_i2c)
+
+
+    def test_matrix_versions(self):
+        """Test matrices are only recalculated if something changed"""
+        c = Canvas()
+        b1, b2, b3 = Box(), Box(), Box()
+        b1.matrix.rotate(0.5)
+        b2.matrix.scale(2, 3)
+        b3.matrix.translate(4, 5)
+        c.add(b1)
+        c.add(b2, b1)
+        c.add(b3, b2)
+        c.update_matrices([b1])
+        expected = cairo.Matrix(*b3.matrix).multiply(
+                       cairo.Matrix(*b2.matrix).multiply(cairo.Matrix(*b1.matrix)))
+        for actual, value in zip(b3._matrix_i2c, expected):
+            self.assertAlmostEqual(value, actual)
+
+        versions = [b._matrix_i2c_version for b in (b1, b2, b3)]
+        c2i = b3._matrix_c2i
+        self.assertEqual(set([b1, b2, b3]), c.update_matrices([b1]))
+        self.assertEqual(versions, [b._matrix_i2c_version for b in (b1, b2, b3)])
+        self.assertTrue(c2i is b3._matrix_c2i)
+
+        b2.matrix.translate(1, 1)
+        c.update_matrices([b2])
+        self.assertEqual(versions[0], b1._matrix_i2c_version)
+        self.assertNotEqual(versions[1], b2._matrix_i2c_version)
+        self.assertNotEqual(versions[2], b3._matrix_i2c_version)
+
+
+class DirtyItemsTestCase(unittest.TestCase):
+
+    def test_ancestors_marked(self):
+        """Test ancestors of an item are updated along with the item"""
+        c = Canvas()
+        b1, b2, b3, b4 = Box(), Box(), Box(), Box()
+        c.add(b1)
+        c.add(b2, b1)
+        c.add(b3, b2)
+        c.add(b4)
+        c.update_now()
+
+        c.request_update(b3)
+        self.assertEqual(set([b1, b2, b3]), c._dirty_items)
+
+        c.reparent(b3, b4)
+        self.assertEqual(set([b1, b2, b3, b4]), c._dirty_items)
+        c.update_now()
+        self.assertEqual(set(), c._dirty_items)
+
+    def test_update_order(self):
+        """Test dirty items are updated bottom to top"""
+        updated = []
+
+        class UpdateItem(Item):
+            def pre_update(self, context):
+                updated.append(self)
+
+        c = Canvas()
+        i1, i2, i3, i4, i5 = [UpdateItem() for i in range(5)]
+        c.add(i1)
+        c.add(i2, i1)
+        c.add(i3, i1)
+        c.add(i4)
+        c.add(i5)
+        c.update_now()
+        del updated[:]
+
+        c.request_update(i2)
+        c.request_update(i5)
+        c.update_now()
+        self.assertEqual([i5, i2, i1], updated)
+
 # fixme: what about multiple constraints for a handle?
 #        what about 1d projection?
 
@@ -154,6 +245,28 @@ class CanvasTestCase(unittest.TestCase):
         self.assertEqual(2, len(c.solver.constraints))
 
 
+    def test_get_connection_follows_table(self):
+        b1 = Box()
+        l = Line()
+        c = Canvas()
+        c.add(b1)
+        c.add(l)
+        h0, h1 = l.handles()
+
+        c.connect_item(l, h0, b1, b1.ports()[0])
+        assert c.get_connection(h0) == next(c.get_connections(handle=h0))
+        self.assertEqual([h0, None], [cinfo and cinfo.handle
+                for cinfo in c.get_connections_for_handles((h0, h1))])
+
+        cons = EqualsConstraint(h0.pos.x, h0.pos.x)
+        c.reconnect_item(l, h0, cons)
+        assert c.get_connection(h0).constraint is cons
+
+        c.remove(b1)
+        assert c.get_connection(h0) is None
+        self.assertEqual([None, None], c.get_connections_for_handles((h0, h1)))
+
+
 class ConstraintProjectionTestCase(unittest.TestCase):
 
     def test_line_projection(self):
@@ -352,4 +465,302 @@ class CanvasConstraintTestCase(unittest.TestCase):
 ###        self.assertTrue(eq1 in canvas.canvas_constraints(l1))
 ###        self.assertTrue(eq2 in canvas.canvas_constraints(l1))
 
+class BatchTestCase(unittest.TestCase):
+
+    def test_batch(self):
+        """Test updates are postponed until the end of a batch"""
+        canvas = Canvas()
+        updates = []
+        canvas.update = lambda: updates.append(True)
+        views = []
+        class View(object):
+            def request_update(self, items, matrix_only_items, removed_items):
+                views.append((set(items), set(removed_items)))
+        canvas.register_view(View())
+
+        b1, b2, l = Box(), Box(), Line()
+        with canvas.batch():
+            canvas.add(b1)
+            canvas.add(b2)
+            canvas.add(l)
+            with canvas.batch():
+                connect(canvas, l, l.handles()[0], b1)
+            connect(canvas, l, l.handles()[-1], b2)
+            b2.matrix.translate(100, 100)
+            canvas.request_matrix_update(b2)
+            canvas.remove(b1)
+            self.assertFalse(canvas.solver._marked_cons)
+
+        self.assertEqual([], updates)
+        self.assertEqual(1, len(views))
+        self.assertEqual((set([b2, l]), set([b1])), views[0])
+        self.assertFalse(canvas.solver._marked_cons)
+        self.assertTrue(canvas.get_connection(l.handles()[-1]))
+        self.assertFalse(canvas.get_connection(l.handles()[0]))
+
+        # The connected handle sticks to the box
+        h = l.handles()[-1]
+        x, y = canvas.get_matrix_i2c(l).transform_point(*h.pos)
+        self.assertTrue(100 <= x <= 100 + b2.width)
+        self.assertTrue(100 <= y <= 100 + b2.height)
+
+    def test_import(self):
+        """Test boxes connected in a ring can be imported in a batch"""
+        n = 100
+        canvas = Canvas()
+        boxes = [Box() for i in range(n)]
+        lines = [Line() for i in range(n)]
+        with canvas.batch():
+            for i, b in enumerate(boxes):
+                b.matrix.translate(i * 20, 0)
+                canvas.add(b)
+            for i, l in enumerate(lines):
+                canvas.add(l)
+                connect(canvas, l, l.handles()[0], boxes[i])
+                connect(canvas, l, l.handles()[-1], boxes[(i + 1) % n])
+
+        self.assertEqual(2 * n, len(canvas.get_all_items()))
+        self.assertFalse(canvas.require_update())
+        for l in lines:
+            self.assertTrue(all(canvas.get_connections_for_handles(l.handles())))
+
+    def test_undo(self):
+        """Test a batch can be undone"""
+        undo_list = []
+        state.observers.add(state.revert_handler)
+        state.subscribers.add(undo_list.append)
+        try:
+            canvas = Canvas()
+            b1, l = Box(), Line()
+            with canvas.batch():
+                canvas.add(b1)
+                canvas.add(l)
+                connect(canvas, l, l.handles()[0], b1)
+            self.assertEqual(3, len(canvas.solver.constraints))
+
+            for event in reversed(undo_list):
+                state.saveapply(*event)
+            self.assertEqual([], canvas.get_all_items())
+            self.assertEqual(0, len(canvas.solver.constraints))
+        finally:
+            state.observers.discard(state.revert_handler)
+            state.subscribers.discard(undo_list.append)
+
+
+class SpatialIndexTestCase(unittest.TestCase):
+
+    def test_index_grows(self):
+        canvas = Canvas()
+        b1 = Box()
+        b2 = Box()
+        canvas.add(b1)
+        canvas.add(b2)
+        canvas.set_item_bounding_box(b1, (0, 0, 10, 10), (0, 0, 10, 10))
+        canvas.set_item_bounding_box(b2, (5000, -3000, 10, 10), (0, 0, 10, 10))
+
+        qtree = canvas.spatial_index
+        self.assertEqual(set([b2]), qtree.find_intersect((4990, -3010, 30, 30)))
+        self.assertEqual(set([b1, b2]), qtree.find_inside(qtree.bounds))
+
+    def test_removed_items_leave_index(self):
+        canvas = Canvas()
+        b1 = Box()
+        b2 = Box()
+        canvas.add(b1)
+        canvas.add(b2, b1)
+        canvas.set_item_bounding_box(b1, (0, 0, 10, 10), (0, 0, 10, 10))
+        canvas.set_item_bounding_box(b2, (0, 0, 5, 5), (0, 0, 5, 5))
+
+        canvas.remove(b1)
+        self.assertEqual(0, len(canvas.spatial_index))
+
+    def test_packed_rtree_index(self):
+        from gaphas.rtree import PackedRTree
+        canvas = Canvas(spatial_index=PackedRTree())
+        b1 = Box()
+        canvas.add(b1)
+        canvas.set_item_bounding_box(b1, (0, 0, 10, 10), (0, 0, 10, 10))
+        assert isinstance(canvas.spatial_index, PackedRTree)
+        self.assertEqual(set([b1]), canvas.spatial_index.find_intersect((5, 5, 1, 1)))
+
+        canvas.remove(b1)
+        self.assertEqual(0, len(canvas.spatial_index))
+
+    def test_pickle_index_settings(self):
+        import pickle
+        from gaphas.rtree import PackedRTree
+        canvas = Canvas(spatial_index=PackedRTree(capacity=4, buffer_size=32))
+        canvas.add(Box())
+        canvas = pickle.loads(pickle.dumps(canvas))
+        index = canvas.spatial_index
+        self.assertTrue(isinstance(index, PackedRTree))
+        self.assertEqual(dict(capacity=4, buffer_size=32), index.settings())
+        self.assertEqual(0, len(index))
+
+
+class BulkEditTestCase(unittest.TestCase):
+
+    def test_remove_many(self):
+        """Test items, children and connections are removed at once"""
+        canvas = Canvas()
+        views = []
+        class View(object):
+            def request_update(self, items, matrix_only_items, removed_items):
+                views.append(list(removed_items))
+        canvas.register_view(View())
+
+        b1, b2, b3, l = Box(), Box(), Box(), Line()
+        canvas.add_many([(b1, None), (b2, b1), (b3, None), (l, None)])
+        self.assertEqual([b1, b2, b3, l], canvas.get_all_items())
+        connect(canvas, l, l.handles()[0], b2)
+        connect(canvas, l, l.handles()[-1], b3)
+
+        canvas.remove_many([b1])
+        self.assertEqual([[b1, b2]], views)
+        self.assertEqual([b3, l], canvas.get_all_items())
+        self.assertFalse(canvas.get_connection(l.handles()[0]))
+        self.assertTrue(canvas.get_connection(l.handles()[-1]))
+        self.assertEqual(None, b2.canvas)
+
+    def test_undo(self):
+        """Test add_many() and remove_many() are undone in one step"""
+        canvas = Canvas()
+        b1, b2, b3, l = Box(), Box(), Box(), Line()
+        b4, b5 = Box(), Box()
+
+        undo_list = []
+        def undo():
+            events = list(undo_list)
+            del undo_list[:]
+            events.reverse()
+            for e in events:
+                state.saveapply(*e)
+
+        state.observers.add(state.revert_handler)
+        state.subscribers.add(undo_list.append)
+        try:
+            canvas.add_many([(b1, None), (b2, b1), (b3, None), (l, None)])
+            self.assertEqual(1, len(undo_list))
+            undo()
+            self.assertEqual([], canvas.get_all_items())
+
+            # redo
+            undo()
+            self.assertEqual([b1, b2, b3, l], canvas.get_all_items())
+            self.assertTrue(canvas.get_parent(b2) is b1)
+
+            connect(canvas, l, l.handles()[0], b2)
+            del undo_list[:]
+
+            canvas.remove_many([b3, b1])
+            self.assertEqual(1, len(undo_list))
+            self.assertEqual([l], canvas.get_all_items())
+            undo()
+            self.assertEqual([b1, b2, b3, l], canvas.get_all_items())
+            self.assertTrue(canvas.get_parent(b2) is b1)
+            self.assertTrue(canvas.get_connection(l.handles()[0]))
+
+            # redo
+            undo()
+            self.assertEqual([l], canvas.get_all_items())
+            self.assertFalse(canvas.get_connection(l.handles()[0]))
+
+            undo()
+            del undo_list[:]
+            canvas.add_many([(b4, None), (b5, b4)])
+            self.assertEqual([b1, b2, b3, l, b4, b5], canvas.get_all_items())
+            undo()
+            self.assertEqual([b1, b2, b3, l], canvas.get_all_items())
+        finally:
+            state.observers.discard(state.revert_handler)
+            state.subscribers.discard(undo_list.append)
+
+
+class ProfileTestCase(unittest.TestCase):
+
+    def test_phases(self):
+        """Test the profiler receives the timings of each update pass"""
+        canvas = Canvas()
+        recorded = []
+        class Profiler(UpdateProfiler):
+            def record(self, timings):
+                recorded.append(timings)
+        canvas.profile(Profiler())
+
+        b1, b2 = Box(), Box()
+        canvas.add(b1)
+        canvas.add(b2, b1)
+        canvas.update_now()
+
+        self.assertEqual(1, len(recorded))
+        timings = recorded[0]
+        self.assertEqual(None, timings.error)
+        self.assertEqual(['sort', 'pre_update', 'matrices', 'solve',
+                          'normalize', 'solve_normalized', 'post_update',
+                          'views'],
+                         [phase for phase, seconds, count in timings.phases])
+        self.assertEqual(2, dict((phase, count) for phase, seconds, count in timings.phases)['sort'])
+        self.assertTrue(timings.time >= sum(seconds for phase, seconds, count in timings.phases) - 1e-9)
+
+    def test_error(self):
+        """Test a failing update pass is recorded"""
+        canvas = Canvas()
+        stats = UpdateStats()
+        canvas.profile(stats)
+        b = Box()
+        canvas.add(b)
+        def pre_update(context):
+            raise ValueError('failure')
+        b.pre_update = pre_update
+        canvas.update_now()
+
+        self.assertEqual(1, stats.passes)
+        self.assertEqual(1, stats.errors)
+        self.assertEqual(None, stats.percentile('post_update', 50))
+        self.assertTrue(stats.percentile(None, 50) >= 0)
+
+
+class HeadlessUpdateTestCase(unittest.TestCase):
+
+    def test_measure_context(self):
+        """Test one measuring context is used for all updates"""
+        canvas = Canvas()
+        contexts = []
+        class Item(Box):
+            def pre_update(self, context):
+                contexts.append(context.cairo)
+        i = Item()
+        canvas.add(i)
+        canvas.update_now()
+        canvas.request_update(i)
+        canvas.update_now()
+        self.assertEqual(2, len(contexts))
+        self.assertTrue(contexts[0] is contexts[1])
+        self.assertTrue(contexts[0] is canvas.measure_context)
+
+        cr = cairo.Context(cairo.ImageSurface(cairo.FORMAT_ARGB32, 0, 0))
+        canvas.measure_context = cr
+        canvas.request_update(i)
+        canvas.update_now()
+        self.assertTrue(contexts[-1] is cr)
+
+    def test_skip_default_updates(self):
+        """Test only items overriding pre/post_update() are called"""
+        canvas = Canvas()
+        b, l = Box(), Line()
+        canvas.add(b)
+        canvas.add(l)
+        self.assertEqual([], canvas._with_update_hook([b, l], 'pre_update'))
+        self.assertEqual([l], canvas._with_update_hook([b, l], 'post_update'))
+
+        canvas.skip_default_updates = False
+        self.assertEqual([b, l], canvas._with_update_hook([b, l], 'pre_update'))
+
+
+def connect(canvas, line, handle, item):
+    port = item.ports()[0]
+    constraint = port.constraint(canvas, line, handle, item)
+    canvas.connect_item(line, handle, item, port, constraint)
+
+
 # vim:sw=4:et:ai
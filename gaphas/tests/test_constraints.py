@@ -1,7 +1,8 @@
 import unittest
 
 from gaphas.solver import Variable
-from gaphas.constraint import PositionConstraint, LineAlignConstraint
+from gaphas.constraint import PositionConstraint, LineAlignConstraint, \
+        EquationConstraint
 
 class PositionTestCase(unittest.TestCase):
     def test_pos_constraint(self):
@@ -68,4 +69,54 @@ class LineAlignConstraintTestCase(unittest.TestCase):
         self.assertAlmostEqual(16.0, point[0].value, 2)
         self.assertAlmostEqual(12.00, point[1].value, 2)
 
+
+class EquationConstraintTestCase(unittest.TestCase):
+    """
+    Equation constraint test case.
+    """
+    def test_affine(self):
+        """Test affine equations are solved directly
+        """
+        a, b, c = Variable(1), Variable(2), Variable(3)
+        f = lambda a, b, c: 2 * a + b - c
+        ec = EquationConstraint(f, a=a, b=b, c=c)
+        ec.solve_for(a)
+        self.assertAlmostEqual(0.5, a.value)
+        self.assertTrue(ec._affine['a'])
+
+        calls = []
+        ec._f = lambda a, b, c: calls.append(a) or f(a, b, c)
+        c.value = 10
+        ec.solve_for(a)
+        self.assertAlmostEqual(4.0, a.value)
+        self.assertEqual(3, len(calls))
+
+    def test_piecewise(self):
+        """Test a piecewise linear equation falls back to Newton's method
+        """
+        a, b = Variable(5), Variable(4)
+        ec = EquationConstraint(lambda a, b: max(a, 3) - b, a=a, b=b)
+        ec.solve_for(a)
+        self.assertEqual(4, a)
+        self.assertTrue(ec._affine['a'])
+
+        a.value = 2.9
+        b.value = 3.5
+        ec.solve_for(a)
+        self.assertFalse(ec._affine['a'])
+        self.assertAlmostEqual(3.5, a.value, 4)
+
+    def test_non_linear(self):
+        """Test non-linear equations are solved with a warm start
+        """
+        a, b = Variable(2), Variable(2)
+        ec = EquationConstraint(lambda a, b: a * a - b, a=a, b=b)
+        ec.solve_for(a)
+        self.assertFalse(ec._affine['a'])
+        self.assertAlmostEqual(1.41421, a.value, 4)
+
+        b.value = 2.1
+        ec.solve_for(a)
+        self.assertAlmostEqual(2.1 ** 0.5, a.value, 4)
+
 # vim: sw=4:et:ai
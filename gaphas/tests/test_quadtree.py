@@ -1,7 +1,7 @@
 
 from builtins import range
 import unittest
-from gaphas.quadtree import Quadtree
+from gaphas.quadtree import Quadtree, LooseQuadtree
 
 class QuadtreeTestCase(unittest.TestCase):
 
@@ -92,6 +92,128 @@ class QuadtreeTestCase(unittest.TestCase):
         qtree.add(1, (-100, -100, 120, 120))
         self.assertEqual((0, 0, 20, 20), qtree.get_clipped_bounds(1))
 
+    def test_soft_bounds(self):
+        qtree = Quadtree((0, 0, 100, 100))
+        for i in range(0, 100, 10):
+            for j in range(0, 100, 10):
+                qtree.add("%dx%d" % (i, j), (i, j, 10, 10))
+        self.assertEqual((0, 0, 100, 100), qtree.soft_bounds)
+
+        # Grow and shrink
+        qtree.add('0x0', (-20, 0, 10, 10))
+        self.assertEqual((-20, 0, 120, 100), qtree.soft_bounds)
+        qtree.add('0x0', (0, 0, 10, 10))
+        self.assertEqual((0, 0, 100, 100), qtree.soft_bounds)
+
+        # Other items are on the same edges: no recalculation needed
+        qtree.remove('50x0')
+        qtree.remove('90x90')
+        assert not qtree._soft_bounds._dirty
+        self.assertEqual((0, 0, 100, 100), qtree.soft_bounds)
+
+        for j in range(0, 100, 10):
+            qtree.remove('0x%d' % j)
+        self.assertEqual((10, 0, 90, 100), qtree.soft_bounds)
+
+        qtree.clear()
+        self.assertEqual((0, 0, 0, 0), qtree.soft_bounds)
+
+    def test_find_nearest(self):
+        qtree = Quadtree((0, 0, 100, 100), capacity=4)
+        for i in range(0, 100, 10):
+            for j in range(0, 100, 10):
+                qtree.add("%dx%d" % (i, j), (i, j, 5, 5))
+
+        self.assertEqual([(0.0, '50x50')], qtree.find_nearest((52, 52)))
+        self.assertEqual([(1.0, '50x50'), (4.0, '60x50')],
+                         qtree.find_nearest((56, 52), k=2))
+        self.assertEqual([], qtree.find_nearest((56, 52), max_distance=0.5))
+        self.assertEqual(['50x50', '50x60', '60x50', '60x60'],
+                         sorted(item for d, item
+                                in qtree.find_within((57.5, 57.5), 4)))
+
+    def test_find_nearest_outside(self):
+        qtree = Quadtree((0, 0, 100, 100), capacity=4)
+        for i in range(0, 100, 10):
+            qtree.add(i, (i, 50, 5, 5))
+        qtree.add('out', (150, 50, 5, 5))
+        qtree.add('long', (-100, 0, 140, 5))
+
+        self.assertEqual([(5.0, 'out')], qtree.find_nearest((160, 52)))
+        self.assertEqual([(10.0, 'long')], qtree.find_nearest((-50, 15)))
+        self.assertEqual([(45.0, 'long'), (50.0, 0)],
+                         qtree.find_within((-50, 50), 50))
+
+        qtree.add('out', (50, 150, 5, 5))
+        self.assertEqual([(0.0, 'out')], qtree.find_nearest((52, 152)))
+        qtree.remove('long')
+        self.assertEqual([(50.0, 0)], qtree.find_within((-50, 50), 50))
+
+    def test_find_nearest_with_distance(self):
+        qtree = Quadtree((0, 0, 100, 100), capacity=4)
+        for i in range(0, 100, 10):
+            qtree.add(i, (i, 0, 5, 5))
+
+        calls = []
+        def distance(item):
+            calls.append(item)
+            if item != 50:
+                return abs(item - 52) + 1
+
+        self.assertEqual([(9, 60), (13, 40)],
+                         qtree.find_nearest((52, 2), k=2, distance=distance))
+        # Items further away are not looked at
+        assert len(calls) < 6, calls
+
+
+class LooseQuadtreeTestCase(unittest.TestCase):
+
+    def _add_grid(self, qtree):
+        # Items straddle the centre lines of buckets at all levels
+        for i in range(0, 100, 5):
+            for j in range(0, 100, 5):
+                qtree.add("%dx%d" % (i, j), (i - 2, j - 2, 5, 5))
+
+    def test_buckets_stay_balanced(self):
+        qtree = Quadtree((0, 0, 100, 100), capacity=10)
+        loose = LooseQuadtree((0, 0, 100, 100), capacity=10)
+        self._add_grid(qtree)
+        self._add_grid(loose)
+
+        stats = qtree.stats()
+        loose_stats = loose.stats()
+        assert loose_stats['items'] == 400
+        assert loose_stats['root_items'] == 0, loose_stats
+        assert loose_stats['max_items'] <= 10, loose_stats
+        assert stats['root_items'] > 10, stats
+        assert loose_stats['max_items'] < stats['max_items']
+
+    def test_lookups(self):
+        qtree = LooseQuadtree((0, 0, 100, 100))
+        self._add_grid(qtree)
+        self.assertEqual(set(['50x50']), qtree.find_intersect((49, 49, 1, 1)))
+        self.assertEqual(set(['50x50', '55x50']), qtree.find_inside((47, 47, 14, 6)))
+
+    def test_root_grows(self):
+        qtree = LooseQuadtree((0, 0, 100, 100), capacity=2)
+        self._add_grid(qtree)
+        qtree.add('far', (-1000, 3000, 10, 10))
+        qtree.add('big', (-5000, -5000, 10000, 10000))
+        x, y, w, h = qtree.bounds
+        assert x <= -1000 and y + h > 3000, qtree.bounds
+        self.assertEqual(set(['far', 'big']), qtree.find_intersect((-1000, 3000, 1, 1)))
+        self.assertEqual(402, len(qtree.find_intersect(qtree._bucket.loose_bounds)))
+
+    def test_moving_items(self):
+        qtree = LooseQuadtree((0, 0, 100, 100), capacity=2)
+        self._add_grid(qtree)
+        qtree.add('0x0', (500, 500, 10, 10))
+        assert qtree.find_intersect((0, 0, 1, 1)) == set()
+        assert qtree.find_intersect((505, 505, 1, 1)) == set(['0x0'])
+        qtree.remove('0x0')
+        assert qtree.find_intersect((505, 505, 1, 1)) == set()
+        self.assertEqual(399, qtree.stats()['items'])
+
 
 if __name__ == '__main__':
     unittest.main()
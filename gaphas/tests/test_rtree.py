@@ -0,0 +1,110 @@
+
+from builtins import range
+import unittest
+from gaphas.rtree import PackedRTree
+from gaphas.quadtree import Quadtree
+
+class PackedRTreeTestCase(unittest.TestCase):
+
+    def _grid(self):
+        return [("%dx%d" % (i, j), (i, j, 10, 10), i + j)
+                for i in range(0, 100, 10) for j in range(0, 100, 10)]
+
+    def test_bulk_load(self):
+        rtree = PackedRTree.bulk_load(self._grid(), capacity=4)
+        assert len(rtree) == 100
+        self.assertEqual((0, 0, 100, 100), rtree.bounds)
+        stats = rtree.stats()
+        assert stats['buffer'] == 0
+        assert stats['items'] == 100
+        # 25 leaves, 7 nodes, 2 nodes, root
+        assert stats['depth'] == 3, stats
+
+        for i in range(0, 100, 10):
+            for j in range(0, 100, 10):
+                self.assertEqual(set(['%dx%d' % (i, j)]),
+                                 rtree.find_intersect((i + 1, j + 1, 1, 1)))
+                self.assertEqual(i + j, rtree.get_data('%dx%d' % (i, j)))
+
+    def test_same_results_as_quadtree(self):
+        rtree = PackedRTree.bulk_load(self._grid())
+        qtree = Quadtree((0, 0, 100, 100))
+        for item, bounds, data in self._grid():
+            qtree.add(item, bounds, data)
+
+        for rect in ((0, 0, 100, 100), (15, 25, 30, 10), (50, 50, 0, 0), (-10, -10, 5, 5)):
+            self.assertEqual(qtree.find_intersect(rect), rtree.find_intersect(rect))
+            self.assertEqual(qtree.find_inside(rect), rtree.find_inside(rect))
+        self.assertEqual(qtree.soft_bounds, rtree.soft_bounds)
+
+    def test_overflow_buffer(self):
+        rtree = PackedRTree.bulk_load(self._grid(), buffer_size=10)
+        rtree.add('0x0', (200, 200, 10, 10))
+        rtree.add('new', (300, 300, 10, 10))
+        rtree.remove('10x10')
+
+        self.assertEqual(2, rtree.stats()['buffer'])
+        self.assertEqual(set(), rtree.find_intersect((1, 1, 1, 1)))
+        self.assertEqual(set(), rtree.find_intersect((11, 11, 1, 1)))
+        self.assertEqual(set(['0x0']), rtree.find_intersect((201, 201, 1, 1)))
+        self.assertEqual((0, 0, 310, 310), rtree.soft_bounds)
+        assert '10x10' not in rtree
+        self.assertEqual(100, len(rtree))
+
+    def test_soft_bounds(self):
+        rtree = PackedRTree.bulk_load([('a', (0, 0, 10, 10)), ('b', (50, 50, 10, 10))])
+        self.assertEqual((0, 0, 60, 60), rtree.soft_bounds)
+        rtree.add('c', (-10, 20, 10, 10))
+        self.assertEqual((-10, 0, 70, 60), rtree.soft_bounds)
+        rtree.add('b', (20, 20, 10, 10))
+        self.assertEqual((-10, 0, 40, 30), rtree.soft_bounds)
+        rtree.remove('c')
+        self.assertEqual((0, 0, 30, 30), rtree.soft_bounds)
+
+    def test_dump(self):
+        import sys
+        from io import StringIO
+        rtree = PackedRTree.bulk_load(self._grid(), capacity=4)
+        rtree.add('new', (52, 52, 1, 1))
+        nodes = list(rtree.node_bounds())
+        self.assertEqual(rtree.stats()['nodes'], len(nodes))
+        self.assertEqual((0, 0, 100, 100), nodes[0])
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            rtree.dump()
+            out = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertTrue("new (52, 52, 1, 1)" in out, out)
+        self.assertTrue("90x90 (90, 90, 10, 10)" in out, out)
+
+    def test_buffer_is_merged(self):
+        rtree = PackedRTree.bulk_load(self._grid(), buffer_size=10)
+        for i in range(11):
+            rtree.add('new%d' % i, (i * 10, 200, 10, 10))
+        stats = rtree.stats()
+        self.assertEqual(0, stats['buffer'])
+        self.assertEqual(111, stats['items'])
+        self.assertEqual(set(['new5']), rtree.find_intersect((51, 201, 1, 1)))
+
+    def test_find_nearest(self):
+        rtree = PackedRTree.bulk_load(self._grid(), capacity=4)
+        rtree.add('new', (52, 52, 1, 1))
+
+        self.assertEqual([(0.0, '50x50'), (0.0, 'new')],
+                         sorted(rtree.find_nearest((52.5, 52.5), k=2)))
+        self.assertEqual(['0x0'], [i for d, i in rtree.find_within((-3, -4), 5)])
+        self.assertEqual([], rtree.find_nearest((-3, -4), max_distance=4.9))
+
+        # Only the far corner is accepted by the distance callback
+        def distance(item):
+            if rtree.get_data(item) == 180:
+                return 200
+        self.assertEqual([(200, '90x90')],
+                         rtree.find_nearest((0, 0), distance=distance))
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:sw=4:et:ai
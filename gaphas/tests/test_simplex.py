@@ -0,0 +1,204 @@
+"""
+Unit tests for the simplex solver.
+"""
+import unittest
+
+from gaphas import state
+from gaphas.solver import Solver, Variable, JuggleError, WEAK, STRONG
+from gaphas.constraint import EqualsConstraint, LessThanConstraint, \
+    EquationConstraint
+from gaphas.simplex import SimplexSolver, Tableau, UnsatisfiableError, EQ
+from gaphas.canvas import Canvas
+from gaphas.examples import Box
+
+
+class TableauTestCase(unittest.TestCase):
+
+    def test_unsatisfiable(self):
+        a = Variable(1.0)
+        t = Tableau()
+        t.add([(a, 1.0)], -1.0, EQ)
+        self.assertRaises(UnsatisfiableError, t.add, [(a, 1.0)], -2.0, EQ)
+        self.assertEqual(1.0, t.value(a))
+
+
+class SimplexSolverTestCase(unittest.TestCase):
+
+    def test_cycle(self):
+        """
+        Test constraints in a cycle, that make local propagation juggle.
+        """
+        def cycle(solver):
+            solver.add_constraint(EqualsConstraint(a, b))
+            solver.add_constraint(EqualsConstraint(b, c))
+            solver.add_constraint(EqualsConstraint(c, a))
+            return solver
+
+        a, b, c = Variable(1), Variable(2), Variable(3)
+        self.assertRaises(JuggleError, cycle(Solver()).solve)
+
+        a, b, c = Variable(1), Variable(2), Variable(3)
+        solver = cycle(SimplexSolver())
+        solver.solve()
+        a.value = 7
+        solver.solve()
+        self.assertEqual([7, 7, 7], [a.value, b.value, c.value])
+        c.value = 3
+        solver.solve()
+        self.assertEqual([3, 3, 3], [a.value, b.value, c.value])
+
+    def test_strength(self):
+        a, b, c = Variable(1), Variable(2, WEAK), Variable(3, STRONG)
+        solver = SimplexSolver()
+        solver.add_constraint(EqualsConstraint(a, b))
+        solver.add_constraint(LessThanConstraint(smaller=b, bigger=c))
+        solver.solve()
+        self.assertEqual([1, 1, 3], [a.value, b.value, c.value])
+
+        # Edits take precedence over stays, even strong ones
+        a.value = 5
+        solver.solve()
+        self.assertEqual([5, 5, 5], [a.value, b.value, c.value])
+
+        c.value = 4
+        solver.solve()
+        self.assertEqual([4, 4, 4], [a.value, b.value, c.value])
+
+    def test_drag(self):
+        a, b = Variable(1), Variable(2)
+        solver = SimplexSolver()
+        solver.add_constraint(EqualsConstraint(a, b, 1))
+        solver.solve()
+
+        plan = solver.create_plan(b)
+        for i in range(5):
+            b.value = 10 + i
+            solver.solve()
+            self.assertEqual(9 + i, a.value)
+        solver.discard_plan(plan)
+        solver.solve()
+        self.assertFalse(solver._edits)
+
+    def test_remove_constraint(self):
+        a, b = Variable(1), Variable(2)
+        solver = SimplexSolver()
+        eq = solver.add_constraint(EqualsConstraint(a, b))
+        solver.solve()
+        self.assertEqual(a.value, b.value)
+        value = b.value
+        solver.remove_constraint(eq)
+        a.value = 4
+        solver.solve()
+        self.assertEqual(4, a.value)
+        self.assertEqual(value, b.value)
+        self.assertFalse(solver._stays)
+
+    def test_non_linear(self):
+        """
+        Test non-linear constraints are solved by local propagation.
+        """
+        a, b, c = Variable(2, STRONG), Variable(3), Variable(0, WEAK)
+        solver = SimplexSolver()
+        solver.add_constraint(EqualsConstraint(a, b))
+        solver.add_constraint(EquationConstraint(lambda b, c: b * b - c, b=b, c=c))
+        self.assertEqual(1, len(solver._propagation.constraints))
+        solver.solve()
+        self.assertEqual(2, b.value)
+        self.assertAlmostEqual(4, c.value, 4)
+
+        a.value = 3
+        solver.solve()
+        self.assertAlmostEqual(9, c.value, 4)
+
+    def test_undo(self):
+        undo_list = []
+        def undo_handler(event):
+            undo_list.append(event)
+        state.observers.add(state.revert_handler)
+        state.subscribers.add(undo_handler)
+        try:
+            a, b = Variable(1), Variable(2)
+            solver = SimplexSolver()
+            eq = solver.add_constraint(EqualsConstraint(a, b))
+            solver.solve()
+            self.assertEqual(2, len(undo_list))
+            for f, kw in reversed(undo_list):
+                f(**kw)
+            self.assertFalse(solver.constraints)
+            self.assertEqual(2, b.value)
+        finally:
+            state.observers.discard(state.revert_handler)
+            state.subscribers.discard(undo_handler)
+
+    def test_box_minimal_size(self):
+        """
+        A box handle is stopped at the minimal size, like with the
+        local propagation solver.
+        """
+        solver = SimplexSolver()
+        canvas = Canvas(solver=solver)
+        box = Box(20, 20)
+        canvas.add(box)
+        canvas.update_now()
+        nw, ne, se, sw = box.handles()
+
+        se.pos = (5, 5)
+        canvas.request_update(box)
+        canvas.update_now()
+        self.assertEqual((0, 0), tuple(nw.pos))
+        self.assertEqual((10, 10), tuple(se.pos))
+        self.assertEqual((1, 0, 0, 1, 0, 0), tuple(box.matrix))
+
+        # Dragging the handle is limited in the same way
+        plan = solver.create_plan(se.pos.x, se.pos.y)
+        for x in (15, 8, 3):
+            se.pos = (x, x)
+            canvas.request_update(box)
+            canvas.update_now()
+        solver.discard_plan(plan)
+        self.assertEqual((0, 0), tuple(nw.pos))
+        self.assertEqual((10, 10), tuple(se.pos))
+        self.assertEqual((1, 0, 0, 1, 0, 0), tuple(box.matrix))
+
+    def test_pickle(self):
+        import pickle
+        a, b = Variable(1), Variable(2)
+        solver = SimplexSolver()
+        solver.add_constraint(EqualsConstraint(a, b))
+        solver.solve()
+        solver, a, b = pickle.loads(pickle.dumps((solver, a, b)))
+        a.value = 3
+        solver.solve()
+        self.assertEqual(3, b.value)
+
+
+class SimplexChainTestCase(unittest.TestCase):
+
+    def test_chain(self):
+        """
+        A long chain of coupled constraints is solved in one pass.
+        """
+        solver = SimplexSolver()
+        variables = [Variable(0, STRONG)] + [Variable(i) for i in range(1, 100)]
+        for a, b in zip(variables, variables[1:]):
+            solver.add_constraint(LessThanConstraint(smaller=a, bigger=b, delta=1))
+        solver.solve()
+        self.assertEqual(list(range(100)), [v.value for v in variables])
+
+        # The weaker variables are pushed
+        variables[0].value = 10
+        solver.solve()
+        self.assertEqual(10, variables[0].value)
+        self.assertEqual(109, variables[-1].value)
+
+        # Variables of the same strength are not
+        variables[1].value = 5
+        solver.solve()
+        self.assertEqual(11, variables[1].value)
+        self.assertEqual(10, variables[0].value)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:sw=4:et:ai
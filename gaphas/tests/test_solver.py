@@ -8,9 +8,11 @@ from past.utils import old_div
 import unittest
 from timeit import Timer
 
-from gaphas.solver import Solver, Variable
+from gaphas import state
+from gaphas.solver import Solver, Variable, Projection, JuggleError, \
+    VariableStore, StoredVariable, WEAK, STRONG
 from gaphas.constraint import EquationConstraint, EqualsConstraint, \
-    LessThanConstraint
+    LessThanConstraint, CenterConstraint
 
 
 SETUP = """
@@ -140,6 +142,425 @@ class SizeTestCase(unittest.TestCase):
 
 
 
+class MarkedConstraintsTestCase(unittest.TestCase):
+    """
+    Test the queue of marked constraints.
+    """
+    def test_mark_twice(self):
+        """Test constraints are queued once, in marking order"""
+        solver = Solver()
+        a, b, c = Variable(1.0), Variable(2.0), Variable(3.0)
+        c_ab = solver.add_constraint(EqualsConstraint(a, b))
+        c_bc = solver.add_constraint(EqualsConstraint(b, c))
+        self.assertEqual([c_ab, c_bc], list(solver._marked_cons))
+
+        a.value = 4
+        self.assertEqual([c_bc, c_ab], list(solver._marked_cons))
+
+        solver.remove_constraint(c_ab)
+        self.assertEqual([c_bc], list(solver._marked_cons))
+
+        solver.solve()
+        self.assertEqual(0, len(solver._marked_cons))
+        self.assertEqual(3, b)
+        self.assertEqual(3, c)
+
+
+    def test_juggle_error(self):
+        """Test variable juggling is detected"""
+        solver = Solver()
+        a, b = Variable(1.0), Variable(2.0)
+        solver.add_constraint(EqualsConstraint(a, b))
+        solver.add_constraint(EqualsConstraint(a, b, delta=1.0))
+
+        self.assertRaises(JuggleError, solver.solve)
+
+
+
+class ConstraintsWithVariableTestCase(unittest.TestCase):
+    """
+    Test lookup of constraints by variable.
+    """
+    def test_projection_chain(self):
+        """Test lookup through nested projections"""
+        solver = Solver()
+        a, b = Variable(1.0), Variable(2.0)
+        pa = Projection(Projection(a))
+        c_eq = solver.add_constraint(EqualsConstraint(pa, b))
+
+        self.assertEqual([c_eq], list(solver.constraints_with_variable(a)))
+        self.assertEqual([c_eq], list(solver.constraints_with_variable(a, b)))
+        self.assertEqual([c_eq], list(solver.constraints_with_variable(pa)))
+        self.assertEqual([], list(solver.constraints_with_variable(Projection(a))))
+
+        solver.remove_constraint(c_eq)
+        self.assertEqual([], list(solver.constraints_with_variable(a)))
+
+
+    def test_undo_redo(self):
+        """Test lookup after constraints are added and removed by undo"""
+        undo_list = []
+        def undo_handler(event):
+            undo_list.append(event)
+        def undo():
+            events = list(reversed(undo_list))
+            del undo_list[:]
+            for e in events:
+                state.saveapply(*e)
+
+        solver = Solver()
+        a, b = Variable(1.0), Variable(2.0)
+        c_eq = EqualsConstraint(a, b)
+
+        state.observers.add(state.revert_handler)
+        state.subscribers.add(undo_handler)
+        try:
+            solver.add_constraint(c_eq)
+            self.assertEqual([c_eq], list(solver.constraints_with_variable(a, b)))
+
+            undo()
+            self.assertEqual([], list(solver.constraints_with_variable(a, b)))
+
+            undo()
+            self.assertEqual([c_eq], list(solver.constraints_with_variable(a, b)))
+        finally:
+            state.observers.discard(state.revert_handler)
+            state.subscribers.discard(undo_handler)
+
+
+
+class ComponentTestCase(unittest.TestCase):
+    """
+    Test partitioning of constraints in connected components.
+    """
+    def test_solve_dirty_component(self):
+        """Test only components with marked constraints are solved"""
+        solver = Solver()
+        a, b, c = Variable(1.0), Variable(2.0), Variable(3.0)
+        d, e = Variable(4.0), Variable(5.0)
+        solver.add_constraint(EqualsConstraint(a, b))
+        solver.add_constraint(EqualsConstraint(b, c))
+        solver.add_constraint(EqualsConstraint(d, e))
+        solver.solve()
+        self.assertEqual(2, len(solver.component_stats))
+
+        d.value = 10
+        solver.solve()
+        self.assertEqual(10, e)
+        stats = solver.component_stats
+        self.assertEqual(1, len(stats))
+        self.assertEqual(1, stats[0].constraints)
+
+        solver.solve()
+        self.assertEqual([], solver.component_stats)
+
+
+    def test_merge_and_split(self):
+        """Test components are merged and split"""
+        solver = Solver()
+        a, b, c, d = Variable(1.0), Variable(2.0), Variable(3.0), Variable(4.0)
+        c_ab = solver.add_constraint(EqualsConstraint(a, b))
+        c_cd = solver.add_constraint(EqualsConstraint(c, d))
+        self.assertEqual(2, len(solver.get_components()))
+
+        c_bc = solver.add_constraint(EqualsConstraint(b, c))
+        self.assertEqual([set([c_ab, c_bc, c_cd])], solver.get_components())
+        solver.solve()
+
+        solver.remove_constraint(c_bc)
+        a.value = 8
+        d.value = 9
+        solver.solve()
+        self.assertEqual(2, len(solver.component_stats))
+        self.assertEqual(8, b)
+        self.assertEqual(9, c)
+
+
+
+class SolvePlanTestCase(unittest.TestCase):
+    """
+    Test solving with a solve plan.
+    """
+    def test_replay(self):
+        """Test a replayed plan gives the same result as solving"""
+        def create():
+            solver = Solver()
+            a, b, c = Variable(1.0), Variable(2.0), Variable(3.0)
+            solver.add_constraint(EqualsConstraint(a, b))
+            solver.add_constraint(LessThanConstraint(smaller=b, bigger=c, delta=5))
+            solver.solve()
+            return solver, a, b, c
+
+        solver, a, b, c = create()
+        ref_solver, ref_a, ref_b, ref_c = create()
+
+        plan = solver.create_plan(a)
+        for i in range(10):
+            a.value = ref_a.value = i * 3 - 10
+            solver.solve()
+            ref_solver.solve()
+            self.assertEqual((ref_a.value, ref_b.value, ref_c.value),
+                             (a.value, b.value, c.value))
+            self.assertEqual(0, len(solver._marked_cons))
+        self.assertEqual(2, len(plan))
+        self.assertEqual(10, plan.replays)
+
+
+    def test_shared_plan(self):
+        """Test a plan is discarded when all users discarded it"""
+        solver = Solver()
+        a, b = Variable(1.0), Variable(2.0)
+        solver.add_constraint(EqualsConstraint(a, b))
+
+        plan = solver.create_plan(a)
+        self.assertTrue(solver.create_plan(b) is plan)
+        self.assertEqual(1, len(plan))
+
+        solver.discard_plan(plan)
+        self.assertTrue(plan.valid)
+        solver.discard_plan(plan)
+        self.assertFalse(plan.valid)
+        self.assertTrue(solver.create_plan(a) is not plan)
+
+
+
+class InstrumentationTestCase(unittest.TestCase):
+    """
+    Test the statistics collected by an instrumented solver.
+    """
+    def test_stats(self):
+        solver = Solver()
+        a, b, c = Variable(1.0), Variable(2.0), Variable(3.0)
+        solver.add_constraint(EqualsConstraint(a, b))
+        solver.add_constraint(LessThanConstraint(smaller=b, bigger=c, delta=5))
+        exported = []
+        solver.instrument(exported.append)
+        solver.solve()
+        self.assertEqual(1, len(exported))
+        stats = solver.stats
+        self.assertTrue(stats is exported[0])
+        self.assertEqual(4, stats.solved)
+        self.assertEqual(2, stats.counts[EqualsConstraint])
+        self.assertEqual(2, stats.counts[LessThanConstraint])
+        self.assertEqual(set([EqualsConstraint, LessThanConstraint]), set(stats.times))
+        self.assertTrue(stats.time >= sum(stats.times.values()))
+        self.assertEqual(1, len(stats.components))
+
+        # Nothing to solve, nothing to report
+        solver.solve()
+        self.assertEqual(1, len(exported))
+        self.assertEqual([], solver.component_stats)
+
+        a.value = 10
+        solver.solve()
+        self.assertEqual(2, len(exported))
+        self.assertTrue(solver.stats.longest_chain > 1)
+
+    def test_batch(self):
+        solver = Solver(batch=True)
+        variables = [Variable(i) for i in range(6)]
+        for a, b in zip(variables[::2], variables[1::2]):
+            solver.add_constraint(EqualsConstraint(a, b))
+        solver.instrument()
+        solver.solve()
+        stats = solver.stats
+        self.assertEqual(6, stats.solved)
+        self.assertEqual({EqualsConstraint: 6}, stats.counts)
+        self.assertEqual(3, len(stats.components))
+        self.assertEqual([1, 1, 3, 3, 5, 5], [v.value for v in variables])
+
+    def test_remarked(self):
+        solver = Solver()
+        a, b, c = Variable(1.0), Variable(2.0), Variable(3.0, WEAK)
+        solver.add_constraint(EqualsConstraint(a, b))
+        solver.add_constraint(EqualsConstraint(b, c))
+        solver.add_constraint(EquationConstraint(lambda a, c: a + c, a=a, c=c))
+        solver.instrument()
+        self.assertRaises(JuggleError, solver.solve)
+        stats = solver.stats
+        self.assertEqual(3, len(stats.remarked))
+        self.assertTrue(max(stats.remarked.values()) > 100)
+
+    def test_same_outcome(self):
+        """Test an instrumented solver solves like a regular one"""
+        def create():
+            solver = Solver(batch=True)
+            a, b, c = Variable(1.0), Variable(2.0), Variable(3.0)
+            solver.add_constraint(EqualsConstraint(a, b))
+            solver.add_constraint(LessThanConstraint(smaller=b, bigger=c, delta=5))
+            solver.solve()
+            return solver, a, b, c
+
+        solver, a, b, c = create()
+        ref_solver, ref_a, ref_b, ref_c = create()
+        solver.instrument()
+        plan = solver.create_plan(a)
+        for i in range(5):
+            a.value = ref_a.value = i * 3 - 10
+            solver.solve()
+            ref_solver.solve()
+            self.assertEqual((ref_a.value, ref_b.value, ref_c.value),
+                             (a.value, b.value, c.value))
+        self.assertEqual(2, solver.stats.replayed)
+        self.assertEqual(0, solver.stats.solved)
+
+
+class VariableStoreTestCase(unittest.TestCase):
+
+    def test_solve_stored_variables(self):
+        store = VariableStore()
+        solver = Solver()
+        a, b = store.variable(1.0), store.variable(2.0, WEAK)
+        solver.add_constraint(EqualsConstraint(a, b))
+        solver.solve()
+        self.assertEqual(1.0, b.value)
+        self.assertEqual([1.0, 1.0], list(store.values))
+
+        store.set_values((a,), (4.0,))
+        solver.solve()
+        self.assertEqual([4.0, 4.0], list(store.values))
+
+    def test_strength(self):
+        store = VariableStore()
+        v = store.variable()
+        v.strength = STRONG
+        self.assertEqual(STRONG, store.strengths[v.index])
+
+    def test_items(self):
+        from gaphas.canvas import Canvas
+        from gaphas.examples import Box
+        from gaphas.item import Line
+        store = VariableStore()
+        canvas = Canvas()
+        box, line = Box(20, 20, store=store), Line(store=store)
+        canvas.add(box)
+        canvas.add(line)
+        for h in box.handles() + line.handles():
+            self.assertTrue(h.pos.x.store is store)
+            self.assertTrue(h.pos.y.store is store)
+
+        # Constraints work on the stored variables
+        box.width = 5
+        canvas.update_now()
+        self.assertEqual(10, box.width)
+
+        # as do handles created when a line segment is split
+        h = line._create_handle((5, 5))
+        self.assertTrue(h.pos.x.store is store)
+
+    def test_pickle(self):
+        import pickle
+        store = VariableStore()
+        a, b = store.variable(1.0), store.variable(2.0)
+        a2, b2 = pickle.loads(pickle.dumps((a, b)))
+        self.assertTrue(isinstance(a2, StoredVariable))
+        self.assertTrue(a2.store is b2.store)
+        self.assertEqual(2.0, b2.value)
+        self.assertEqual(1, b2.index)
+
+        v = pickle.loads(pickle.dumps(Variable(3.0, WEAK), 0))
+        self.assertEqual(3.0, v.value)
+        self.assertEqual(WEAK, v.strength)
+
+
+class BatchTestCase(unittest.TestCase):
+
+    def _build(self, solver, n):
+        variables = []
+        for i in range(n):
+            a, b, c = Variable(i), Variable(i + 1, WEAK), Variable(0)
+            solver.add_constraint(EqualsConstraint(a, b, 2))
+            solver.add_constraint(LessThanConstraint(smaller=b, bigger=c, delta=10))
+            variables.append((a, b, c))
+        return variables
+
+    def test_same_outcome(self):
+        solver, batch = Solver(), Solver(batch=True)
+        v1, v2 = self._build(solver, 10), self._build(batch, 10)
+        for s in (solver, batch):
+            s.solve()
+        for v in v1[::2] + v2[::2]:
+            v[0].value += 20
+            v[2].value = 5
+        for s in (solver, batch):
+            s.solve()
+        self.assertEqual([[v.value for v in vs] for vs in v1],
+                         [[v.value for v in vs] for vs in v2])
+        self.assertEqual(22.0, v2[0][1].value)
+        self.assertEqual(32.0, v2[0][2].value)
+        self.assertEqual(5, len(batch.component_stats))
+
+    def _build_items(self, solver, n):
+        """
+        Create constraints like n elements would have: a minimal size
+        is maintained and a port is kept in the middle.
+        """
+        items = []
+        for i in range(n):
+            x0, y0 = Variable(i * 10), Variable(0)
+            x1, y1 = Variable(i * 10 + 5), Variable(5)
+            center, port = Variable(0, WEAK), Variable(0, WEAK)
+            solver.add_constraint(LessThanConstraint(smaller=x0, bigger=x1, delta=10))
+            solver.add_constraint(LessThanConstraint(smaller=y0, bigger=y1, delta=10))
+            solver.add_constraint(CenterConstraint(x0, x1, center))
+            solver.add_constraint(EqualsConstraint(center, port))
+            items.append((x0, y0, x1, y1, port))
+        return items
+
+    def test_bulk_move(self):
+        """Test loading and moving many items solves like one by one"""
+        solver, batch = Solver(), Solver(batch=True)
+        i1, i2 = self._build_items(solver, 200), self._build_items(batch, 200)
+        for s in (solver, batch):
+            s.solve()
+        self.assertEqual([[v.value for v in vs] for vs in i1],
+                         [[v.value for v in vs] for vs in i2])
+        self.assertEqual((10.0, 0.0, 20.0, 10.0, 15.0), tuple(v.value for v in i2[1]))
+
+        for items in (i1[:150], i2[:150]):
+            for item in items:
+                for v in item[:4]:
+                    v.value += 15
+        for s in (solver, batch):
+            s.solve()
+        self.assertEqual([[v.value for v in vs] for vs in i1],
+                         [[v.value for v in vs] for vs in i2])
+        self.assertEqual((25.0, 15.0, 35.0, 25.0, 30.0), tuple(v.value for v in i2[1]))
+        self.assertEqual(300, len(batch.component_stats))
+
+    def test_custom_constraint(self):
+        class PlusOneConstraint(EqualsConstraint):
+            def solve_for(self, var):
+                self.b.value = self.a.value + 1
+
+        solver = Solver(batch=True)
+        a, b, c, d = Variable(1), Variable(1, WEAK), Variable(5), Variable(1, WEAK)
+        solver.add_constraint(PlusOneConstraint(a, b))
+        solver.add_constraint(PlusOneConstraint(c, d))
+        solver.solve()
+        self.assertEqual(2.0, b.value)
+        self.assertEqual(6.0, d.value)
+
+    def test_undo(self):
+        undo_list = []
+        def undo_handler(event):
+            undo_list.append(event)
+        state.observers.add(state.revert_handler)
+        state.subscribers.add(undo_handler)
+        try:
+            solver = Solver(batch=True)
+            variables = self._build(solver, 3)
+            del undo_list[:]
+            solver.solve()
+            self.assertEqual(3.0, variables[1][1].value)
+            for f, kw in reversed(undo_list):
+                f(**kw)
+            self.assertEqual(2.0, variables[1][1].value)
+        finally:
+            state.observers.discard(state.revert_handler)
+            state.subscribers.discard(undo_handler)
+
+
 class SolverSpeedTestCase(unittest.TestCase):
     """
     Solver speed tests.
@@ -1,6 +1,15 @@
 
 import unittest
-from gaphas.tree import Tree
+import random
+from gaphas.tree import Tree, NodeList
+
+
+class Node(object):
+    def __init__(self, n):
+        self.n = n
+
+    def __repr__(self):
+        return 'Node(%d)' % self.n
 
 
 class TreeTestCase(unittest.TestCase):
@@ -159,5 +168,111 @@ class TreeTestCase(unittest.TestCase):
         tree.reparent(n4, parent=None, index=0)
         assert tree.nodes == [n4, n5, n1, n2, n3], tree.nodes
 
+    def test_index_maintained(self):
+        """
+        Test the index labels keep the order of the nodes, while nodes
+        are added, removed and reparented.
+        """
+        rnd = random.Random(4)
+        tree = Tree()
+        nodes = [Node(i) for i in range(10)]
+        for n in nodes:
+            tree.add(n)
+        tree.index_nodes('index')
+
+        for i in range(10, 1000):
+            node = Node(i)
+            parent = rnd.choice(nodes + [None])
+            siblings = tree.get_children(parent)
+            tree.add(node, parent=parent, index=rnd.randint(0, len(siblings)))
+            nodes.append(node)
+            if i % 10 == 0:
+                node = rnd.choice(nodes)
+                tree.remove(node)
+                nodes = tree.nodes
+            elif i % 10 == 5:
+                node = rnd.choice(nodes)
+                ancestors = [node] + list(tree.get_all_children(node))
+                parent = rnd.choice([n for n in nodes if n not in ancestors] + [None])
+                tree.reparent(node, parent, index=0)
+
+            labels = [n.index for n in tree.nodes]
+            self.assertEqual(sorted(set(labels)), labels)
+
+        selection = rnd.sample(tree.nodes, 20)
+        self.assertEqual([n for n in tree.nodes if n in selection],
+                         tree.sort(selection, index_key='index'))
+
+    def test_get_all_children(self):
+        """
+        Test all children are found from the nodes list, in the same
+        order as a recursive walk.
+        """
+        rnd = random.Random(2)
+        tree = Tree()
+        nodes = [None]
+        for i in range(200):
+            node = Node(i)
+            tree.add(node, parent=rnd.choice(nodes))
+            nodes.append(node)
+
+        def walk(node):
+            for c in tree.get_children(node):
+                yield c
+                for cc in walk(c):
+                    yield cc
+
+        for node in nodes:
+            self.assertEqual(list(walk(node)), list(tree.get_all_children(node)))
+        self.assertEqual(tree.nodes, list(tree.iter_nodes()))
+        self.assertEqual(200, tree.node_count)
+        assert nodes[1] in tree
+
+
+class NodeListTestCase(unittest.TestCase):
+
+    def test_operations(self):
+        """
+        Test a NodeList with small blocks behaves like a plain list.
+        """
+        class SmallNodeList(NodeList):
+            load = 2
+
+        rnd = random.Random(1)
+        nodes = SmallNodeList()
+        expected = []
+        counter = 0
+        for i in range(2000):
+            op = rnd.random()
+            if op < 0.4:
+                index = rnd.randint(0, len(expected))
+                nodes.insert(index, counter)
+                expected.insert(index, counter)
+                counter += 1
+            elif op < 0.55 and expected:
+                node = rnd.choice(expected)
+                nodes.remove(node)
+                expected.remove(node)
+            elif op < 0.7:
+                index = rnd.randint(0, len(expected))
+                new = list(range(counter, counter + rnd.randint(1, 9)))
+                counter += len(new)
+                nodes.insert_many(index, new)
+                expected[index:index] = new
+            elif op < 0.8:
+                start = rnd.randint(0, len(expected))
+                stop = rnd.randint(start, len(expected))
+                self.assertEqual(expected[start:stop], nodes.delete(start, stop))
+                del expected[start:stop]
+
+            self.assertEqual(expected, list(nodes))
+            self.assertEqual(len(expected), len(nodes))
+            if expected:
+                node = rnd.choice(expected)
+                self.assertEqual(expected.index(node), nodes.index(node))
+                index = rnd.randrange(len(expected))
+                self.assertEqual(expected[index], nodes[index])
+                self.assertEqual(expected[index:], nodes[index:])
+
 
 # vi:sw=4:et:ai
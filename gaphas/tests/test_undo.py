@@ -94,6 +94,33 @@ class UndoTestCase(unittest.TestCase):
 #        self.assertEqual(list(canvas.solver.constraints_with_variable(line.handles()[-1].pos.x)))
 #        self.assertTrue(list(canvas.solver.constraints_with_variable(line.handles()[-1].pos.y)))
 
+    def testUndoMatrix(self):
+        b = Box()
+        b.matrix.translate(10, 20)
+        del undo_list[:]
+
+        b.matrix.rotate(0.5)
+        b.matrix.scale(2.0, 4.0)
+        b.matrix.translate(5, 5)
+        self.assertEqual(3, len(undo_list))
+
+        undo()
+
+        for expected, value in zip((1, 0, 0, 1, 10, 20), b.matrix):
+            self.assertAlmostEqual(expected, value)
+
+    def testUndoMatrixKeywords(self):
+        b = Box()
+        del undo_list[:]
+
+        b.matrix.translate(tx=10, ty=20)
+        b.matrix.scale(sx=2.0, sy=4.0)
+        self.assertEqual((2, 0, 0, 4, 10, 20), tuple(b.matrix))
+
+        undo()
+
+        self.assertEqual((1, 0, 0, 1, 0, 0), tuple(b.matrix))
+
 if __name__ == '__main__':
     unittest.main()
 # vim:sw=4:et:ai
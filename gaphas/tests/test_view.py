@@ -79,14 +79,48 @@ class ViewTestCase(unittest.TestCase):
         while Gtk.events_pending():
             Gtk.main_iteration()
 
-        assert len(view._qtree._ids) == 1
-        assert not view._qtree._bucket.bounds == (0, 0, 0, 0), view._qtree._bucket.bounds
+        assert len(canvas.spatial_index._ids) == 1
+        assert not canvas.spatial_index.bounds == (0, 0, 0, 0), canvas.spatial_index.bounds
 
         assert view.get_item_at_point((10, 10)) is box
         assert view.get_item_at_point((60, 10)) is None
 
         window.destroy()
 
+    def test_zoom_keeps_spatial_index(self):
+        canvas = Canvas()
+        view = GtkView(canvas)
+        window = Gtk.Window.new(Gtk.WindowType.TOPLEVEL)
+        window.add(view)
+        window.show_all()
+
+        box = Box()
+        box.matrix.translate(20, 20)
+        canvas.add(box)
+
+        while Gtk.events_pending():
+            Gtk.main_iteration()
+
+        bounds = canvas.get_item_bounding_box(box)
+        vbounds = view.get_item_bounding_box(box)
+
+        view.zoom(2)
+        assert canvas.get_item_bounding_box(box) is bounds
+        assert not view._dirty_matrix_items
+        zbounds = view.get_item_bounding_box(box)
+        # The margin for handles stays the same on screen
+        m = view.bounding_box_margin
+        self.assertAlmostEqual(bounds.width * 2 + m * 2, zbounds.width)
+        self.assertAlmostEqual(bounds.x * 2 - m, zbounds.x)
+        self.assertAlmostEqual(vbounds.x + m, bounds.x)
+        self.assertEqual((2, 0, 0, 2, 40, 40), tuple(view.get_matrix_i2v(box)))
+        self.assertEqual((0.5, 0, 0, 0.5, -20, -20), tuple(view.get_matrix_v2i(box)))
+
+        assert view.get_items_in_rectangle((45, 45, 10, 10)) == [box]
+        assert view.get_items_in_rectangle((10, 10, 10, 10)) == []
+
+        window.destroy()
+
     def test_get_handle_at_point(self):
         canvas = Canvas()
         view = GtkView(canvas)
@@ -125,6 +159,88 @@ class ViewTestCase(unittest.TestCase):
         assert i is box
         assert h is box.handles()[0]
 
+    def test_get_port_at_point(self):
+        canvas = Canvas()
+        view = GtkView(canvas)
+        window = Gtk.Window.new(Gtk.WindowType.TOPLEVEL)
+        window.add(view)
+        window.show_all()
+
+        b1 = Box()
+        b2 = Box()
+        b2.matrix.translate(100, 0)
+        canvas.add(b1)
+        canvas.add(b2)
+
+        while Gtk.events_pending():
+            Gtk.main_iteration()
+
+        item, port, glue_pos = view.get_port_at_point((104, 13))
+        assert item is b2
+        assert port in b2.ports()
+        self.assertAlmostEqual(104, glue_pos[0])
+        self.assertAlmostEqual(10, glue_pos[1])
+
+        item, port, glue_pos = view.get_port_at_point((13, 4))
+        assert item is b1
+
+        self.assertEqual((None, None, None),
+                         view.get_port_at_point((104, 13), exclude=(b2,)))
+
+        window.destroy()
+
+    def test_get_handle_at_point_overlap(self):
+        canvas = Canvas()
+        view = GtkView(canvas)
+        window = Gtk.Window.new(Gtk.WindowType.TOPLEVEL)
+        window.add(view)
+        window.show_all()
+
+        b1 = Box()
+        b2 = Box()
+        b2.matrix.translate(3, 0)
+        canvas.add(b1)
+        canvas.add(b2)
+
+        # The topmost item wins, though b1's handle is nearer
+        i, h = view.get_handle_at_point((0, 0))
+        assert i is b2
+        assert h is b2.handles()[0]
+
+        i, h = view.get_handle_at_point((-4, 0))
+        assert i is b1
+        assert h is b1.handles()[0]
+
+        window.destroy()
+
+    def test_get_port_at_point_overlap(self):
+        canvas = Canvas()
+        view = GtkView(canvas)
+        window = Gtk.Window.new(Gtk.WindowType.TOPLEVEL)
+        window.add(view)
+        window.show_all()
+
+        b1 = Box()
+        b2 = Box()
+        b3 = Box()
+        b3.matrix.translate(0, 4)
+        canvas.add(b1)
+        canvas.add(b2)
+        canvas.add(b3)
+
+        while Gtk.events_pending():
+            Gtk.main_iteration()
+
+        # b1 and b2 are equally close: the topmost one wins. b3 is on
+        # top, but further away.
+        item, port, glue_pos = view.get_port_at_point((5, -3))
+        assert item is b2
+        assert port is b2.ports()[0]
+        self.assertAlmostEqual(5, glue_pos[0])
+        self.assertAlmostEqual(0, glue_pos[1])
+
+        window.destroy()
+
     def test_item_removal(self):
         canvas = Canvas()
         view = GtkView(canvas)
@@ -141,13 +257,13 @@ class ViewTestCase(unittest.TestCase):
         while Gtk.events_pending():
             Gtk.main_iteration()
 
-        assert len(canvas.get_all_items()) == len(view._qtree)
+        assert len(canvas.get_all_items()) == len(canvas.spatial_index)
 
         view.focused_item = box
         canvas.remove(box)
 
         assert len(canvas.get_all_items()) == 0
-        assert len(view._qtree) == 0
+        assert len(canvas.spatial_index) == 0
 
         window.destroy()
 
@@ -512,8 +512,7 @@ class PanTool(Tool):
             dx = self.x1 - self.x0
             dy = self.y1 - self.y0
             view._matrix.translate(old_div(dx,view._matrix[0]), old_div(dy,view._matrix[3]))
-            # Make sure everything's updated
-            view.request_update((), view._canvas.get_all_items())
+            view.matrix_changed()
             self.x0 = self.x1
             self.y0 = self.y1
             return True
@@ -532,7 +531,7 @@ class PanTool(Tool):
             view._matrix.translate(0, old_div(self.speed, view._matrix[3]))
         elif direction == Gdk.ScrollDirection.DOWN:
             view._matrix.translate(0, old_div(-self.speed, view._matrix[3]))
-        view.request_update((), view._canvas.get_all_items())
+        view.matrix_changed()
         return True
 
 
@@ -585,8 +584,7 @@ class ZoomTool(Tool):
                 m.scale(factor, factor)
                 m.translate(+ox, +oy)
 
-                # Make sure everything's updated
-                view.request_update((), view._canvas.get_all_items())
+                view.matrix_changed()
 
                 self.lastdiff = dy
             return True
@@ -604,8 +602,7 @@ class ZoomTool(Tool):
             view._matrix.translate(-ox, -oy)
             view._matrix.scale(factor, factor)
             view._matrix.translate(+ox, +oy)
-            # Make sure everything's updated
-            view.request_update((), view._canvas.get_all_items())
+            view.matrix_changed()
             return True
 
 
@@ -9,6 +9,293 @@ __version__ = "$Revision$"
 # $HeadURL$
 
 from operator import attrgetter
+from itertools import chain, islice
+
+# Distance between the index labels of nodes appended to an indexed
+# tree. See Tree.index_nodes().
+LABEL_GAP = 1 << 16
+
+
+class _Block(list):
+    """
+    A block of nodes in a NodeList. It knows its position in the list
+    of blocks.
+    """
+
+    __slots__ = ('pos',)
+
+
+class NodeList(object):
+    """
+    A sequence of nodes, stored as a list of blocks of limited size.
+    A node can be found, inserted and removed by only looking at one
+    block, so the costs do not grow linearly with the number of nodes,
+    like they do for a flat list. Node positions are found through a
+    Fenwick tree of block sizes.
+
+    Nodes should be unique and hashable.
+
+    >>> l = NodeList(['a', 'b', 'c'])
+    >>> l.insert(1, 'd')
+    >>> l
+    NodeList(['a', 'd', 'b', 'c'])
+    >>> l.index('b')
+    2
+    >>> l.remove('d')
+    >>> l.insert_many(3, ['e', 'f'])
+    >>> l.delete(0, 2)
+    ['a', 'b']
+    >>> l == ['c', 'e', 'f']
+    True
+    >>> len(l), 'e' in l, 'a' in l
+    (3, True, False)
+    """
+
+    # Maximum number of nodes in a block is twice this value
+    load = 256
+
+    def __init__(self, nodes=()):
+        self._set(list(nodes))
+
+    def _set(self, nodes):
+        load = self.load
+        self._blocks = [_Block(nodes[i:i + load])
+                        for i in range(0, len(nodes), load)]
+        self._len = len(nodes)
+        self._block_of = {}
+        for block in self._blocks:
+            self._block_of.update(dict.fromkeys(block, block))
+        self._reindex()
+
+    def __getstate__(self):
+        return list(self)
+
+    def __setstate__(self, state):
+        self._set(state)
+
+    def _reindex(self):
+        """
+        Number the blocks and rebuild the Fenwick tree. Needed after
+        blocks have been added or removed.
+        """
+        blocks = self._blocks
+        nblocks = len(blocks)
+        sizes = [0] * (nblocks + 1)
+        for i, block in enumerate(blocks):
+            block.pos = i
+            j = i + 1
+            sizes[j] += len(block)
+            k = j + (j & -j)
+            if k <= nblocks:
+                sizes[k] += sizes[j]
+        self._sizes = sizes
+        step = 1
+        while step * 2 <= nblocks:
+            step *= 2
+        self._step = step if nblocks else 0
+
+    def _update(self, pos, delta):
+        """
+        Change the size of block ``pos`` in the Fenwick tree.
+        """
+        sizes = self._sizes
+        nblocks = len(sizes) - 1
+        i = pos + 1
+        while i <= nblocks:
+            sizes[i] += delta
+            i += i & -i
+
+    def _offset(self, pos):
+        """
+        The number of nodes before block ``pos``.
+        """
+        sizes = self._sizes
+        offset = 0
+        while pos:
+            offset += sizes[pos]
+            pos -= pos & -pos
+        return offset
+
+    def _locate(self, index):
+        """
+        Find the block containing position ``index``. Returns the block
+        position and the index in the block.
+        """
+        sizes = self._sizes
+        nblocks = len(sizes) - 1
+        pos = 0
+        step = self._step
+        while step:
+            i = pos + step
+            if i <= nblocks and sizes[i] <= index:
+                pos = i
+                index -= sizes[i]
+            step >>= 1
+        return pos, index
+
+    def _split(self, index):
+        """
+        Make sure a block starts at position ``index``, and return the
+        position of that block.
+        """
+        if index >= self._len:
+            return len(self._blocks)
+        pos, offset = self._locate(index)
+        if offset:
+            block = self._blocks[pos]
+            tail = _Block(block[offset:])
+            del block[offset:]
+            self._block_of.update(dict.fromkeys(tail, tail))
+            pos += 1
+            self._blocks.insert(pos, tail)
+            self._reindex()
+        return pos
+
+    def _join(self, pos):
+        """
+        Merge block ``pos`` into the block before it, if both are
+        small enough.
+        """
+        blocks = self._blocks
+        if 0 < pos < len(blocks):
+            block = blocks[pos - 1]
+            tail = blocks[pos]
+            if len(block) + len(tail) <= self.load:
+                block.extend(tail)
+                self._block_of.update(dict.fromkeys(tail, block))
+                del blocks[pos]
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return chain.from_iterable(self._blocks)
+
+    def __contains__(self, node):
+        return node in self._block_of
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'NodeList(%r)' % list(self)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._len)
+            if step != 1:
+                return list(self)[index]
+            return list(self.iter_range(start, stop))
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError('list index out of range')
+        pos, offset = self._locate(index)
+        return self._blocks[pos][offset]
+
+    def iter_range(self, start, stop):
+        """
+        Iterate the nodes in range ``start:stop``, without copying them.
+        """
+        if start >= stop:
+            return iter(())
+        pos, offset = self._locate(start)
+        return islice(chain.from_iterable(islice(self._blocks, pos, None)),
+                      offset, offset + stop - start)
+
+    def index(self, node):
+        """
+        Return the position of ``node``.
+        """
+        try:
+            block = self._block_of[node]
+        except KeyError:
+            raise ValueError('%r is not in list' % (node,))
+        return self._offset(block.pos) + block.index(node)
+
+    def insert(self, index, node):
+        """
+        Insert ``node`` before position ``index``.
+        """
+        assert node not in self._block_of
+        blocks = self._blocks
+        if not blocks:
+            self._set([node])
+            return
+        index = max(0, min(self._len, index if index >= 0 else index + self._len))
+        pos, offset = self._locate(index)
+        if pos == len(blocks):
+            # append to the last block
+            pos -= 1
+            offset = len(blocks[pos])
+        block = blocks[pos]
+        block.insert(offset, node)
+        self._block_of[node] = block
+        self._len += 1
+        if len(block) > 2 * self.load:
+            tail = _Block(block[self.load:])
+            del block[self.load:]
+            self._block_of.update(dict.fromkeys(tail, tail))
+            blocks.insert(pos + 1, tail)
+            self._reindex()
+        else:
+            self._update(pos, 1)
+
+    def insert_many(self, index, nodes):
+        """
+        Insert a sequence of nodes before position ``index``.
+        """
+        if len(nodes) == 1:
+            self.insert(index, nodes[0])
+            return
+        pos = self._split(index)
+        load = self.load
+        new_blocks = [_Block(nodes[i:i + load])
+                      for i in range(0, len(nodes), load)]
+        for block in new_blocks:
+            self._block_of.update(dict.fromkeys(block, block))
+        self._blocks[pos:pos] = new_blocks
+        self._len += len(nodes)
+        self._join(pos + len(new_blocks))
+        self._join(pos)
+        self._reindex()
+
+    def remove(self, node):
+        """
+        Remove ``node``.
+        """
+        try:
+            block = self._block_of.pop(node)
+        except KeyError:
+            raise ValueError('%r is not in list' % (node,))
+        block.remove(node)
+        self._len -= 1
+        if block:
+            self._update(block.pos, -1)
+        else:
+            del self._blocks[block.pos]
+            self._reindex()
+
+    def delete(self, start, stop):
+        """
+        Remove the nodes in the range ``start:stop``, and return them.
+        """
+        pos = self._split(start)
+        end = self._split(stop)
+        removed = list(chain.from_iterable(self._blocks[pos:end]))
+        del self._blocks[pos:end]
+        block_of = self._block_of
+        for node in removed:
+            del block_of[node]
+        self._len -= len(removed)
+        self._join(pos)
+        self._reindex()
+        return removed
 
 
 class Tree(object):
@@ -20,10 +307,13 @@ class Tree(object):
     @invariant: len(self._children) == len(self._nodes) + 1
     """
 
+    # Also for trees pickled before indexes were maintained
+    _index_key = None
+
     def __init__(self):
         # List of nodes in the tree, sorted in the order they ought to be
         # rendered
-        self._nodes = []
+        self._nodes = NodeList()
 
         # Per entry a list of children is maintained.
         self._children = { None: [] }
@@ -31,8 +321,39 @@ class Tree(object):
         # For easy and fast lookups, also maintain a child -> parent mapping
         self._parents = { }
 
+        # Attribute maintained by index_nodes()
+        self._index_key = None
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if not isinstance(self._nodes, NodeList):
+            # Pickled before nodes were stored in a NodeList
+            self._nodes = NodeList(self._nodes)
+
     nodes = property(lambda s: list(s._nodes))
 
+    node_count = property(lambda s: len(s._nodes))
+
+    def __contains__(self, node):
+        return node in self._nodes
+
+    def iter_nodes(self):
+        """
+        Iterate all nodes in the tree, in depth-first order. Unlike
+        ``nodes``, no copy is made, so the tree should not be changed
+        while iterating.
+
+        >>> tree = Tree()
+        >>> tree.add('n1')
+        >>> tree.add('n2')
+        >>> tree.add('n3', parent='n1')
+        >>> list(tree.iter_nodes())
+        ['n1', 'n3', 'n2']
+        >>> tree.node_count
+        3
+        """
+        return iter(self._nodes)
+
     def get_parent(self, node):
         """
         Return the parent item of ``node``.
@@ -130,11 +451,14 @@ class Tree(object):
         >>> list(tree.get_all_children('n1'))
         ['n2', 'n3']
         """
-        children = self.get_children(node)
-        for c in children:
+        # The children directly follow node in the nodes list
+        nodes = self._nodes
+        last = self._last_descendant(node)
+        if last is node:
+            return
+        start = nodes.index(node) + 1 if node is not None else 0
+        for c in nodes.iter_range(start, nodes.index(last) + 1):
             yield c
-            for cc in self.get_all_children(c):
-                yield cc
 
     def get_ancestors(self, node):
         """
@@ -163,6 +487,11 @@ class Tree(object):
         Provide each item in the tree with an index attribute. This
         makes for fast sorting of items.
 
+        From then on, the index is kept up to date while nodes are
+        added and reparented. The index values are not consecutive,
+        but they do reflect the order of the nodes. Only a few of them
+        need to change when a node is inserted.
+
         >>> class A(object):
         ...     def __init__(self, n):
         ...         self.n = n
@@ -178,12 +507,101 @@ class Tree(object):
         >>> t.index_nodes('my_key')
         >>> t.nodes[0].my_key, t.nodes[1].my_key, t.nodes[2].my_key
         (0, 1, 2)
+        >>> d = A('d')
+        >>> t.add(d, parent=a)
+        >>> t.nodes
+        [a, c, d, b]
+        >>> [n.my_key for n in t.nodes] == sorted(n.my_key for n in t.nodes)
+        True
 
         For sorting, see ``sort()``.
         """
         nodes = self.nodes
         lnodes = len(nodes)
         list(map(setattr, nodes, [index_key] * lnodes, list(range(lnodes))))
+        self._index_key = index_key
+
+    def _insert_nodes(self, index, nodes):
+        """
+        Insert ``nodes`` in the nodes list at position ``index``. If the
+        tree is indexed, the nodes get index labels in between the
+        labels of their neighbours.
+        """
+        all_nodes = self._nodes
+        all_nodes.insert_many(index, nodes)
+        key = self._index_key
+        if key is None:
+            return
+        count = len(nodes)
+        if 0 < index and index + count < len(all_nodes):
+            before = getattr(all_nodes[index - 1], key)
+            after = getattr(all_nodes[index + count], key)
+            if after - before <= count:
+                self._relabel(index, count)
+                return
+        self._spread(index, index + count)
+
+    def _spread(self, lo, hi):
+        """
+        Give the nodes in range ``lo:hi`` index labels, evenly spread
+        between the labels of the nodes just outside the range.
+        """
+        nodes = self._nodes
+        key = self._index_key
+        count = hi - lo
+        if lo == 0 and hi == len(nodes):
+            labels = [i * LABEL_GAP for i in range(count)]
+        elif lo == 0:
+            high = getattr(nodes[hi], key)
+            labels = [high - (count - i) * LABEL_GAP for i in range(count)]
+        elif hi == len(nodes):
+            low = getattr(nodes[lo - 1], key)
+            labels = [low + (i + 1) * LABEL_GAP for i in range(count)]
+        else:
+            low = getattr(nodes[lo - 1], key)
+            span = getattr(nodes[hi], key) - low
+            labels = [low + (i + 1) * span // (count + 1) for i in range(count)]
+        list(map(setattr, nodes[lo:hi], [key] * count, labels))
+
+    def _relabel(self, index, count=1):
+        """
+        Make room for the labels of the ``count`` nodes at ``index``:
+        find a range of nodes around them of which the labels are not
+        too densely packed, and spread the labels evenly over that
+        range. Larger ranges should have more room per node, so the
+        labels end up spread out, relabeling is needed less often, and
+        amortized costs stay logarithmic.
+
+        >>> class A(object):
+        ...     pass
+        >>> t = Tree()
+        >>> t.index_nodes('key')
+        >>> nodes = [A() for i in range(100)]
+        >>> t.add(nodes[0])
+        >>> t.add(nodes[1])
+        >>> for n in nodes[2:]:
+        ...     t.add(n, index=1)
+        >>> labels = [n.key for n in t.nodes]
+        >>> labels == sorted(set(labels))
+        True
+        """
+        nodes = self._nodes
+        key = self._index_key
+        n = len(nodes)
+        size = 2 * count
+        density = 2.0
+        while True:
+            lo = max(0, index - (size - count) // 2)
+            hi = min(n, lo + size)
+            if lo == 0 or hi == n:
+                break
+            low = getattr(nodes[lo - 1], key)
+            high = getattr(nodes[hi], key)
+            if high - low > (hi - lo) * density:
+                break
+            size *= 2
+            density *= 1.5
+        self._spread(lo, hi)
 
     def sort(self, nodes, index_key, reverse=False):
         """
@@ -211,43 +629,49 @@ class Tree(object):
         else:
             raise NotImplemented('index_key should be provided.')
 
-    def _add_to_nodes(self, node, parent, index=None):
+    def _last_descendant(self, node):
         """
-        Helper method to place nodes on the right location in the
-        nodes list Called only from add() and reparent()
+        Return the last node in the subtree of ``node``. This is
+        ``node`` itself if it has no children.
+        """
+        children = self._children[node]
+        while children:
+            node = children[-1]
+            children = self._children[node]
+        return node
+
+    def _add_to_nodes(self, nodes, parent, index=None):
+        """
+        Helper method to place ``nodes``, a node and its children, on
+        the right location in the nodes list. Called only from _add().
         """
-        nodes = self._nodes
         siblings = self._children[parent]
         try:
             atnode = siblings[index]
         except (TypeError, IndexError):
-            index = len(siblings)
-            #self._add_to_nodes(node, parent)
-            if parent:
-                try:
-                    next_uncle = self.get_next_sibling(parent)
-                except IndexError:
-                    # parent has no younger brothers..
-                    # place it before the next uncle of grant_parent:
-                    return self._add_to_nodes(node, self.get_parent(parent))
-                else:
-                    nodes.insert(nodes.index(next_uncle), node)
-            else:
+            if parent is None:
                 # append to root node:
-                nodes.append(node)
+                position = len(self._nodes)
+            else:
+                # place it after the last node in parent's subtree
+                last = self._last_descendant(parent)
+                position = self._nodes.index(last) + 1
         else:
-            nodes.insert(nodes.index(atnode), node)
+            position = self._nodes.index(atnode)
+        self._insert_nodes(position, nodes)
 
 
-    def _add(self, node, parent=None, index=None):
+    def _add(self, node, parent=None, index=None, nodes=None):
         """
-        Helper method for both add() and reparent().
+        Helper method for both add() and reparent(). ``nodes`` is the
+        node with its children, in the order they appear in the nodes
+        list.
         """
         assert node not in self._nodes
 
         siblings = self._children[parent]
 
-        self._add_to_nodes(node, parent, index)
+        self._add_to_nodes(nodes or [node], parent, index)
 
         # Fix parent-child and child-parent relationship
         try:
@@ -271,39 +695,22 @@ class Tree(object):
         self._children[node] = []
 
 
-    def _remove(self, node):
-        # Remove from parent item
-        self.get_siblings(node).remove(node)
-        # Remove data entries:
-        del self._children[node]
-        self._nodes.remove(node)
-        try:
-            del self._parents[node]
-        except KeyError:
-            pass
-
     def remove(self, node):
         """
-        Remove ``node`` from the tree.
+        Remove ``node`` and its children from the tree.
 
         For usage, see the unit tests.
         """
-        # First remove children:
-        for c in reversed(list(self._children[node])):
-            self.remove(c)
-        self._remove(node)
-
-    def _reparent_nodes(self, node, parent):
-        """
-        Helper for reparent().
-        The _children and _parent trees can be left intact as far as
-        children of the reparented node are concerned. Only the
-        position in the _nodes list changes.
-        """
-        self._nodes.remove(node)
-        self._add_to_nodes(node, parent)
-        for c in self._children[node]:
-            self._reparent_nodes(c, node)
+        # Remove from parent item
+        self.get_siblings(node).remove(node)
+        # The node and its children are cut from the nodes list in one go
+        nodes = self._nodes
+        start = nodes.index(node)
+        stop = nodes.index(self._last_descendant(node)) + 1
+        # Remove data entries:
+        for n in nodes.delete(start, stop):
+            del self._children[n]
+            self._parents.pop(n, None)
 
     def reparent(self, node, parent, index=None):
         """
@@ -343,15 +750,17 @@ class Tree(object):
         # Remove all node references:
         old_parent = self.get_parent(node)
         self._children[old_parent].remove(node)
-        self._nodes.remove(node)
         if old_parent:
             del self._parents[node]
 
-        self._add(node, parent, index)
+        # The node and its children are kept together in the nodes
+        # list, so they can be moved in one go
+        nodes = self._nodes
+        start = nodes.index(node)
+        stop = nodes.index(self._last_descendant(node)) + 1
+        subtree = nodes.delete(start, stop)
 
-        # reorganize children in nodes list
-        for c in self._children[node]:
-            self._reparent_nodes(c, node)
+        self._add(node, parent, index, subtree)
 
 
 # vi: sw=4:et:ai
@@ -15,8 +15,7 @@ gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk, GObject, Gdk
 from cairo import Matrix
 from .canvas import Context
-from .geometry import Rectangle, distance_point_point_fast
-from .quadtree import Quadtree
+from .geometry import Rectangle, distance_point_point, distance_point_point_fast, rectangle_contains
 from .tool import DefaultTool
 from .painter import DefaultPainter, BoundingBoxPainter
 from .decorators import AsyncIO
@@ -30,11 +29,27 @@ DEBUG_DRAW_QUADTREE = False
 DEFAULT_CURSOR = Gdk.CursorType.LEFT_PTR
 
 
+def _transform_rectangle(matrix, rect):
+    """
+    Return the bounding box of rectangle ``rect`` (x, y, width,
+    height), transformed by ``matrix``.
+    """
+    x, y, w, h = rect
+    t = matrix.transform_point
+    xs, ys = list(zip(t(x, y), t(x + w, y), t(x, y + h), t(x + w, y + h)))
+    return Rectangle(min(xs), min(ys), x1=max(xs), y1=max(ys))
+
+
 class View(object):
     """
     View class for gaphas.Canvas objects.
     """
 
+    # Handles are drawn with a fixed size. The bounding boxes in the
+    # spatial index of the canvas do not include them, instead the
+    # view adds this margin (in pixels).
+    bounding_box_margin = 6
+
     def __init__(self, canvas=None):
         self._matrix = Matrix()
         self._painter = DefaultPainter(self)
@@ -48,7 +63,6 @@ class View(object):
         self._dropzone_item = None
         ###/
 
-        self._qtree = Quadtree()
         self._bounds = Rectangle(0, 0, 0, 0)
 
         self._canvas = None
@@ -66,7 +80,6 @@ class View(object):
         in the view.
         """
         if self._canvas:
-            self._qtree.clear()
             self._selected_items.clear()
             self._focused_item = None
             self._hovered_item = None
@@ -112,7 +125,7 @@ class View(object):
 
 
     def select_all(self):
-        for item in self.canvas.get_all_items():
+        for item in self.canvas.iter_items():
             self.select_item(item)
 
 
@@ -233,7 +246,7 @@ class View(object):
         Parameters:
          - selected: if False returns first non-selected item
         """
-        items = self._qtree.find_intersect((pos[0], pos[1], 1, 1))
+        items = self._find_items((pos[0], pos[1], 1, 1))
         for item in self._canvas.sort(items, reverse=True):
             if not selected and item in self.selected_items:
                 continue  # skip selected items
@@ -249,20 +262,27 @@ class View(object):
     def get_handle_at_point(self, pos, distance=6):
         """
         Look for a handle at ``pos`` and return the
-        tuple (item, handle).
+        tuple (item, handle). Handles of the focused and hovered item
+        are preferred, otherwise the topmost item with a handle at
+        ``pos`` is returned.
         """
         def find(item):
-            """ Find item's handle at pos """
+            """ Find item's handle nearest to pos """
             v2i = self.get_matrix_v2i(item)
             d = distance_point_point_fast(v2i.transform_distance(0, distance))
             x, y = v2i.transform_point(*pos)
 
+            found, found_d = None, None
             for h in item.handles():
                 if not h.movable:
                     continue
                 hx, hy = h.pos
-                if -d < (hx - x) < d and -d < (hy - y) < d:
-                    return h
+                dx, dy = hx - x, hy - y
+                if -d < dx < d and -d < dy < d:
+                    hd = dx * dx + dy * dy
+                    if found is None or hd < found_d:
+                        found, found_d = h, hd
+            return found
 
         # The focused item is the prefered item for handle grabbing
         if self.focused_item:
@@ -276,12 +296,12 @@ class View(object):
             if h:
                 return self.hovered_item, h
 
-        # Last try all items, checking the bounding box first
+        # Last try the items whose bounding box is near pos, topmost
+        # first, and stop at the first one with a handle at pos
         x, y = pos
-        items = self.get_items_in_rectangle((x - distance, y - distance, distance * 2, distance * 2), reverse=True)
-
-        found_item, found_h = None, None
-        for item in items:
+        items = self._find_items((x - distance, y - distance,
+                                  distance * 2, distance * 2))
+        for item in self._canvas.sort(items, reverse=True):
             h = find(item)
             if h:
                 return item, h
@@ -290,7 +310,9 @@ class View(object):
 
     def get_port_at_point(self, vpos, distance=10, exclude=None):
         """
-        Find item with port closest to specified position.
+        Find item with port closest to specified position. If ports
+        of several items are equally close, the topmost item is
+        returned.
 
         List of items to be ignored can be specified with `exclude`
         parameter.
@@ -305,42 +327,51 @@ class View(object):
          vpos
             Position specified in view coordinates.
          distance
-            Max distance from point to a port (default 10)
+            Max distance from point to a port, in view coordinates
+            (default 10)
          exclude
             Set of items to ignore.
         """
-        v2i = self.get_matrix_v2i
-        vx, vy = vpos
-
-        max_dist = distance
-        port = None
-        glue_pos = None
-        item = None
-
-        rect = (vx - distance, vy - distance, distance * 2, distance * 2)
-        items = self.get_items_in_rectangle(rect, reverse=True)
-        for i in items:
-            if i in exclude:
-                continue
-            for p in i.ports():
+        canvas = self._canvas
+        v2c = self.get_matrix_v2c()
+        cpos = v2c.transform_point(*vpos)
+        max_dist = distance_point_point(v2c.transform_distance(distance, 0))
+        exclude = exclude or ()
+        glued = {}
+
+        def port_distance(item):
+            """ Distance to item's nearest port, in canvas coordinates """
+            if item in exclude:
+                return None
+            ipos = canvas.get_matrix_c2i(item).transform_point(*cpos)
+            i2c = canvas.get_matrix_i2c(item).transform_point
+            found = None
+            for p in item.ports():
                 if not p.connectable:
                     continue
-
-                ix, iy = v2i(i).transform_point(vx, vy)
-                pg, d = p.glue((ix, iy))
-
-                if d >= max_dist:
-                    continue
-
-                max_dist = d
-                item = i
-                port = p
-
-                # transform coordinates from connectable item space to view
-                # space
-                i2v = self.get_matrix_i2v(i).transform_point
-                glue_pos = i2v(*pg)
-
+                pg, d = p.glue(ipos)
+                d = distance_point_point(i2c(*pg), cpos)
+                if d < max_dist and (found is None or d < found[0]):
+                    found = d, p, pg
+            if found:
+                glued[item] = found
+                return found[0]
+
+        # The index returns the item with the nearest port first
+        nearest = []
+        for d, item in canvas.spatial_index.iter_nearest(cpos, max_dist, port_distance):
+            if nearest and d > glued[nearest[0]][0]:
+                break
+            nearest.append(item)
+
+        if not nearest:
+            return None, None, None
+
+        item = canvas.sort(nearest, reverse=True)[0]
+        d, port, pg = glued[item]
+        # transform coordinates from connectable item space to view
+        # space
+        glue_pos = self.get_matrix_i2v(item).transform_point(*pg)
         return item, port, glue_pos
 
 
@@ -349,19 +380,37 @@ class View(object):
         Return the items in the rectangle 'rect'.
         Items are automatically sorted in canvas' processing order.
         """
-        if intersect:
-            items = self._qtree.find_intersect(rect)
-        else:
-            items = self._qtree.find_inside(rect)
+        items = self._find_items(rect, intersect)
         return self._canvas.sort(items, reverse=reverse)
 
 
+    def _find_items(self, rect, intersect=True):
+        """
+        Find the items in view rectangle ``rect`` in the spatial
+        index of the canvas. The index is in canvas coordinates, so
+        the rectangle is transformed, instead of the index.
+        """
+        qtree = self._canvas.spatial_index
+        v2c = self.get_matrix_v2c()
+        if intersect:
+            # The bounding boxes in the index lack the margin
+            m = self.bounding_box_margin
+            x, y, w, h = rect
+            return qtree.find_intersect(_transform_rectangle(v2c,
+                    (x - m, y - m, w + m * 2, h + m * 2)))
+        # Check the bounding boxes with margin. For rotated views the
+        # transformed rectangle is larger than the view rectangle, too.
+        get_bounds = self.get_item_bounding_box
+        items = qtree.find_inside(_transform_rectangle(v2c, rect))
+        return set(i for i in items if rectangle_contains(get_bounds(i), rect))
+
+
     def select_in_rectangle(self, rect):
         """
         Select all items who have their bounding box within the
         rectangle @rect.
         """
-        items = self._qtree.find_inside(rect)
+        items = self._find_items(rect, intersect=False)
         list(map(self.select_item, items))
 
 
@@ -371,17 +420,35 @@ class View(object):
         """
         # TODO: should the scale factor be clipped?
         self._matrix.scale(factor, factor)
+        self.matrix_changed()
+
 
-        # Make sure everything's updated
-        #map(self.update_matrix, self._canvas.get_all_items())
-        self.request_update((), self._canvas.get_all_items())
+    def matrix_changed(self):
+        """
+        Call this after the view matrix has changed (zooming,
+        panning). Bounding boxes are kept in canvas coordinates, so no
+        item needs to be updated. The item to view matrices are
+        recalculated when they're asked for.
+        """
+        self._bounds = self._get_soft_bounds()
+
+
+    def get_matrix_v2c(self):
+        """
+        Get the View to Canvas matrix.
+        """
+        v2c = Matrix(*self._matrix)
+        v2c.invert()
+        return v2c
 
 
     def set_item_bounding_box(self, item, bounds):
         """
         Update the bounding box of the item.
 
-        ``bounds`` is in view coordinates.
+        ``bounds`` is in view coordinates, without
+        ``bounding_box_margin``. The bounding box is stored in canvas
+        coordinates, in the spatial index of the canvas.
 
         Coordinates are calculated back to item coordinates, so
         matrix-only updates can occur.
@@ -389,14 +456,30 @@ class View(object):
         v2i = self.get_matrix_v2i(item).transform_point
         ix0, iy0 = v2i(bounds.x, bounds.y)
         ix1, iy1 = v2i(bounds.x1, bounds.y1)
-        self._qtree.add(item=item, bounds=bounds, data=(ix0, iy0, ix1, iy1))
+        self._canvas.set_item_bounding_box(item,
+                _transform_rectangle(self.get_matrix_v2c(), bounds),
+                data=(ix0, iy0, ix1, iy1))
 
 
     def get_item_bounding_box(self, item):
         """
         Get the bounding box for the item, in view coordinates.
         """
-        return self._qtree.get_bounds(item)
+        bounds = _transform_rectangle(self._matrix,
+                                      self._canvas.get_item_bounding_box(item))
+        bounds.expand(self.bounding_box_margin)
+        return bounds
+
+
+    def _get_soft_bounds(self):
+        """
+        The bounds of all items, in view coordinates.
+        """
+        qtree = self._canvas.spatial_index
+        bounds = _transform_rectangle(self._matrix, qtree.soft_bounds)
+        if len(qtree):
+            bounds.expand(self.bounding_box_margin)
+        return bounds
 
 
     bounding_box = property(lambda s: s._bounds)
@@ -417,7 +500,7 @@ class View(object):
                               area=None))
 
         # Update the view's bounding box with the rest of the items
-        self._bounds = Rectangle(*self._qtree.soft_bounds)
+        self._bounds = self._get_soft_bounds()
 
 
     def paint(self, cr):
@@ -430,8 +513,7 @@ class View(object):
         """
         Get Item to View matrix for ``item``.
         """
-        if self not in item._matrix_i2v:
-            self.update_matrix(item)
+        self.update_matrix(item)
         return item._matrix_i2v[self]
 
 
@@ -439,16 +521,21 @@ class View(object):
         """
         Get View to Item matrix for ``item``.
         """
-        if self not in item._matrix_v2i:
-            self.update_matrix(item)
+        self.update_matrix(item)
         return item._matrix_v2i[self]
 
 
     def update_matrix(self, item):
         """
-        Update item matrices related to view.
+        Update item matrices related to view. Nothing is calculated
+        if neither the item's i2c matrix nor the view matrix changed.
         """
         matrix_i2c = self.canvas.get_matrix_i2c(item)
+        key = (item._matrix_i2c_version, tuple(self._matrix))
+        if item._matrix_i2v_key.get(self) == key and self in item._matrix_i2v:
+            return
+        item._matrix_i2v_key[self] = key
+
         try:
             i2v = matrix_i2c.multiply(self._matrix)
         except AttributeError:
@@ -466,10 +553,11 @@ class View(object):
         """
         Clear registered data in Item's _matrix{i2c|v2i} attributes.
         """
-        for item in self.canvas.get_all_items():
+        for item in self.canvas.iter_items():
             try:
                 del item._matrix_i2v[self]
                 del item._matrix_v2i[self]
+                del item._matrix_i2v_key[self]
             except KeyError:
                 pass
 
@@ -607,7 +695,7 @@ class GtkView(Gtk.DrawingArea, Gtk.Scrollable, View):
 
         if self._canvas:
             self._canvas.register_view(self)
-            self.request_update(self._canvas.get_all_items())
+            self.request_update(self._canvas.iter_items())
         self.queue_draw_refresh()
 
     canvas = property(lambda s: s._canvas, _set_canvas)
@@ -627,11 +715,13 @@ class GtkView(Gtk.DrawingArea, Gtk.Scrollable, View):
 
     vadjustment = property(lambda s: s._vadjustment)
 
-    def zoom(self, factor):
+    def matrix_changed(self):
         """
-        Zoom in/out by factor ``factor``.
+        The view matrix has changed: update the scroll bars and
+        redraw.
         """
-        super(GtkView, self).zoom(factor)
+        super(GtkView, self).matrix_changed()
+        self.update_adjustments()
         self.queue_draw_refresh()
 
 
@@ -646,7 +736,7 @@ class GtkView(Gtk.DrawingArea, Gtk.Scrollable, View):
         vadjustment = self._vadjustment
 
         # canvas limits (in view coordinates)
-        c = Rectangle(*self._qtree.soft_bounds)
+        c = self._get_soft_bounds()
 
         # view limits
         v = Rectangle(0, 0, aw, ah)
@@ -692,11 +782,10 @@ class GtkView(Gtk.DrawingArea, Gtk.Scrollable, View):
         TODO: Should we also create a (sorted) list of items that need
         redrawal?
         """
-        get_bounds = self._qtree.get_bounds
+        get_bounds = self.get_item_bounding_box
         items = [_f for _f in items if _f]
         try:
-            # create a copy, otherwise we'll change the original rectangle
-            bounds = Rectangle(*get_bounds(items[0]))
+            bounds = get_bounds(items[0])
             for item in items[1:]:
                 bounds += get_bounds(item)
             self.queue_draw_area(*bounds)
@@ -732,18 +821,24 @@ class GtkView(Gtk.DrawingArea, Gtk.Scrollable, View):
         treatment, while ``matrix_only_items`` will only have their
         bounding box recalculated.
         """
+        # Mark old bb sections for update right away: the spatial index
+        # is shared, other views may update it before update() is called.
         if items:
+            items = list(items)
             self._dirty_items.update(items)
+            self.queue_draw_item(*items)
         if matrix_only_items:
+            matrix_only_items = list(matrix_only_items)
             self._dirty_matrix_items.update(matrix_only_items)
+            self.queue_draw_item(*matrix_only_items)
 
         # Remove removed items:
         if removed_items:
             self._dirty_items.difference_update(removed_items)
             self.queue_draw_item(*removed_items)
 
+            # The canvas removes the items from the spatial index
             for item in removed_items:
-                self._qtree.remove(item)
                 self.selected_items.discard(item)
 
             if self.focused_item in removed_items:
@@ -766,14 +861,11 @@ class GtkView(Gtk.DrawingArea, Gtk.Scrollable, View):
 
         dirty_items = self._dirty_items
         dirty_matrix_items = self._dirty_matrix_items
+        qtree = self._canvas.spatial_index
 
         try:
-            self.queue_draw_item(*dirty_items)
-
-            # Mark old bb section for update
-            self.queue_draw_item(*dirty_matrix_items)
             for i in dirty_matrix_items:
-                if i not in self._qtree:
+                if i not in qtree:
                     dirty_items.add(i)
                     self.update_matrix(i)
                     continue
@@ -783,12 +875,7 @@ class GtkView(Gtk.DrawingArea, Gtk.Scrollable, View):
                 if i not in dirty_items:
                     # Only matrix has changed, so calculate new bb based
                     # on quadtree data (= bb in item coordinates).
-                    bounds = self._qtree.get_data(i)
-                    i2v = self.get_matrix_i2v(i).transform_point
-                    x0, y0 = i2v(bounds[0], bounds[1])
-                    x1, y1 = i2v(bounds[2], bounds[3])
-                    vbounds = Rectangle(x0, y0, x1=x1, y1=y1)
-                    self._qtree.add(i, vbounds, bounds)
+                    self._canvas.update_item_bounding_box(i)
 
             self.queue_draw_item(*dirty_matrix_items)
 
@@ -825,7 +912,6 @@ class GtkView(Gtk.DrawingArea, Gtk.Scrollable, View):
         Gtk.DrawingArea.do_size_allocate(self, allocation)
         self.set_allocation(allocation)
         self.update_adjustments(allocation)
-        self._qtree.resize((0, 0, allocation.width, allocation.height))
 
     def on_size_allocate(self, widget, allocation):
         pass
@@ -837,14 +923,13 @@ class GtkView(Gtk.DrawingArea, Gtk.Scrollable, View):
         self._canvas.register_view(self)
 
         if self._canvas:
-            self.request_update(self._canvas.get_all_items())
+            self.request_update(self._canvas.iter_items())
 
     def do_unrealize(self):
         if self.canvas:
             # Although Item._matrix_{i2v|v2i} keys are automatically removed
             # (weak refs), better do it explicitly to be sure.
             self._clear_matrices()
-        self._qtree.clear()
 
         self._dirty_items.clear()
         self._dirty_matrix_items.clear()
@@ -889,14 +974,14 @@ class GtkView(Gtk.DrawingArea, Gtk.Scrollable, View):
 
         # Draw Quadtree structure
         if DEBUG_DRAW_QUADTREE:
-            def draw_qtree_bucket(bucket):
-                cr.rectangle(*bucket.bounds)
-                cr.stroke()
-                for b in bucket._buckets:
-                    draw_qtree_bucket(b)
+            cr.save()
+            cr.transform(self._matrix)
             cr.set_source_rgb(0, 0, .8)
-            cr.set_line_width(1.0)
-            draw_qtree_bucket(self._qtree._bucket)
+            cr.set_line_width(1.0 / self._matrix[0])
+            for bounds in self._canvas.spatial_index.node_bounds():
+                cr.rectangle(*bounds)
+                cr.stroke()
+            cr.restore()
 
         return False
 
@@ -930,9 +1015,6 @@ class GtkView(Gtk.DrawingArea, Gtk.Scrollable, View):
             m.translate(0, -value)
         self._matrix *= m
 
-        # Force recalculation of the bounding boxes:
-        self.request_update((), self._canvas.get_all_items())
-
-        self.queue_draw_refresh()
+        self.matrix_changed()
 
 # vim: sw=4:et:ai